@@ -9,8 +9,9 @@ from flask import Blueprint, Flask
 from flask_restx import Api
 
 from app.commands import cache
-from app.endpoints import calculation_module, datasets, wms
+from app.endpoints import calculation_module, datasets, mvt, wms, wmts
 from app.healthz import healthz
+from app.metrics import metrics
 
 
 class ReverseProxied(object):
@@ -47,6 +48,7 @@ def create_app(environment="production", testing=False, on_startup=False):
     app.config["RASTER_CACHE_DIR"] = None
     app.config["WMS_CACHE_DIR"] = "wms_cache"
     app.config["CM_OUTPUTS_DIR"] = "cm_outputs"
+    app.config["CM_TASK_MAX_WAIT"] = 30
     app.config["FILTER_DATASETS"] = False
     app.config["RASTER_PROJECTION_SYSTEM"] = "EPSG:3035"
     app.config["VECTOR_PROJECTION_SYSTEM"] = "EPSG:4326"
@@ -55,6 +57,25 @@ def create_app(environment="production", testing=False, on_startup=False):
     app.config["WMS"]["MAX_SIZE"] = 2048 ** 2
     app.config["WMS"]["GETMAP"] = {}
     app.config["WMS"]["GETMAP"]["ALLOWED_OUTPUTS"] = ["image/png", "image/jpg"]
+    app.config["WMS"]["TILE_CACHE"] = {}
+    app.config["WMS"]["TILE_CACHE"]["ENABLED"] = True
+    app.config["WMS"]["TILE_CACHE"]["MEMORY_SIZE"] = 64 * 1024 * 1024
+    app.config["WMS"]["TILE_CACHE"]["DISK_SIZE"] = 2 * 1024 * 1024 * 1024
+    app.config["WMS"]["METATILE"] = {}
+    # Only used by "flask seed-tiles" unless enabled: rendering a metatile on demand
+    # makes the first request of a tile much slower
+    app.config["WMS"]["METATILE"]["ENABLED"] = False
+    app.config["WMS"]["METATILE"]["SIZE"] = 8
+    app.config["WMS"]["METATILE"]["BUFFER"] = 64
+    app.config["WMTS"] = {}
+    app.config["WMTS"]["MAX_ZOOM"] = 18
+    app.config["WMTS"]["MAX_AGE"] = 3600
+    app.config["MVT"] = {}
+    app.config["MVT"]["MAX_ZOOM"] = 18
+    app.config["MVT"]["MAX_AGE"] = 3600
+    app.config["CACHE"] = {}
+    app.config["CACHE"]["MAX_JOBS_PER_HOST"] = 4
+    app.config["CACHE"]["VERSIONS_GRACE_PERIOD"] = 10 * 60
 
     for k, v in app.config.items():
         app.config[k] = os.environ.get(k, v)
@@ -64,17 +85,24 @@ def create_app(environment="production", testing=False, on_startup=False):
     api = Api(api_bp)
     api.add_namespace(datasets.api)
     api.add_namespace(wms.api)
+    api.add_namespace(wmts.api)
+    api.add_namespace(mvt.api)
     api.add_namespace(calculation_module.api)
 
     app.register_blueprint(api_bp)
     app.register_blueprint(healthz)
+    app.register_blueprint(metrics)
 
     app.cli.add_command(cache.update_all_datasets)
     app.cli.add_command(cache.update_dataset)
     app.cli.add_command(cache.update_areas)
+    app.cli.add_command(cache.update_capabilities)
     app.cli.add_command(cache.list_datasets)
     app.cli.add_command(cache.get_parameters)
     app.cli.add_command(cache.get_legend)
+    app.cli.add_command(cache.update_legends)
+    app.cli.add_command(cache.optimize_rasters)
+    app.cli.add_command(cache.seed_tiles)
 
     # Install the WSGI middleware
     app.wsgi_app = ReverseProxied(app.wsgi_app)
@@ -1,28 +1,47 @@
+import functools
 import itertools
 import json
+import multiprocessing
+import os
 import time
+from tempfile import TemporaryDirectory
 
 import click
-from flask import current_app
+from flask import current_app, safe_join
 from flask.cli import with_appcontext
 
+from app.commands.jobs import JobGraph
 from app.common import client
 from app.common import datasets as datasets_fcts
-from app.common import path
+from app.common import file_cache, path
 from app.common.projection import epsg_string_to_proj4
 from app.models import geofile, storage
+from app.models.wms import capabilities, grid, registry
+from app.models.wms.capabilities import get_layer_names
+from app.models.wms.map import create_default_legend, get_map_data
 
 
 @click.command("update-all-datasets")
+@click.option("--optimize", is_flag=True)
+@click.option("-j", "--jobs", default=1)
+@click.option("--force", is_flag=True)
 @with_appcontext
-def update_all_datasets():
+def update_all_datasets(optimize, jobs, force):
     datasets = client.get_dataset_list(disable_filtering=True)
     if len(datasets) == 0:
         current_app.logger.info("No dataset found")
         return
 
+    graph = create_job_graph(jobs)
+
     for dataset in datasets:
-        process_dataset(dataset, ignore_intersecting=True)
+        add_dataset_job(
+            graph, dataset, ignore_intersecting=True, optimize=optimize, force=force
+        )
+
+    run_job_graph(graph)
+
+    update_capabilities_document()
 
 
 @click.command("update-dataset")
@@ -32,8 +51,13 @@ def update_all_datasets():
 @click.option("-d", "--dimension", default=5.0)
 @click.option("-p", "--prettyprint", is_flag=True)
 @click.option("-l", "--rowlimit", default=1000)
+@click.option("--optimize", is_flag=True)
+@click.option("-j", "--jobs", default=1)
+@click.option("--force", is_flag=True)
 @with_appcontext
-def update_dataset(ds_id, all, center, dimension, prettyprint, rowlimit):
+def update_dataset(
+    ds_id, all, center, dimension, prettyprint, rowlimit, optimize, jobs, force
+):
     datasets = client.get_dataset_list(disable_filtering=True)
     datasets = [x for x in datasets if x["ds_id"] == int(ds_id)]
 
@@ -59,13 +83,21 @@ def update_dataset(ds_id, all, center, dimension, prettyprint, rowlimit):
             return
 
     if len(datasets) == 1:
-        process_dataset(
+        graph = create_job_graph(jobs)
+
+        add_dataset_job(
+            graph,
             datasets[0],
             ignore_intersecting=all,
             target_area=target_area,
             pretty_print=prettyprint,
             # row_limit=rowlimit,
+            optimize=optimize,
+            force=force,
         )
+
+        run_job_graph(graph)
+        update_capabilities_document()
     else:
         current_app.logger.info("Dataset not found")
 
@@ -81,6 +113,21 @@ def update_areas():
         process_area(area["id"])
 
 
+@click.command("update-capabilities")
+@with_appcontext
+def update_capabilities():
+    """Rebuild the capabilities document of the WMS, to be done when the datasets or
+    their parameters were modified without updating the cache
+    """
+    update_capabilities_document()
+
+
+def update_capabilities_document():
+    current_app.logger.info("Update the capabilities document")
+    if not capabilities.save_capabilities():
+        current_app.logger.error("Failed to build the capabilities document")
+
+
 @click.command("list-datasets")
 @click.option("-p", "--prettyprint", is_flag=True)
 @with_appcontext
@@ -211,15 +258,381 @@ def get_legend(ds_id, variable, time_period, prettyprint):
         return
 
 
+@click.command("update-legends")
+@click.option("--ds-id", "ds_ids", type=int, multiple=True)
+@with_appcontext
+def update_legends(ds_ids):
+    """Rebuild the legend files of the layers already in the cache, to be done when
+    the legends were modified in the database without updating the cache
+    """
+    datasets = client.get_dataset_list(disable_filtering=True)
+    if len(ds_ids) > 0:
+        datasets = [x for x in datasets if x["ds_id"] in ds_ids]
+
+    if len(datasets) == 0:
+        current_app.logger.info("No dataset found")
+        return
+
+    layer_names = []
+    for dataset in datasets:
+        for layer_name in get_layer_names(dataset):
+            # The legends of all the variables of a vector layer are in the same file
+            if path.get_type(layer_name) == path.VECTOR:
+                (type, id, _, time_period, _) = path.parse_unique_layer_name(layer_name)
+                layer_name = path.make_unique_layer_name(
+                    type, id, time_period=time_period
+                )
+
+            if layer_name not in layer_names:
+                layer_names.append(layer_name)
+
+    for layer_name in layer_names:
+        current_app.logger.info(f"Update the legends of <{layer_name}>...")
+
+        variables = None
+        if path.get_type(layer_name) == path.VECTOR:
+            storage_instance = storage.create(layer_name)
+            variables = file_cache.get_json(
+                storage_instance.get_variables_file(layer_name)
+            )
+
+        # The legend file is replaced in a new version of the layer, so the other
+        # processes never render a layer with the legends of another version
+        geofile.begin_layer_update(layer_name, copy=True)
+
+        try:
+            if not save_legends(layer_name, variables=variables):
+                geofile.abort_layer_update(layer_name)
+                continue
+
+            # Invalidate the images rendered with the previous legends
+            geofile.update_layer_version(layer_name)
+        except Exception:
+            geofile.abort_layer_update(layer_name)
+            raise
+
+        geofile.publish_layer_update(layer_name)
+
+
+@click.command("optimize-rasters")
+@click.option("--ds-id", "ds_ids", type=int, multiple=True)
+@with_appcontext
+def optimize_rasters(ds_ids):
+    """Convert the raster files already in the cache into tiled and compressed GeoTIFF
+    files with internal overviews, and rebuild the mosaics using them
+    """
+    if current_app.config["RASTER_CACHE_DIR"] is not None:
+        current_app.logger.info("The raster files aren't stored in the cache")
+        return
+
+    datasets = client.get_dataset_list(disable_filtering=True)
+    datasets = [x for x in datasets if x["is_raster"]]
+    if len(ds_ids) > 0:
+        datasets = [x for x in datasets if x["ds_id"] in ds_ids]
+
+    if len(datasets) == 0:
+        current_app.logger.info("No dataset found")
+        return
+
+    nb_files = 0
+
+    for dataset in datasets:
+        for layer_name in get_layer_names(dataset):
+            nb_files += optimize_raster_layer(layer_name)
+
+    current_app.logger.info(f"{nb_files} raster files optimized")
+
+
+def optimize_raster_layer(layer_name):
+    """Optimize the raster files of a layer that aren't already, and rebuild its
+    mosaic. This is done in a new version of the layer, published once complete.
+    Return the number of files optimized.
+    """
+    storage_instance = storage.create(layer_name)
+
+    geometries = storage_instance.get_geometries(layer_name) or {}
+
+    feature_ids = []
+    for feature_id in geometries.keys():
+        filename = storage_instance.get_file_path(layer_name, feature_id)
+        if os.path.exists(filename) and not geofile.is_optimized_raster_file(filename):
+            feature_ids.append(feature_id)
+
+    if len(feature_ids) == 0:
+        return 0
+
+    geofile.begin_layer_update(layer_name, copy=True)
+
+    nb_files = 0
+
+    try:
+        for feature_id in feature_ids:
+            # The file of the new version is replaced, not the one of the current
+            # version it is linked to
+            filename = storage_instance.get_file_path(layer_name, feature_id)
+
+            current_app.logger.info(f"Optimize <{filename}>...")
+            if geofile.optimize_raster_file(filename, storage_instance.get_tmp_dir()):
+                nb_files += 1
+            else:
+                current_app.logger.info("... failed to optimize the raster file")
+
+        if nb_files == 0:
+            geofile.abort_layer_update(layer_name)
+            return 0
+
+        current_app.logger.info(f"Rebuild the mosaic of <{layer_name}>...")
+        if not geofile.save_raster_mosaic(layer_name):
+            current_app.logger.info("... failed to build the mosaic")
+
+        # Invalidate everything rendered from the previous files
+        geofile.update_layer_version(layer_name)
+    except Exception:
+        geofile.abort_layer_update(layer_name)
+        raise
+
+    geofile.publish_layer_update(layer_name)
+
+    return nb_files
+
+
+@click.command("seed-tiles")
+@click.option("--ds-id", "ds_ids", type=int, multiple=True)
+@click.option("-z", "--zoom", default="0-8")
+@click.option("-w", "--workers", default=1)
+@click.option("--checkpoint", default=None)
+@click.option("--restart", is_flag=True)
+@with_appcontext
+def seed_tiles(ds_ids, zoom, workers, checkpoint, restart):
+    """Render the XYZ tiles of the layers over a range of zoom levels and store them
+    in the tile cache. The tiles already seeded (as recorded in the checkpoint file)
+    are skipped, unless their layer was modified since then.
+
+    The tiles are always rendered by metatiles, even if they are disabled for the
+    requests.
+    """
+    if not current_app.config["WMS"]["TILE_CACHE"]["ENABLED"]:
+        current_app.logger.error("The tile cache is disabled")
+        return
+
+    try:
+        zoom_levels = parse_zoom_levels(zoom)
+    except ValueError:
+        current_app.logger.error(
+            "Invalid zoom levels. Must be --zoom=<level> or --zoom=<min>-<max>"
+        )
+        return
+
+    datasets = client.get_dataset_list(disable_filtering=True)
+    if len(ds_ids) > 0:
+        datasets = [x for x in datasets if x["ds_id"] in ds_ids]
+
+    if len(datasets) == 0:
+        current_app.logger.info("No dataset found")
+        return
+
+    # Each unit of work is a column of metatiles of a layer at a given zoom level
+    units = []
+    for dataset in datasets:
+        for layer_name in get_layer_names(dataset):
+            units.extend(get_seed_units(layer_name, zoom_levels))
+
+    if checkpoint is None:
+        checkpoint = safe_join(
+            current_app.config["WMS_CACHE_DIR"], "seed-tiles.checkpoint"
+        )
+
+    if not restart and os.path.exists(checkpoint):
+        with open(checkpoint, "r") as f:
+            done = set(f.read().splitlines())
+
+        units = [x for x in units if get_seed_unit_id(x) not in done]
+
+    current_app.logger.info(
+        f"Seed {sum([len(x[4]) for x in units])} tiles, zoom levels"
+        f" {zoom_levels[0]} to {zoom_levels[-1]}..."
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+
+    time_started = time.time()
+    time_reported = time_started
+    nb_tiles = 0
+
+    with open(checkpoint, "w" if restart else "a") as f:
+        for unit_id, nb_unit_tiles in run_seed_units(units, workers):
+            f.write(unit_id + "\n")
+            f.flush()
+
+            nb_tiles += nb_unit_tiles
+
+            if time.time() - time_reported >= 10:
+                time_reported = time.time()
+                current_app.logger.info(
+                    f"... {nb_tiles} tiles"
+                    f" ({nb_tiles / (time_reported - time_started):.1f} tiles/s)"
+                )
+
+    duration = time.time() - time_started
+    current_app.logger.info(
+        f"... {nb_tiles} tiles seeded in {int(duration)} seconds"
+        f" ({nb_tiles / max(duration, 0.001):.1f} tiles/s)"
+    )
+
+
+def parse_zoom_levels(text):
+    """Return the list of zoom levels described by a "<level>" or "<min>-<max>" text"""
+    parts = [int(x) for x in text.split("-")]
+    if (len(parts) > 2) or (min(parts) < 0) or (parts[0] > parts[-1]):
+        raise ValueError(text)
+
+    return list(range(parts[0], parts[-1] + 1))
+
+
+def get_seed_units(layer_name, zoom_levels):
+    """Return the units of work needed to seed the tiles of a layer, as (layer name,
+    layer version, zoom level, first column, tiles) tuples. Each unit covers a whole
+    column of metatiles, so that a metatile is rendered by only one worker.
+    """
+    version = geofile.get_layer_version(layer_name)
+    if version is None:
+        current_app.logger.info(f"... no version for <{layer_name}>, not seeded")
+        return []
+
+    bbox = storage.create(layer_name).get_bbox(layer_name)
+    if bbox is None:
+        current_app.logger.info(f"... no bounding box for <{layer_name}>, not seeded")
+        return []
+
+    metatile_size = current_app.config["WMS"]["METATILE"]["SIZE"]
+
+    units = []
+    for z in zoom_levels:
+        columns = {}
+        for x, y in grid.get_tiles_in_bbox(
+            z, bbox["left"], bbox["bottom"], bbox["right"], bbox["top"]
+        ):
+            (x0, _, _) = grid.get_metatile(z, x, y, metatile_size)
+            columns.setdefault(x0, []).append((x, y))
+
+        for x0, tiles in columns.items():
+            units.append((layer_name, version, z, x0, tiles))
+
+    return units
+
+
+def get_seed_unit_id(unit):
+    (layer_name, version, z, x, _) = unit
+    return f"{layer_name} {version} {z} {x}"
+
+
+def run_seed_units(units, workers):
+    """Seed the tiles of all the units, yielding (unit id, number of tiles) tuples
+    as they are done
+    """
+    if workers <= 1:
+        for unit in units:
+            yield seed_unit(unit)
+        return
+
+    # The worker processes are forked, and inherit the application
+    global _seed_app
+    _seed_app = current_app._get_current_object()
+
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, initializer=_init_seed_worker) as pool:
+        for result in pool.imap_unordered(seed_unit, units):
+            yield result
+
+
+_seed_app = None
+
+
+def _init_seed_worker():
+    _seed_app.app_context().push()
+    registry.clear()
+
+
+def seed_unit(unit):
+    """Render the tiles of a unit of work into the tile cache"""
+    (layer_name, _, z, _, tiles) = unit
+
+    for x, y in tiles:
+        try:
+            get_map_data(grid.get_getmap_args(layer_name, z, x, y), metatile=True)
+        except Exception as e:
+            current_app.logger.error(f"Failed to seed {layer_name} {z}/{x}/{y}: {e}")
+
+    return (get_seed_unit_id(unit), len(tiles))
+
+
+def create_job_graph(workers):
+    return JobGraph(
+        workers=workers,
+        max_per_host=current_app.config["CACHE"]["MAX_JOBS_PER_HOST"],
+    )
+
+
+def run_job_graph(graph):
+    """Run the jobs of the graph, and log a summary of what was done"""
+    time_started = time.time()
+
+    graph.run()
+
+    duration = max(time.time() - time_started, 0.001)
+
+    result = f"\nDone in {int(duration)} seconds ({graph.workers} workers):\n"
+    for kind, (nb_jobs, nb_failures, jobs_duration) in graph.get_summary().items():
+        result += (
+            f"- {kind}: {nb_jobs - nb_failures}/{nb_jobs} succeeded,"
+            f" {nb_jobs / duration:.2f}/s, {jobs_duration / nb_jobs:.1f} s/job\n"
+        )
+
+    stats = client.get_stats()
+    result += (
+        f"- requests: {stats['requests']} ({stats['errors']} errors),"
+        f" max latency {stats['max_latency']:.1f} s\n"
+    )
+
+    if len(graph.failures) > 0:
+        result += "\nFailures:\n"
+        for job in graph.failures:
+            result += f"- {job.name}\n"
+
+    current_app.logger.info(result)
+
+
+def add_dataset_job(graph, dataset, **kwargs):
+    """Add the job caching all the layers of a dataset to the graph"""
+    return graph.add(
+        f"dataset {dataset['ds_id']}",
+        functools.partial(process_dataset, graph, dataset, **kwargs),
+        kind="dataset",
+        url=client.DATASETS_SERVER_URL,
+    )
+
+
 def process_dataset(
-    dataset, ignore_intersecting=False, target_area=None, pretty_print=False
+    graph,
+    dataset,
+    ignore_intersecting=False,
+    target_area=None,
+    pretty_print=False,
+    optimize=False,
+    force=False,
 ):
+    """Add the jobs needed to cache all the layers of a dataset to the graph. Return
+    False if the parameters of the dataset couldn't be retrieved.
+    """
     type = path.RASTER if dataset["is_raster"] else path.VECTOR
 
     # Retrieve the variables of the dataset
     parameters = client.get_parameters(dataset["ds_id"])
     if parameters is None:
-        return
+        current_app.logger.info(
+            f"... failed to retrieve the parameters of dataset <{dataset['ds_id']}>"
+        )
+        return False
 
     datasets_fcts.process_parameters(parameters)
 
@@ -228,86 +641,84 @@ def process_dataset(
         parameters["variables"] = []
 
     # Iterate over all combinations of variables and time_periods
-    if (len(parameters["variables"]) > 0) and (len(parameters["time_periods"]) > 0):
-        for variable, time_period in itertools.product(
-            parameters["variables"], parameters["time_periods"]
-        ):
-            success, _ = process_layer(
-                type,
-                dataset["ds_id"],
-                variable=variable,
-                time_period=time_period,
-                ignore_intersecting=ignore_intersecting,
-                target_area=target_area,
-                pretty_print=pretty_print,
-            )
+    variables = parameters["variables"] or [None]
+    time_periods = parameters["time_periods"] or [None]
 
-            if not success:
-                break
+    layer_jobs = []
+    for variable, time_period in itertools.product(variables, time_periods):
+        layer_name = path.make_unique_layer_name(
+            type, dataset["ds_id"], variable=variable, time_period=time_period
+        )
 
-    elif len(parameters["variables"]) > 0:
-        for variable in parameters["variables"]:
-            success, _ = process_layer(
+        job = graph.add(
+            layer_name,
+            functools.partial(
+                process_layer,
+                graph,
                 type,
                 dataset["ds_id"],
                 variable=variable,
-                ignore_intersecting=ignore_intersecting,
-                target_area=target_area,
-                pretty_print=pretty_print,
-            )
-
-            if not success:
-                break
-    elif len(parameters["time_periods"]) > 0:
-        valid_combinations = {}
-
-        for time_period in parameters["time_periods"]:
-            success, valid_variables = process_layer(
-                type,
-                dataset["ds_id"],
                 time_period=time_period,
                 ignore_intersecting=ignore_intersecting,
                 target_area=target_area,
                 pretty_print=pretty_print,
-            )
-
-            if not success:
-                break
+                optimize=optimize,
+                force=force,
+            ),
+            kind="layer",
+        )
 
-            if valid_variables is not None:
-                if time_period not in valid_combinations:
-                    valid_combinations[time_period] = []
+        layer_jobs.append((time_period, job))
+
+    def _finalize():
+        succeeded = [(x, job) for x, job in layer_jobs if job.result is not None]
+        if len(succeeded) == 0:
+            return False
+
+        # For vector datasets, save the variables available for each time period
+        if (type == path.VECTOR) and (parameters["time_periods"]):
+            valid_combinations = {}
+            for time_period, job in succeeded:
+                (success, valid_variables) = job.result
+                if success and (valid_variables is not None):
+                    valid_combinations.setdefault(time_period, []).extend(
+                        valid_variables
+                    )
+
+            if len(valid_combinations) > 0:
+                layer_name = path.make_unique_layer_name(type, dataset["ds_id"])
+                storage_instance = storage.create(layer_name)
+                with open(
+                    storage_instance.get_combinations_file(layer_name),
+                    "w",
+                ) as f:
+                    json.dump(valid_combinations, f)
+
+        # For raster datasets, save the projection in a file
+        if type == path.RASTER:
+            current_app.logger.info(
+                f"... save projection of dataset <{dataset['ds_id']}>"
+            )
+            layer_name = path.make_unique_layer_name(type, dataset["ds_id"])
+            geofile.save_raster_projection(
+                layer_name,
+                epsg_string_to_proj4(current_app.config["RASTER_PROJECTION_SYSTEM"]),
+            )
 
-                valid_combinations[time_period].extend(valid_variables)
+        return True
 
-        if (type == path.VECTOR) and (len(valid_combinations) > 0):
-            layer_name = path.make_unique_layer_name(type, dataset["ds_id"])
-            storage_instance = storage.create(layer_name)
-            with open(
-                storage_instance.get_combinations_file(layer_name),
-                "w",
-            ) as f:
-                json.dump(valid_combinations, f)
-    else:
-        success, _ = process_layer(
-            type,
-            dataset["ds_id"],
-            ignore_intersecting=ignore_intersecting,
-            target_area=target_area,
-            pretty_print=pretty_print,
-        )
+    graph.add(
+        f"dataset {dataset['ds_id']} (save)",
+        _finalize,
+        kind="save",
+        depends_on=[job for _, job in layer_jobs],
+    )
 
-    # For raster datasets, save the projection in a file
-    if success and (type == path.RASTER):
-        current_app.logger.info("... save projection")
-        layer_name = path.make_unique_layer_name(type, dataset["ds_id"])
-        geofile.save_raster_projection(
-            layer_name,
-            epsg_string_to_proj4(current_app.config["RASTER_PROJECTION_SYSTEM"]),
-        )
+    return True
 
 
 def process_layer(
+    graph,
     type,
     id,
     variable=None,
@@ -315,33 +726,45 @@ def process_layer(
     ignore_intersecting=False,
     target_area=None,
     pretty_print=False,
+    optimize=False,
+    force=False,
 ):
+    """Cache a layer. For raster layers, the downloads of the raster files and the
+    final steps are added to the graph as children of the current job.
+
+    The layer jobs aren't tagged with the host of the datasets server, since most of
+    their time is spent processing the data: they only hold a slot of the host while
+    fetching it (see JobGraph.host_slot()).
+
+    The layer is rebuilt in a staging directory, and only replaces the current
+    version once complete. Unless forced, only the raster files that changed on the
+    server since the last time (according to the manifest of the layer) are
+    downloaded, and the vector layers are only downloaded if their content changed.
+
+    Return a (success, valid variables) tuple, or None if the layer couldn't be
+    cached at all.
+    """
     layer_name = path.make_unique_layer_name(
         type, id, variable=variable, time_period=time_period
     )
 
-    time_started = time.time()
-
     if type == path.VECTOR:
-        current_app.logger.info(f"Download geojson <{layer_name}>...")
-
-        data = client.get_geojson(
+        result = process_vector_layer(
+            graph,
             layer_name,
             ignore_intersecting=ignore_intersecting,
             target_area=target_area,
             pretty_print=pretty_print,
+            force=force,
         )
 
-        if data is None:
-            current_app.logger.info("... failed to retrieve the geojson")
-            return (False, None)
+        return result if result[0] else None
 
-        if (data["features"] is None) or (len(data["features"]) == 0):
-            current_app.logger.info("... no feature found in the geojson")
-            return (False, None)
-    else:
-        current_app.logger.info(f"Download raster files list of <{layer_name}>...")
+    time_started = time.time()
+
+    current_app.logger.info(f"Download raster files list of <{layer_name}>...")
 
+    with graph.host_slot(client.DATASETS_SERVER_URL):
         data = client.get_rasters(
             layer_name,
             ignore_intersecting=ignore_intersecting,
@@ -349,71 +772,316 @@ def process_layer(
             pretty_print=pretty_print,
         )
 
-        if data is None:
-            current_app.logger.info("... failed to retrieve the list of raster files")
-            return (False, None)
-
-        if len(data) == 0:
-            current_app.logger.info("... no raster file found")
-            return (False, None)
+    if data is None:
+        current_app.logger.info(
+            f"... failed to retrieve the list of raster files of <{layer_name}>"
+        )
+        return None
 
-    time_fetched = time.time()
+    if len(data) == 0:
+        current_app.logger.info(f"... no raster file found for <{layer_name}>")
+        return None
 
     current_app.logger.info(
-        f"... fetch done in {int(time_fetched - time_started)} seconds"
+        f"... fetch of <{layer_name}> done in {int(time.time() - time_started)} seconds"
     )
 
-    geofile.delete_all_features(layer_name)
+    manifest = None
+    if not force:
+        manifest = storage.create(layer_name).get_manifest(layer_name)
+
+    previous_files = manifest["files"] if manifest is not None else {}
+
+    previous_dir = geofile.begin_layer_update(layer_name)
+
+    # Don't download raster files if we have directly access to them
+    download_jobs = []
+    if current_app.config["RASTER_CACHE_DIR"] is None:
+        for feature in data:
+            download_jobs.append(
+                graph.add(
+                    f"{layer_name} {feature['fid']}",
+                    functools.partial(
+                        download_raster_file,
+                        layer_name,
+                        id,
+                        feature["fid"],
+                        previous=previous_files.get(feature["fid"]),
+                        previous_dir=previous_dir,
+                        optimize=optimize,
+                    ),
+                    kind="raster file",
+                    url=client.RASTER_SERVER_URL,
+                )
+            )
 
-    valid_variables = None
-    success = True
+    def _finalize():
+        if not all(job.success for job in download_jobs):
+            current_app.logger.info(
+                f"... failed to download some raster files of <{layer_name}>, keep"
+                " the previous version"
+            )
+            geofile.abort_layer_update(layer_name)
+            return False
 
-    if type == path.VECTOR:
-        valid_variables = geofile.save_vector_geojson(layer_name, data)
-    else:
-        # Don't download raster files if we have directly access to them
-        if current_app.config["RASTER_CACHE_DIR"] is None:
-            for feature in data:
-                feature_id = feature["fid"]
-                current_app.logger.info(f"... download raster file <{feature_id}>")
-                raster_content = client.get_raster_file(id, feature_id)
-
-                if raster_content is not None:
-                    geofile.save_raster_file(layer_name, feature_id, raster_content)
-                else:
-                    success = False
-                    break
-
-        current_app.logger.info("... save geometries")
-        geofile.save_raster_geometries(layer_name, data)
-
-    time_saved = time.time()
-    current_app.logger.info(
-        f"... save done in {int(time_saved - time_fetched)} seconds."
+        try:
+            save_raster_layer(
+                layer_name, data, dict(job.result for job in download_jobs)
+            )
+        except Exception:
+            geofile.abort_layer_update(layer_name)
+            raise
+
+        return True
+
+    graph.add(f"{layer_name} (save)", _finalize, kind="save", depends_on=download_jobs)
+
+    return (True, None)
+
+
+def download_raster_file(
+    layer_name, id, feature_id, previous=None, previous_dir=None, optimize=False
+):
+    """Save a raster file of a layer being rebuilt. If the file didn't change on the
+    server (same ETag and size as in the manifest of the previous version), the
+    previous file is reused instead of being downloaded again.
+
+    Return a (feature id, entry of the manifest) tuple, or False in case of failure.
+    """
+    info = client.get_raster_file_info(id, feature_id)
+
+    unchanged = (
+        (previous is not None)
+        and (info is not None)
+        and (info["etag"] is not None)
+        and (info["etag"] == previous["etag"])
+        and (info["size"] == previous["size"])
     )
 
-    return (success, valid_variables)
+    if unchanged and geofile.link_raster_file(
+        layer_name, feature_id, safe_join(previous_dir, feature_id)
+    ):
+        current_app.logger.info(f"... raster file <{feature_id}> unchanged")
+        return (feature_id, previous)
+
+    # If only the previous file is missing, the new one must be identical to it
+    expected_sha256 = previous.get("sha256") if unchanged else None
+
+    storage_instance = storage.create_for_layer_type(path.RASTER)
+    os.makedirs(os.path.dirname(storage_instance.get_tmp_dir()), exist_ok=True)
+
+    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
+        filename = safe_join(tmp_dir, os.path.basename(feature_id))
+
+        current_app.logger.info(f"... download raster file <{feature_id}>")
+        entry = client.get_raster_file(
+            id,
+            feature_id,
+            filename,
+            expected_size=info["size"] if info is not None else None,
+            expected_sha256=expected_sha256,
+        )
+        if entry is None:
+            return False
+
+        if not geofile.move_raster_file(
+            layer_name, feature_id, filename, optimize=optimize
+        ):
+            return False
+
+    return (feature_id, entry)
+
+
+def save_raster_layer(layer_name, data, files):
+    """Save the geometries, mosaic, legend and manifest of a raster layer once its
+    files are downloaded, and publish it
+    """
+    current_app.logger.info(f"... save geometries of <{layer_name}>")
+    geofile.save_raster_geometries(layer_name, data)
+
+    current_app.logger.info(f"... build mosaic of <{layer_name}>")
+    if not geofile.save_raster_mosaic(layer_name):
+        current_app.logger.info("... failed to build the mosaic")
+
+    save_legends(layer_name)
+
+    geofile.save_layer_manifest(layer_name, {"files": files})
+
+    # Invalidate everything derived from the previous version of the layer
+    geofile.update_layer_version(layer_name)
+
+    geofile.publish_layer_update(layer_name)
+
+
+def process_vector_layer(
+    graph,
+    layer_name,
+    ignore_intersecting=False,
+    target_area=None,
+    pretty_print=False,
+    force=False,
+):
+    """Download the features of a vector layer and save them, page by page. Unless
+    forced, nothing is downloaded if the summary of the features in the database
+    (number, latest date and checksum) didn't change since the last time.
+
+    A slot of the host of the datasets server is only held until all the features
+    are downloaded, not while the layer files are built.
+    """
+    current_app.logger.info(f"Download and save geojson <{layer_name}>...")
+
+    time_started = time.time()
+
+    storage_instance = storage.create(layer_name)
+
+    with graph.host_slot(client.DATASETS_SERVER_URL):
+        summary = client.get_layer_summary(
+            layer_name, ignore_intersecting=ignore_intersecting, target_area=target_area
+        )
+
+    manifest = storage_instance.get_manifest(layer_name)
+    if (
+        not (force)
+        and (summary is not None)
+        and (manifest is not None)
+        and (manifest["summary"] == summary)
+    ):
+        current_app.logger.info(f"... <{layer_name}> unchanged")
+        return (
+            True,
+            file_cache.get_json(storage_instance.get_variables_file(layer_name)),
+        )
+
+    features = _iter_in_host_slot(
+        graph,
+        client.DATASETS_SERVER_URL,
+        client.iter_geojson_features(
+            layer_name,
+            ignore_intersecting=ignore_intersecting,
+            target_area=target_area,
+            pretty_print=pretty_print,
+            workers=client.GEOJSON_WORKERS,
+        ),
+    )
+
+    try:
+        first_feature = next(features, None)
+        if first_feature is None:
+            current_app.logger.info("... no feature found in the geojson")
+            return (False, None)
+
+        geofile.begin_layer_update(layer_name)
+
+        valid_variables = geofile.save_vector_features(
+            layer_name, itertools.chain([first_feature], features)
+        )
+    except Exception as e:
+        current_app.logger.error(f"... failed to retrieve the geojson: {repr(e)}")
+        geofile.abort_layer_update(layer_name)
+        return (False, None)
+    finally:
+        # Release the slot of the host if the iteration was stopped
+        features.close()
+
+    try:
+        save_legends(layer_name, variables=valid_variables)
+
+        geofile.save_layer_manifest(layer_name, {"summary": summary})
+
+        # Invalidate everything derived from the previous version of the layer
+        geofile.update_layer_version(layer_name)
+    except Exception:
+        geofile.abort_layer_update(layer_name)
+        raise
+
+    geofile.publish_layer_update(layer_name)
+
+    current_app.logger.info(f"... done in {int(time.time() - time_started)} seconds.")
+
+    return (True, valid_variables)
+
+
+def _iter_in_host_slot(graph, url, iterable):
+    """Iterate over the items of an iterable fetching them from a server, holding a
+    slot of its host until the last item is fetched (or the iteration is stopped)
+    """
+    with graph.host_slot(url):
+        yield from iterable
+
+
+def save_legends(layer_name, variables=None):
+    """Retrieve the legends of a layer (one for each of its variables for vector
+    layers) and compute the statistics of its values (for raster layers), and save
+    them beside the data of the layer, so the rendering never has to query the
+    database. A default legend is used when the layer has none.
+    """
+    type = path.get_type(layer_name)
+
+    statistics = None
+    if type == path.RASTER:
+        current_app.logger.info("... compute statistics")
+        statistics = geofile.compute_raster_statistics(layer_name)
+
+    current_app.logger.info("... save legends")
+
+    (_, id, variable, time_period, _) = path.parse_unique_layer_name(layer_name)
+
+    legends = {}
+    for legend_variable in [variable] + (variables or []):
+        legend = client.get_legend(
+            path.make_unique_layer_name(
+                type, id, variable=legend_variable, time_period=time_period
+            )
+        )
+
+        if (legend is None) or (len(legend["symbology"]) == 0):
+            if statistics is not None:
+                legend = create_default_legend(
+                    type, min_value=statistics["min"], max_value=statistics["max"]
+                )
+            else:
+                legend = create_default_legend(type)
+
+        legends[legend_variable or ""] = legend
+
+    if not geofile.save_layer_legends(layer_name, legends, statistics=statistics):
+        current_app.logger.info("... failed to save the legends")
+        return False
+
+    return True
 
 
 def process_area(id):
     layer_name = path.make_unique_layer_name(path.AREA, id)
 
-    current_app.logger.info(f"Download area <{id}>...")
+    current_app.logger.info(f"Download and save area <{id}>...")
 
     time_started = time.time()
-    data = client.get_area(id)
-    if data is None:
-        return
 
-    time_fetched = time.time()
+    features = client.iter_area_features(id, workers=client.GEOJSON_WORKERS)
 
-    current_app.logger.info(
-        f"... fetch done in {int(time_fetched - time_started)} seconds"
-    )
+    try:
+        first_feature = next(features, None)
+        if first_feature is None:
+            current_app.logger.info("... no feature found")
+            return
 
-    geofile.save_vector_geojson(layer_name, data)
+        geofile.begin_layer_update(layer_name)
 
-    time_saved = time.time()
-    current_app.logger.info(
-        f"... save done in {int(time_saved - time_fetched)} seconds."
-    )
+        geofile.save_vector_features(
+            layer_name, itertools.chain([first_feature], features)
+        )
+    except Exception as e:
+        current_app.logger.error(f"... failed to retrieve the area: {repr(e)}")
+        geofile.abort_layer_update(layer_name)
+        return
+
+    try:
+        geofile.update_layer_version(layer_name)
+    except Exception:
+        geofile.abort_layer_update(layer_name)
+        raise
+
+    geofile.publish_layer_update(layer_name)
+
+    current_app.logger.info(f"... done in {int(time.time() - time_started)} seconds.")
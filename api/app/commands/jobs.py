@@ -0,0 +1,249 @@
+"""Graph of jobs run by the cache builder on a pool of threads.
+
+Each job is run once the jobs it depends on are done. A job can add new jobs to the
+graph while it runs (for instance a layer adding the downloads of its raster files):
+those become its children, and the job is only considered done once all of them are,
+so the jobs depending on it wait for the whole subtree.
+
+The failure of a job (returning False or None, or raising an exception) is recorded,
+but it doesn't prevent the other jobs from running, including the ones depending on
+it: they are expected to check the results they need.
+
+The jobs only accessing a remote server are tagged with its host, and at most
+max_per_host jobs of a given host are run at the same time, whatever the number of
+workers. The jobs also doing some processing instead hold a slot of the host only
+while they access it (see JobGraph.host_slot()), so the processing doesn't prevent
+other jobs from using the server.
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from flask import current_app
+
+
+class Job(object):
+    def __init__(self, name, kind, function, host, parent):
+        self.name = name
+        self.kind = kind
+        self.function = function
+        self.host = host
+        self.parent = parent
+
+        self.nb_dependencies = 0
+        self.dependents = []
+        self.nb_children = 0
+
+        self.finished = False
+        self.done = False
+        self.success = None
+        self.result = None
+        self.duration = 0.0
+
+
+class JobGraph(object):
+    def __init__(self, workers=1, max_per_host=4):
+        self.workers = max(workers, 1)
+        self.max_per_host = max(max_per_host, 1)
+
+        self.jobs = []
+        self.failures = []
+
+        self._ready = deque()
+        self._running_per_host = {}
+        self._lock = threading.Lock()
+        self._host_released = threading.Condition(self._lock)
+        self._local = threading.local()
+
+    def add(self, name, function, kind="job", depends_on=(), url=None):
+        """Add a job to the graph, and return it. The function is called without
+        argument (in an application context), and its return value is available as
+        the result of the job.
+
+        If a URL is given, the job counts against the concurrency limit of its host.
+        """
+        parent = getattr(self._local, "job", None)
+
+        job = Job(name, kind, function, get_host(url), parent)
+
+        with self._lock:
+            self.jobs.append(job)
+
+            if parent is not None:
+                parent.nb_children += 1
+
+            for dependency in depends_on:
+                if not dependency.done:
+                    dependency.dependents.append(job)
+                    job.nb_dependencies += 1
+
+            if job.nb_dependencies == 0:
+                self._ready.append(job)
+
+        return job
+
+    def run(self, report_interval=10):
+        """Run all the jobs of the graph (including the ones added while running),
+        logging the progress regularly
+        """
+        app = current_app._get_current_object()
+
+        time_started = time.time()
+        time_reported = time_started
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            running = {}
+
+            while True:
+                with self._lock:
+                    for job in self._pop_runnable_jobs(self.workers - len(running)):
+                        running[executor.submit(self._run_job, app, job)] = job
+
+                if len(running) == 0:
+                    break
+
+                completed, _ = wait(
+                    running.keys(), timeout=1, return_when=FIRST_COMPLETED
+                )
+
+                with self._lock:
+                    for future in completed:
+                        job = running.pop(future)
+
+                        if job.host is not None:
+                            self._release_host(job.host)
+
+                        job.finished = True
+                        if not job.success:
+                            self.failures.append(job)
+
+                        if job.nb_children == 0:
+                            self._complete(job)
+
+                if time.time() - time_reported >= report_interval:
+                    time_reported = time.time()
+                    self._report_progress()
+
+        return len(self.failures) == 0
+
+    @contextmanager
+    def host_slot(self, url):
+        """Context manager waiting until the host of the URL is used by less than
+        max_per_host jobs, and using it until exited. Must not be used by a job
+        tagged with the same host.
+        """
+        host = get_host(url)
+        if host is None:
+            yield
+            return
+
+        with self._host_released:
+            while self._running_per_host.get(host, 0) >= self.max_per_host:
+                self._host_released.wait()
+
+            self._running_per_host[host] = self._running_per_host.get(host, 0) + 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._release_host(host)
+
+    def get_summary(self):
+        """Return the number of jobs, failures and cumulated duration of each kind of
+        jobs, as a {kind: (number, failures, duration)} dictionary
+        """
+        summary = {}
+        for job in self.jobs:
+            (nb_jobs, nb_failures, duration) = summary.get(job.kind, (0, 0, 0.0))
+            summary[job.kind] = (
+                nb_jobs + 1,
+                nb_failures + (0 if job.success else 1),
+                duration + job.duration,
+            )
+
+        return summary
+
+    def _pop_runnable_jobs(self, count):
+        """Return up to count ready jobs whose host isn't already used by as many jobs
+        as allowed. Must be called with the lock held.
+        """
+        jobs = []
+        skipped = deque()
+
+        while (len(jobs) < count) and (len(self._ready) > 0):
+            job = self._ready.popleft()
+
+            if job.host is not None:
+                nb_running = self._running_per_host.get(job.host, 0)
+                if nb_running >= self.max_per_host:
+                    skipped.append(job)
+                    continue
+
+                self._running_per_host[job.host] = nb_running + 1
+
+            jobs.append(job)
+
+        # Keep the order of the jobs waiting for their host
+        self._ready.extendleft(reversed(skipped))
+
+        return jobs
+
+    def _release_host(self, host):
+        """Must be called with the lock held"""
+        self._running_per_host[host] -= 1
+        self._host_released.notify_all()
+
+    def _run_job(self, app, job):
+        with app.app_context():
+            self._local.job = job
+            time_started = time.time()
+
+            try:
+                job.result = job.function()
+                job.success = (job.result is not None) and (job.result is not False)
+            except Exception as e:
+                current_app.logger.error(f"Job <{job.name}> failed: {repr(e)}")
+                job.success = False
+            finally:
+                job.duration = time.time() - time_started
+                self._local.job = None
+
+    def _complete(self, job):
+        """Mark a job as done, and release the jobs waiting for it. Must be called
+        with the lock held.
+        """
+        job.done = True
+
+        for dependent in job.dependents:
+            dependent.nb_dependencies -= 1
+            if dependent.nb_dependencies == 0:
+                self._ready.append(dependent)
+
+        parent = job.parent
+        if parent is not None:
+            parent.nb_children -= 1
+            if parent.finished and (parent.nb_children == 0):
+                self._complete(parent)
+
+    def _report_progress(self):
+        with self._lock:
+            nb_done = len([x for x in self.jobs if x.done])
+            nb_jobs = len(self.jobs)
+            nb_failures = len(self.failures)
+
+        current_app.logger.info(
+            f"... {nb_done}/{nb_jobs} jobs done ({nb_failures} failed)"
+        )
+
+
+def get_host(url):
+    """Return the host of a URL, or None if there is none"""
+    if not url:
+        return None
+
+    host = urlparse(url).netloc
+    return host if len(host) > 0 else None
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from app.commands.jobs import JobGraph, get_host
+from app.common.test import BaseApiTest
+
+
+class JobGraphTest(BaseApiTest):
+    def testDependencies(self):
+        order = []
+
+        with self.flask_app.app_context():
+            graph = JobGraph(workers=4)
+
+            job1 = graph.add("job1", lambda: order.append(1) or True)
+            job2 = graph.add("job2", lambda: order.append(2) or True, depends_on=[job1])
+            graph.add("job3", lambda: order.append(3) or True, depends_on=[job1, job2])
+
+            self.assertTrue(graph.run())
+
+        self.assertEqual(order, [1, 2, 3])
+
+    def testChildren(self):
+        order = []
+
+        with self.flask_app.app_context():
+            graph = JobGraph(workers=4)
+
+            def _child():
+                time.sleep(0.1)
+                order.append("child")
+                return True
+
+            def _parent():
+                graph.add("child1", _child)
+                graph.add("child2", _child)
+                order.append("parent")
+                return True
+
+            parent = graph.add("parent", _parent)
+            graph.add("next", lambda: order.append("next") or True, depends_on=[parent])
+
+            self.assertTrue(graph.run())
+
+        self.assertEqual(order, ["parent", "child", "child", "next"])
+
+    def testFailuresAreIsolated(self):
+        done = []
+
+        with self.flask_app.app_context():
+            graph = JobGraph(workers=2)
+
+            def _raise():
+                raise Exception("failure")
+
+            job1 = graph.add("job1", _raise, kind="layer")
+            graph.add("job2", lambda: False, kind="layer")
+            graph.add("job3", lambda: done.append(3) or True, kind="layer")
+            graph.add("job4", lambda: done.append(4) or True, depends_on=[job1])
+
+            self.assertFalse(graph.run())
+
+        self.assertEqual(sorted(done), [3, 4])
+        self.assertEqual(sorted([x.name for x in graph.failures]), ["job1", "job2"])
+
+        summary = graph.get_summary()
+        self.assertEqual(summary["layer"][:2], (3, 2))
+        self.assertEqual(summary["job"][:2], (1, 0))
+
+    def testMaxPerHost(self):
+        lock = threading.Lock()
+        running = {"current": 0, "max": 0}
+
+        def _download():
+            with lock:
+                running["current"] += 1
+                running["max"] = max(running["max"], running["current"])
+
+            time.sleep(0.05)
+
+            with lock:
+                running["current"] -= 1
+
+            return True
+
+        with self.flask_app.app_context():
+            graph = JobGraph(workers=8, max_per_host=2)
+
+            for i in range(8):
+                graph.add(f"download{i}", _download, url="http://rasters:8000/1/")
+
+            # Not limited by the other host
+            graph.add("other", lambda: True, url="http://postgrest:3000/")
+
+            self.assertTrue(graph.run())
+
+        self.assertEqual(running["max"], 2)
+
+    def testHostSlot(self):
+        lock = threading.Lock()
+        running = {"current": 0, "max": 0}
+
+        def _download():
+            with lock:
+                running["current"] += 1
+                running["max"] = max(running["max"], running["current"])
+
+            time.sleep(0.05)
+
+            with lock:
+                running["current"] -= 1
+
+            return True
+
+        with self.flask_app.app_context():
+            graph = JobGraph(workers=8, max_per_host=2)
+
+            def _process():
+                with graph.host_slot("http://postgrest:3000/rpc/enermaps_get_rasters"):
+                    _download()
+
+                # Not limited once the slot is released
+                time.sleep(0.05)
+                return True
+
+            for i in range(4):
+                graph.add(f"layer{i}", _process)
+
+            # The jobs tagged with the host share the same slots
+            for i in range(4):
+                graph.add(f"dataset{i}", _download, url="http://postgrest:3000/")
+
+            self.assertTrue(graph.run())
+
+        self.assertEqual(running["max"], 2)
+        self.assertEqual(graph._running_per_host["postgrest:3000"], 0)
+
+    def testHost(self):
+        self.assertEqual(get_host("http://rasters:8000/1/FID.tif"), "rasters:8000")
+        self.assertTrue(get_host("") is None)
+        self.assertTrue(get_host(None) is None)
+        self.assertTrue(get_host("rpc/enermaps_get_rasters") is None)
@@ -1,25 +1,91 @@
 #!/usr/bin/python
+import hashlib
+import itertools
 import json
 import logging
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from functools import lru_cache
 
 import requests
 from flask import current_app
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from app.common import datasets, path
+from app.common import datasets, metadata_cache, path
 from app.models import storage
 
 DATASETS_SERVER_URL = os.environ.get("DATASETS_SERVER_URL", "")
 DATASETS_SERVER_API_KEY = os.environ.get("DATASETS_SERVER_API_KEY", "")
 RASTER_SERVER_URL = os.environ.get("RASTER_SERVER_URL", "")
 
+# Number of connections kept alive per server
+POOL_SIZE = 10
 
-def get_ttl_hash(seconds=10):
-    """Return the same value within `seconds` time period"""
-    return round(time.time() / seconds)
+# Number of pages of features downloaded concurrently by iter_geojson_features()
+GEOJSON_WORKERS = int(os.environ.get("GEOJSON_WORKERS", 4))
+
+# Number of retries of the requests failing because of a connection error or a
+# temporary failure of the server
+MAX_RETRIES = 3
+
+# Size of the chunks written to disk while downloading a raster file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of times an interrupted download of a raster file is resumed
+MAX_DOWNLOAD_RESUMES = 5
+
+stats = {
+    "requests": 0,
+    "errors": 0,
+    "latency": 0.0,
+    "max_latency": 0.0,
+}
+
+# The requests are sent by several threads at once (see app.commands.jobs)
+_stats_lock = threading.Lock()
+
+_session = None
+_session_pid = None
+
+
+def get_session():
+    """Return the HTTP session of the current process, keeping the connections to
+    the servers alive between the requests
+    """
+    global _session, _session_pid
+
+    # Connections can't be shared with the parent process
+    if (_session is None) or (_session_pid != os.getpid()):
+        retry = Retry(
+            total=MAX_RETRIES, backoff_factor=0.2, status_forcelist=(502, 503, 504)
+        )
+        adapter = HTTPAdapter(
+            pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+        )
+
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+
+    return _session
+
+
+def get_stats():
+    """Return the counters of the requests sent by the current process"""
+    with _stats_lock:
+        result = dict(stats)
+
+    if result["requests"] > 0:
+        result["mean_latency"] = result["latency"] / result["requests"]
+    else:
+        result["mean_latency"] = None
+
+    return result
 
 
 def get_dataset_list(disable_filtering=False, pretty_print=False):
@@ -27,14 +93,7 @@ def get_dataset_list(disable_filtering=False, pretty_print=False):
     url = DATASETS_SERVER_URL + "dataset_list"
 
     try:
-        with requests.get(url) as resp:
-            if pretty_print:
-                _pretty_print_request(resp)
-
-            if resp.status_code != 200:
-                resp.raise_for_status()
-
-            datasets = resp.json()
+        datasets = _get_json(url, cache_key="dataset_list", pretty_print=pretty_print)
 
         # If necessary: filter out datasets that don't exist in the cache
         if not (disable_filtering) and current_app.config["FILTER_DATASETS"]:
@@ -57,14 +116,13 @@ def get_parameters(dataset_id, pretty_print=False):
     headers = {"Authorization": "Bearer {}".format(DATASETS_SERVER_API_KEY)}
 
     try:
-        with requests.get(url, headers=headers, params=params) as resp:
-            if pretty_print:
-                _pretty_print_request(resp)
-
-            if resp.status_code != 200:
-                resp.raise_for_status()
-
-            parameters = resp.json()
+        parameters = _get_json(
+            url,
+            cache_key=f"parameters:{dataset_id}",
+            pretty_print=pretty_print,
+            headers=headers,
+            params=params,
+        )
 
         return datasets.convert(parameters)
 
@@ -118,15 +176,60 @@ def get_geojson(
     return _get_geojson(parameters, pretty_print, row_limit=row_limit)
 
 
-def get_raster_file(dataset_id, feature_id):
+def iter_geojson_features(
+    layer_name,
+    ignore_intersecting=False,
+    target_area=None,
+    pretty_print=False,
+    row_limit=1000,
+    workers=1,
+):
+    """
+    Fetch the features of a geojson dataset layer from the enermaps server, and
+    yield them one by one (in order) as soon as their page is downloaded.
+
+    Up to `workers` pages are downloaded concurrently, and only those pages are kept
+    in memory. An exception is raised if a page can't be retrieved.
+    """
+    parameters = _parameters_from_layer_name(
+        layer_name, ignore_intersecting=ignore_intersecting, target_area=target_area
+    )
+
+    for data in _iter_geojson_pages(
+        parameters,
+        pretty_print=pretty_print,
+        row_limit=row_limit,
+        workers=workers,
+        keyset=True,
+    ):
+        yield from data["features"]
+
+
+def get_raster_file(
+    dataset_id, feature_id, filename, expected_size=None, expected_sha256=None
+):
+    """Download a raster file of a dataset into filename. The file is written by
+    chunks, so it is never held in memory whatever its size, and an interrupted
+    download is resumed from where it stopped (up to MAX_DOWNLOAD_RESUMES times).
+
+    The size of the file is checked against the one announced by the server (and
+    the expected one, if given), and its SHA-256 against the expected one, if given.
+
+    Return the ETag, size and SHA-256 of the file as a dictionary, or None in case
+    of failure (the content of filename is then undefined).
+    """
     url = f"{RASTER_SERVER_URL}{dataset_id}/{feature_id}"
 
     try:
-        with requests.get(url, stream=True) as resp:
-            if resp.status_code != 200:
-                resp.raise_for_status()
+        with open(filename, "wb") as f:
+            info = _download(url, f, expected_size=expected_size)
 
-            return resp.content
+        if (expected_sha256 is not None) and (info["sha256"] != expected_sha256):
+            raise ValueError(
+                f"SHA-256 mismatch (expected {expected_sha256}, got {info['sha256']})"
+            )
+
+        return info
     except Exception as ex:
         logging.error(
             f"Failed to retrieve the raster file <{feature_id}> of dataset"
@@ -136,13 +239,84 @@ def get_raster_file(dataset_id, feature_id):
     return None
 
 
-@lru_cache(maxsize=10)
-def get_legend(layer_name, pretty_print=False, ttl_hash=None):
+def get_raster_file_info(dataset_id, feature_id):
+    """Return the ETag and size of a raster file on the server, as a dictionary
+    (their values being None if the server doesn't send them), or None in case of
+    failure
     """
-    Fetch a geojson dataset layer from the enermaps server with a given id.
+    url = f"{RASTER_SERVER_URL}{dataset_id}/{feature_id}"
+
+    try:
+        with _head(url, allow_redirects=True) as resp:
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            size = resp.headers.get("Content-Length")
+
+            return {
+                "etag": resp.headers.get("ETag"),
+                "size": int(size) if size is not None else None,
+            }
+    except Exception as ex:
+        logging.error(
+            f"Failed to retrieve the information about the raster file <{feature_id}>"
+            f" of dataset <{dataset_id}>: {repr(ex)}"
+        )
+
+    return None
+
+
+def get_vector_tile(layer_name, z, x, y, pretty_print=False):
     """
-    del ttl_hash
+    Fetch the Mapbox Vector Tile (z, x, y) of a vector or area layer from the enermaps
+    server. Return the content of the tile (empty if there is no feature in it), or
+    None in case of failure.
+    """
+    url = DATASETS_SERVER_URL + "rpc/enermaps_query_mvt"
+
+    headers = {
+        "Authorization": "Bearer {}".format(DATASETS_SERVER_API_KEY),
+        "Accept": "application/octet-stream",
+    }
+
+    try:
+        (type, id, _, _, _) = path.parse_unique_layer_name(layer_name)
+        if type == path.AREA:
+            parameters = _area_parameters(id)
+        else:
+            parameters = _parameters_from_layer_name(layer_name)
+
+        params = {
+            "parameters": json.dumps(parameters),
+            "z": z,
+            "x": x,
+            "y": y,
+        }
+
+        with _get(url, headers=headers, params=params) as resp:
+            if pretty_print:
+                _pretty_print_request(resp)
+
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            return resp.content
+
+    except Exception as ex:
+        logging.error(
+            f"Failed to retrieve the vector tile {z}/{x}/{y} of layer <{layer_name}>:"
+            f" {repr(ex)}"
+        )
+
+    return None
 
+
+def get_legend(layer_name, pretty_print=False):
+    """
+    Fetch the legend of a layer from the enermaps server. Only used when caching the
+    layer: the legends are then read from the legend files (see
+    geofile.save_layer_legends()).
+    """
     url = DATASETS_SERVER_URL + "rpc/enermaps_get_legend"
 
     parameters = _parameters_from_layer_name(layer_name, ignore_intersecting=True)
@@ -154,7 +328,7 @@ def get_legend(layer_name, pretty_print=False, ttl_hash=None):
             "parameters": json.dumps(parameters),
         }
 
-        with requests.get(url, headers=headers, params=params, timeout=10) as resp:
+        with _get(url, headers=headers, params=params, timeout=10) as resp:
             if pretty_print:
                 _pretty_print_request(resp)
 
@@ -175,13 +349,30 @@ def get_area(id, pretty_print=False):
     Fetch a geofile (geojson or raster) dataset layer from the enermaps server
     with a given Id.
     """
-    parameters = {
+    return _get_geojson(_area_parameters(id), pretty_print=pretty_print)
+
+
+def iter_area_features(id, pretty_print=False, row_limit=1000, workers=1):
+    """
+    Fetch the features of an area from the enermaps server, and yield them one by
+    one (see iter_geojson_features()).
+    """
+    for data in _iter_geojson_pages(
+        _area_parameters(id),
+        pretty_print=pretty_print,
+        row_limit=row_limit,
+        workers=workers,
+        keyset=True,
+    ):
+        yield from data["features"]
+
+
+def _area_parameters(id):
+    return {
         "data.ds_id": 0,
         "level": "{" + "{}".format(id) + "}",
     }
 
-    return _get_geojson(parameters, pretty_print=pretty_print)
-
 
 def get_rasters(
     layer_name, ignore_intersecting=False, target_area=None, pretty_print=False
@@ -203,7 +394,7 @@ def get_rasters(
             "parameters": json.dumps(parameters),
         }
 
-        with requests.get(url, headers=headers, params=params) as resp:
+        with _get(url, headers=headers, params=params) as resp:
             if pretty_print:
                 _pretty_print_request(resp)
 
@@ -219,48 +410,60 @@ def get_rasters(
     return data
 
 
-def _get_geojson(parameters, pretty_print=False, row_limit=1000):
-    """
-    Fetch a geofile (geojson or raster) dataset layer from the enermaps server
-    with a given Id.
+def get_layer_summary(
+    layer_name, ignore_intersecting=False, target_area=None, pretty_print=False
+):
+    """Return the number of features of a vector layer in the database, the latest
+    date of their values and a checksum of their content, used to know if the layer
+    was modified since it was cached. Return None in case of failure.
     """
-    url = DATASETS_SERVER_URL + "rpc/enermaps_query_geojson"
+    url = DATASETS_SERVER_URL + "rpc/enermaps_layer_summary"
 
     headers = {"Authorization": "Bearer {}".format(DATASETS_SERVER_API_KEY)}
 
-    row_offset = 0
-    all_data = None
-
     try:
-        while True:
-            params = {
-                "parameters": json.dumps(parameters),
-                "row_offset": row_offset,
-                "row_limit": row_limit,
-            }
+        parameters = _parameters_from_layer_name(
+            layer_name,
+            ignore_intersecting=ignore_intersecting,
+            target_area=target_area,
+        )
 
-            with requests.get(url, headers=headers, params=params) as resp:
-                if pretty_print:
-                    _pretty_print_request(resp)
+        params = {
+            "parameters": json.dumps(parameters),
+        }
 
-                if resp.status_code != 200:
-                    resp.raise_for_status()
+        with _get(url, headers=headers, params=params) as resp:
+            if pretty_print:
+                _pretty_print_request(resp)
+
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            return resp.json()
+    except Exception as ex:
+        logging.error(
+            f"Failed to retrieve the summary of layer <{layer_name}>: {repr(ex)}"
+        )
+
+    return None
 
-                data = resp.json()
 
-            if ("features" not in data) or (data["features"] is None):
-                return None
+def _get_geojson(parameters, pretty_print=False, row_limit=1000):
+    """
+    Fetch a geofile (geojson or raster) dataset layer from the enermaps server
+    with a given Id.
+    """
+    all_data = None
 
+    try:
+        for data in _iter_geojson_pages(
+            parameters, pretty_print=pretty_print, row_limit=row_limit
+        ):
             if all_data is not None:
                 all_data["features"].extend(data["features"])
             else:
                 all_data = data
 
-            if len(data["features"]) < row_limit:
-                break
-
-            row_offset += row_limit
-
     except Exception as ex:
         logging.error(f"Failed to retrieve the geojson: {repr(ex)}")
         return None
@@ -268,6 +471,275 @@ def _get_geojson(parameters, pretty_print=False, row_limit=1000):
     return all_data
 
 
+def _iter_geojson_pages(
+    parameters, pretty_print=False, row_limit=1000, workers=1, keyset=False
+):
+    """
+    Yield the successive pages of a geojson dataset layer, as returned by the
+    enermaps server. Up to `workers` pages are downloaded concurrently, but they are
+    yielded in order.
+
+    With `keyset`, the bounds of the pages are first retrieved from the server, and
+    each page is then requested from the last fid of the previous one, instead of
+    with an offset that the database has to skip (which is slow for the last pages
+    of a big layer). The pages are requested with an offset if the server doesn't
+    support it.
+
+    Nothing is yielded if the first page doesn't contain any feature.
+    """
+    headers = {"Authorization": "Bearer {}".format(DATASETS_SERVER_API_KEY)}
+
+    after_fids = None
+    if keyset:
+        after_fids = _get_page_bounds(parameters, pretty_print, row_limit)
+
+    if after_fids is not None:
+        url = DATASETS_SERVER_URL + "rpc/enermaps_query_geojson_keyset"
+
+        def _pages():
+            for after_fid in after_fids:
+                params = {
+                    "parameters": json.dumps(parameters),
+                    "row_limit": row_limit,
+                }
+
+                if after_fid is not None:
+                    params["after_fid"] = after_fid
+
+                yield params
+
+    else:
+        url = DATASETS_SERVER_URL + "rpc/enermaps_query_geojson"
+
+        def _pages():
+            for row_offset in itertools.count(0, row_limit):
+                yield {
+                    "parameters": json.dumps(parameters),
+                    "row_offset": row_offset,
+                    "row_limit": row_limit,
+                }
+
+    def _fetch(params):
+        with _get(url, headers=headers, params=params) as resp:
+            if pretty_print:
+                _pretty_print_request(resp)
+
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            return resp.json()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
+        pages = _pages()
+
+        try:
+            while True:
+                # Keep the window of pages being downloaded full
+                for params in itertools.islice(pages, max(1, workers) - len(pending)):
+                    pending.append(executor.submit(_fetch, params))
+
+                if len(pending) == 0:
+                    break
+
+                data = pending.popleft().result()
+
+                # The server returns no feature list once past the last row
+                if ("features" not in data) or (data["features"] is None):
+                    break
+
+                yield data
+
+                if len(data["features"]) < row_limit:
+                    break
+        finally:
+            # Don't download the pages past the end of the layer
+            for future in pending:
+                future.cancel()
+
+
+def _get_page_bounds(parameters, pretty_print=False, row_limit=1000):
+    """
+    Return the list of the "after_fid" parameters of the pages of features matching
+    the parameters (None for the first page), or None if the server failed to
+    compute them
+    """
+    url = DATASETS_SERVER_URL + "rpc/enermaps_count_features"
+
+    headers = {"Authorization": "Bearer {}".format(DATASETS_SERVER_API_KEY)}
+
+    params = {
+        "parameters": json.dumps(parameters),
+        "row_limit": row_limit,
+    }
+
+    try:
+        with _get(url, headers=headers, params=params) as resp:
+            if pretty_print:
+                _pretty_print_request(resp)
+
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            return resp.json()["after_fids"]
+
+    except Exception as ex:
+        logging.warning(f"Failed to count the features, using offsets: {repr(ex)}")
+        return None
+
+
+def _get(url, **kwargs):
+    """Send a GET request through the session of the process, and record its
+    latency
+    """
+    return _request("GET", url, **kwargs)
+
+
+def _head(url, **kwargs):
+    """Send a HEAD request through the session of the process, and record its
+    latency
+    """
+    return _request("HEAD", url, **kwargs)
+
+
+def _request(method, url, **kwargs):
+    start = time.perf_counter()
+
+    try:
+        return get_session().request(method, url, **kwargs)
+    except Exception:
+        with _stats_lock:
+            stats["errors"] += 1
+        raise
+    finally:
+        latency = time.perf_counter() - start
+
+        with _stats_lock:
+            stats["requests"] += 1
+            stats["latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+
+
+def _download(url, f, expected_size=None):
+    """Write the content of a URL into a file object, resuming the download with a
+    Range request when the connection is lost. Return the ETag, size and SHA-256 of
+    the content.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    total_size = expected_size
+    etag = None
+    nb_resumes = 0
+
+    while True:
+        # The offsets of the Range requests are the ones of the file itself
+        headers = {"Accept-Encoding": "identity"}
+        if size > 0:
+            headers["Range"] = f"bytes={size}-"
+            if etag is not None:
+                # Send the whole file again if it was modified in the meantime
+                headers["If-Range"] = etag
+
+        try:
+            with _get(url, stream=True, headers=headers) as resp:
+                if resp.status_code == 200:
+                    if size > 0:
+                        f.seek(0)
+                        f.truncate()
+                        sha256 = hashlib.sha256()
+                        size = 0
+
+                    length = resp.headers.get("Content-Length")
+                    if length is not None:
+                        length = int(length)
+                        if (total_size is not None) and (length != total_size):
+                            raise ValueError(
+                                f"Size mismatch (expected {total_size}, announced"
+                                f" {length})"
+                            )
+
+                        total_size = length
+                elif resp.status_code == 206:
+                    (start, total) = _parse_content_range(
+                        resp.headers.get("Content-Range")
+                    )
+                    if start != size:
+                        raise ValueError(f"Unexpected range start {start} ({size})")
+
+                    if total is not None:
+                        total_size = total
+                else:
+                    resp.raise_for_status()
+                    raise ValueError(f"Unexpected status code {resp.status_code}")
+
+                etag = resp.headers.get("ETag", etag)
+
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as ex:
+            nb_resumes += 1
+            if nb_resumes > MAX_DOWNLOAD_RESUMES:
+                raise
+
+            logging.warning(
+                f"Download of <{url}> interrupted after {size} bytes, resuming:"
+                f" {repr(ex)}"
+            )
+            time.sleep(0.2 * nb_resumes)
+
+    if (total_size is not None) and (size != total_size):
+        raise ValueError(f"Size mismatch (expected {total_size}, got {size})")
+
+    return {"etag": etag, "size": size, "sha256": sha256.hexdigest()}
+
+
+def _parse_content_range(content_range):
+    """Return the start and total size (None if unknown) of a 'bytes start-end/total'
+    Content-Range header
+    """
+    (unit, _, value) = (content_range or "").partition(" ")
+    if unit != "bytes":
+        raise ValueError(f"Invalid Content-Range header: {content_range}")
+
+    (interval, _, total) = value.partition("/")
+    start = int(interval.split("-")[0])
+
+    return (start, int(total) if total not in ("", "*") else None)
+
+
+def _get_json(url, cache_key=None, pretty_print=False, **kwargs):
+    """Send a GET request and return its decoded JSON response. If a cache key is
+    given, the response is shared with the other requests using the same key during
+    a few seconds (see metadata_cache.py).
+    """
+    content = None
+    if (cache_key is not None) and not (pretty_print):
+        content = metadata_cache.get(cache_key)
+
+    if content is None:
+        with _get(url, **kwargs) as resp:
+            if pretty_print:
+                _pretty_print_request(resp)
+
+            if resp.status_code != 200:
+                resp.raise_for_status()
+
+            content = resp.content
+
+        if cache_key is not None:
+            metadata_cache.put(cache_key, content)
+
+    return json.loads(content)
+
+
 def _parameters_from_layer_name(
     layer_name, ignore_intersecting=False, target_area=None
 ):
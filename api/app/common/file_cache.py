@@ -0,0 +1,121 @@
+"""Per-process cache of the content of the small files of the layers (geometries,
+bounding box, projection, legend, spatial index, ...).
+
+The content of a file is only parsed the first time it is needed, and kept in memory
+along with the modification time, size and inode of the file: as soon as the cache
+builder rewrites it, the new version is loaded at the next access. The memory used is
+bounded by the total size of the cached files, the least recently used ones being
+evicted first.
+
+The values returned are shared by all the callers, and must not be modified.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Maximal total size of the files whose content is kept in memory
+MAX_SIZE = 64 * 1024 * 1024
+
+_entries = OrderedDict()
+_size = 0
+_lock = threading.Lock()
+
+stats = {
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def get(filename, loader, tag=None):
+    """Return the value produced by calling loader(filename), or None if the file
+    doesn't exist. The loader is only called again if the file was modified.
+
+    The tag allows to keep several values derived from the same file (for instance
+    its parsed content and an index built from it).
+    """
+    global _size
+
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    key = (filename, tag)
+    signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    with _lock:
+        entry = _entries.get(key)
+        if (entry is not None) and (entry[0] == signature):
+            _entries.move_to_end(key)
+            stats["hits"] += 1
+            return entry[1]
+
+        stats["misses"] += 1
+
+    value = loader(filename)
+
+    weight = max(st.st_size, 1)
+    if weight > MAX_SIZE:
+        return value
+
+    with _lock:
+        previous = _entries.pop(key, None)
+        if previous is not None:
+            _size -= previous[2]
+
+        _entries[key] = (signature, value, weight)
+        _size += weight
+
+        while _size > MAX_SIZE:
+            (_, evicted) = _entries.popitem(last=False)
+            _size -= evicted[2]
+
+    return value
+
+
+def get_json(filename):
+    """Return the parsed content of a JSON file, or None if it doesn't exist or is
+    invalid
+    """
+    return get(filename, _load_json, tag="json")
+
+
+def get_text(filename):
+    """Return the content of a text file, or None if it doesn't exist"""
+    return get(filename, _load_text, tag="text")
+
+
+def clear():
+    """Remove all the entries of the cache"""
+    global _size
+
+    with _lock:
+        _entries.clear()
+        _size = 0
+
+
+def get_stats():
+    """Return the counters of the cache of the current process"""
+    with _lock:
+        result = dict(stats)
+        result["entries"] = len(_entries)
+        result["size"] = _size
+
+    return result
+
+
+def _load_json(filename):
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_text(filename):
+    try:
+        with open(filename, "r") as f:
+            return f.read()
+    except OSError:
+        return None
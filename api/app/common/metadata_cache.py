@@ -0,0 +1,154 @@
+"""Cache of the metadata (list of datasets, parameters of the datasets) retrieved
+from the datasets server.
+
+The responses of the server are kept during a few seconds (DATASETS_METADATA_TTL) at
+two levels:
+* in the memory of the process, in a small LRU cache
+* in redis (if DATASETS_METADATA_REDIS_URL is set), to share them between the
+  worker processes
+
+The values are the JSON texts returned by the server, so that each caller decodes
+its own copy of the data, and can modify it.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+TTL = int(os.environ.get("DATASETS_METADATA_TTL", 60))
+REDIS_URL = os.environ.get("DATASETS_METADATA_REDIS_URL", "")
+
+MAX_ENTRIES = 256
+
+KEY_PREFIX = "enermaps:api:metadata:"
+
+# Delay (in seconds) before trying to use redis again after a failure
+REDIS_RETRY_DELAY = 30
+
+stats = {
+    "hits": 0,
+    "shared_hits": 0,
+    "misses": 0,
+}
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+
+_redis = None
+_redis_pid = None
+_redis_retry_at = 0
+
+
+def get(key):
+    """Return the cached content associated to the key, or None"""
+    now = time.monotonic()
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                _entries.move_to_end(key)
+                stats["hits"] += 1
+                return entry[1]
+
+            del _entries[key]
+
+    content = _redis_get(key)
+    if content is not None:
+        _remember(key, content, now)
+        stats["shared_hits"] += 1
+        return content
+
+    stats["misses"] += 1
+    return None
+
+
+def put(key, content):
+    """Associate a content to the key, during TTL seconds"""
+    if TTL <= 0:
+        return
+
+    _remember(key, content, time.monotonic())
+    _redis_set(key, content)
+
+
+def clear():
+    """Forget all the entries cached in the memory of the current process"""
+    with _lock:
+        _entries.clear()
+
+
+def get_stats():
+    """Return the counters of the cache of the current process"""
+    with _lock:
+        result = dict(stats)
+        result["entries"] = len(_entries)
+
+    lookups = result["hits"] + result["shared_hits"] + result["misses"]
+    if lookups > 0:
+        result["hit_rate"] = (result["hits"] + result["shared_hits"]) / lookups
+    else:
+        result["hit_rate"] = None
+
+    return result
+
+
+def _remember(key, content, now):
+    with _lock:
+        _entries[key] = (now + TTL, content)
+        _entries.move_to_end(key)
+
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+
+
+def _get_redis():
+    """Return the redis client of the current process, or None if redis isn't
+    configured or failed recently
+    """
+    global _redis, _redis_pid
+
+    if (REDIS_URL == "") or (time.monotonic() < _redis_retry_at):
+        return None
+
+    # Connections can't be shared with the parent process
+    if (_redis is None) or (_redis_pid != os.getpid()):
+        _redis = redis.Redis.from_url(
+            REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+        _redis_pid = os.getpid()
+
+    return _redis
+
+
+def _redis_get(key):
+    client = _get_redis()
+    if client is None:
+        return None
+
+    try:
+        return client.get(KEY_PREFIX + key)
+    except redis.exceptions.RedisError as e:
+        _redis_failed(e)
+        return None
+
+
+def _redis_set(key, content):
+    client = _get_redis()
+    if client is None:
+        return
+
+    try:
+        client.setex(KEY_PREFIX + key, TTL, content)
+    except redis.exceptions.RedisError as e:
+        _redis_failed(e)
+
+
+def _redis_failed(error):
+    global _redis_retry_at
+
+    logging.warning(f"Failed to access the shared metadata cache: {repr(error)}")
+    _redis_retry_at = time.monotonic() + REDIS_RETRY_DELAY
@@ -0,0 +1,199 @@
+"""Static spatial index of bounding boxes.
+
+The index is an R-tree packed with the Sort-Tile-Recursive (STR) algorithm: the
+bounding boxes are sorted and grouped in nodes of at most `node_capacity` entries,
+level after level, until a single root node remains. Finding the entries intersecting
+a given bounding box only visits the nodes intersecting it, so the cost of a query is
+logarithmic in the number of entries (plus the number of results).
+
+The index can't be modified once built, which matches the way we use it: the index of
+a layer is built (and saved next to its files) each time the layer is written, and
+loaded once by each worker process.
+
+All bounding boxes are tuples of the form (min_x, min_y, max_x, max_y).
+"""
+import json
+import math
+
+from . import file_cache
+
+DEFAULT_NODE_CAPACITY = 16
+
+
+def intersects(a, b):
+    """Return True if the two bounding boxes intersect"""
+    return (a[0] <= b[2]) and (b[0] <= a[2]) and (a[1] <= b[3]) and (b[1] <= a[3])
+
+
+def bounds_of_coordinates(coordinates):
+    """Return the bounding box of a list of (x, y) points"""
+    xs = [p[0] for p in coordinates]
+    ys = [p[1] for p in coordinates]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def index_rings(rings):
+    """Build the index of a dict of {id: list of (x, y) points}. The value of each
+    entry is a [position of the ring in the dict, id] list, so that the results of a
+    query can be sorted in the order of the dict. Return None if a ring is missing.
+    """
+    entries = []
+
+    for position, (id, coordinates) in enumerate(rings.items()):
+        if not coordinates:
+            return None
+
+        entries.append((bounds_of_coordinates(coordinates), [position, id]))
+
+    return STRTree(entries)
+
+
+def _union(boxes):
+    return (
+        min(b[0] for b in boxes),
+        min(b[1] for b in boxes),
+        max(b[2] for b in boxes),
+        max(b[3] for b in boxes),
+    )
+
+
+def _str_order(boxes, node_capacity):
+    """Return the indices of the boxes, ordered so that consecutive groups of
+    `node_capacity` boxes are spatially close (Sort-Tile-Recursive)
+    """
+    nb_nodes = math.ceil(len(boxes) / node_capacity)
+    nb_slices = max(1, math.ceil(math.sqrt(nb_nodes)))
+    slice_size = nb_slices * node_capacity
+
+    def _center_x(i):
+        return boxes[i][0] + boxes[i][2]
+
+    def _center_y(i):
+        return boxes[i][1] + boxes[i][3]
+
+    ordered = sorted(range(len(boxes)), key=_center_x)
+
+    result = []
+    for start in range(0, len(ordered), slice_size):
+        result.extend(sorted(ordered[start : start + slice_size], key=_center_y))
+
+    return result
+
+
+class STRTree(object):
+    """R-tree packed with the Sort-Tile-Recursive algorithm.
+
+    The entries are (bounding box, value) tuples, the values must be serializable to
+    JSON for the index to be saved.
+    """
+
+    def __init__(self, entries, node_capacity=DEFAULT_NODE_CAPACITY):
+        self.node_capacity = node_capacity
+
+        order = _str_order([x[0] for x in entries], node_capacity)
+        self.entries = [(tuple(entries[i][0]), entries[i][1]) for i in order]
+
+        # Each level is a list of nodes, a node being a tuple (bounding box, start,
+        # end) referencing a range of nodes in the level below (or of entries for the
+        # first level). The last level only contains the root node.
+        self.levels = []
+
+        boxes = [x[0] for x in self.entries]
+        while len(boxes) > 0:
+            nodes = []
+            for start in range(0, len(boxes), node_capacity):
+                end = min(start + node_capacity, len(boxes))
+                nodes.append((_union(boxes[start:end]), start, end))
+
+            self.levels.append(nodes)
+
+            if len(nodes) == 1:
+                break
+
+            # Reorder the nodes of the new level so that they can be packed too
+            order = _str_order([x[0] for x in nodes], node_capacity)
+            if order != list(range(len(nodes))):
+                self.levels[-1] = [nodes[i] for i in order]
+
+            boxes = [x[0] for x in self.levels[-1]]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, bounds):
+        """Return the values of the entries whose bounding box intersects the given
+        one
+        """
+        if len(self.levels) == 0:
+            return []
+
+        result = []
+
+        level_index = len(self.levels) - 1
+        candidates = [
+            node for node in self.levels[level_index] if intersects(node[0], bounds)
+        ]
+
+        while level_index > 0:
+            level_index -= 1
+            children = self.levels[level_index]
+
+            candidates = [
+                child
+                for node in candidates
+                for child in children[node[1] : node[2]]
+                if intersects(child[0], bounds)
+            ]
+
+        for node in candidates:
+            for box, value in self.entries[node[1] : node[2]]:
+                if intersects(box, bounds):
+                    result.append(value)
+
+        return result
+
+    def to_dict(self):
+        return {
+            "node_capacity": self.node_capacity,
+            "entries": [[list(box), value] for box, value in self.entries],
+            "levels": [
+                [[list(box), start, end] for box, start, end in nodes]
+                for nodes in self.levels
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        tree = cls.__new__(cls)
+        tree.node_capacity = data["node_capacity"]
+        tree.entries = [(tuple(box), value) for box, value in data["entries"]]
+        tree.levels = [
+            [(tuple(box), start, end) for box, start, end in nodes]
+            for nodes in data["levels"]
+        ]
+        return tree
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f)
+
+
+def load(filename, factory=None):
+    """Return the index saved in a file, or None if the file doesn't exist. The index
+    is only read again from the disk if the file was modified.
+
+    If a factory is given, the index is built by calling it instead of being read
+    from the file (which is then only used to detect modifications).
+    """
+    if factory is not None:
+        return file_cache.get(filename, lambda _: factory(), tag="spatial_index")
+
+    return file_cache.get(filename, _load_tree, tag="spatial_index")
+
+
+def _load_tree(filename):
+    try:
+        with open(filename, "r") as f:
+            return STRTree.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
@@ -13,6 +13,7 @@ import requests
 import urllib3
 
 from app import create_app
+from app.common import metadata_cache
 
 
 class BaseTest(unittest.TestCase):
@@ -30,6 +31,7 @@ class BaseApiTest(BaseTest):
         * set the TESTING to true
         * set the upload directory to a temporary directory
         * ensure we don't run the test in debug
+        * forget the metadata of the datasets cached by the previous tests
         """
         self.flask_app = create_app(testing=True)
         self.wms_cache_dir = tempfile.mkdtemp()
@@ -40,6 +42,7 @@ class BaseApiTest(BaseTest):
         self.client = self.flask_app.test_client()
         self.client.follow_redirect = True
         self.assertEqual(self.flask_app.debug, False)
+        metadata_cache.clear()
 
     def tearDown(self):
         """After each test, cleanup the upload directory"""
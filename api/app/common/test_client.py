@@ -1,24 +1,38 @@
 import copy
+import hashlib
 import json
 import os
 from unittest.mock import Mock, patch
 
+import requests
+
 from app.common import client, datasets, path
 from app.common.test import BaseApiTest
 
 
 class Response(object):
-    def __init__(self, content, status_code=200):
+    def __init__(self, content, status_code=200, headers=None):
         self.content = content
         self.status_code = status_code
+        self.headers = headers if headers is not None else {}
 
     def json(self):
         return json.loads(self.content)
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
     def raise_for_status(self):
         raise Exception(self.status_code)
 
 
+class InterruptedResponse(Response):
+    def iter_content(self, chunk_size=1):
+        yield self.content
+        raise requests.exceptions.ChunkedEncodingError()
+
+
 def setupResponse(response):
     ctx_mgr = Mock()
     ctx_mgr.__enter__ = Mock(return_value=response)
@@ -33,32 +47,6 @@ def setupResponseWithSideEffect(responses):
     return ctx_mgr
 
 
-class TTLHashTest(BaseApiTest):
-    @patch(
-        "time.time",
-    )
-    def testSameHash(self, time_fct):
-        time_fct.return_value = 1000000
-        hash1 = client.get_ttl_hash()
-
-        time_fct.return_value = 1000005
-        hash2 = client.get_ttl_hash()
-
-        self.assertEqual(hash1, hash2)
-
-    @patch(
-        "time.time",
-    )
-    def testDifferentHashes(self, time_fct):
-        time_fct.return_value = 1000000
-        hash1 = client.get_ttl_hash()
-
-        time_fct.return_value = 1000015
-        hash2 = client.get_ttl_hash()
-
-        self.assertNotEqual(hash1, hash2)
-
-
 class DatasetListTest(BaseApiTest):
 
     DATASETS = [
@@ -76,7 +64,7 @@ class DatasetListTest(BaseApiTest):
         super().setUp()
         os.makedirs(os.path.join(self.wms_cache_dir, "rasters", "1"))
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testWithoutFiltering(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
@@ -92,7 +80,7 @@ class DatasetListTest(BaseApiTest):
 
             self.assertEqual(datasets, DatasetListTest.DATASETS)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testWithFiltering(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
@@ -109,7 +97,7 @@ class DatasetListTest(BaseApiTest):
             self.assertEqual(len(datasets), 1)
             self.assertEqual(datasets[0], DatasetListTest.DATASETS[0])
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testFailure(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(Response(None, 500))
@@ -117,7 +105,7 @@ class DatasetListTest(BaseApiTest):
             datasets = client.get_dataset_list()
             self.assertEqual(len(datasets), 0)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testException(self, get_mock):
         with self.flask_app.app_context():
             get_mock.side_effect = Exception()
@@ -146,7 +134,7 @@ class ParametersTest(BaseApiTest):
         "default_parameters": {},
     }
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testSuccess(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
@@ -167,7 +155,25 @@ class ParametersTest(BaseApiTest):
 
             self.assertEqual(parameters, datasets.convert(ParametersTest.PARAMETERS))
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
+    def testCached(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.return_value = setupResponse(
+                Response(json.dumps(ParametersTest.PARAMETERS))
+            )
+
+            parameters1 = client.get_parameters(1)
+            parameters1["variables"].append("var2")
+
+            parameters2 = client.get_parameters(1)
+
+            self.assertEqual(get_mock.call_count, 1)
+            self.assertEqual(parameters2, datasets.convert(ParametersTest.PARAMETERS))
+
+            client.get_parameters(2)
+            self.assertEqual(get_mock.call_count, 2)
+
+    @patch("app.common.client._get")
     def testFailure(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(Response(None, 500))
@@ -175,7 +181,7 @@ class ParametersTest(BaseApiTest):
             parameters = client.get_parameters(1)
             self.assertTrue(parameters is None)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testException(self, get_mock):
         with self.flask_app.app_context():
             get_mock.side_effect = Exception()
@@ -198,39 +204,171 @@ class AreasTest(BaseApiTest):
 class RasterFileTest(BaseApiTest):
 
     RASTER_CONTENT = b"this is a raster file"
+    RASTER_SHA256 = hashlib.sha256(RASTER_CONTENT).hexdigest()
+
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.wms_cache_dir, "FID.tif")
+
+    def getFileContent(self):
+        with open(self.filename, "rb") as f:
+            return f.read()
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testSuccess(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
-                Response(RasterFileTest.RASTER_CONTENT)
+                Response(
+                    RasterFileTest.RASTER_CONTENT,
+                    headers={
+                        "Content-Length": str(len(RasterFileTest.RASTER_CONTENT)),
+                        "ETag": '"1234"',
+                    },
+                )
             )
 
-            content = client.get_raster_file(1, "FID.tif")
+            info = client.get_raster_file(1, "FID.tif", self.filename)
 
             self.assertEqual(len(get_mock.call_args.args), 1)
             self.assertEqual(get_mock.call_args.args[0], "1/FID.tif")
 
-            self.assertEqual(len(get_mock.call_args.kwargs), 1)
-            self.assertTrue("stream" in get_mock.call_args.kwargs)
             self.assertTrue(get_mock.call_args.kwargs["stream"])
+            self.assertFalse("Range" in get_mock.call_args.kwargs["headers"])
+
+            self.assertEqual(
+                info,
+                {
+                    "etag": '"1234"',
+                    "size": len(RasterFileTest.RASTER_CONTENT),
+                    "sha256": RasterFileTest.RASTER_SHA256,
+                },
+            )
+            self.assertEqual(self.getFileContent(), RasterFileTest.RASTER_CONTENT)
+
+    @patch("app.common.client._get")
+    def testResume(self, get_mock):
+        with self.flask_app.app_context():
+            size = len(RasterFileTest.RASTER_CONTENT)
+
+            get_mock.side_effect = [
+                setupResponse(
+                    InterruptedResponse(
+                        RasterFileTest.RASTER_CONTENT[:5],
+                        headers={"Content-Length": str(size), "ETag": '"1234"'},
+                    )
+                ),
+                setupResponse(
+                    Response(
+                        RasterFileTest.RASTER_CONTENT[5:],
+                        206,
+                        headers={"Content-Range": f"bytes 5-{size - 1}/{size}"},
+                    )
+                ),
+            ]
+
+            info = client.get_raster_file(
+                1, "FID.tif", self.filename, expected_sha256=self.RASTER_SHA256
+            )
+
+            headers = get_mock.call_args.kwargs["headers"]
+            self.assertEqual(headers["Range"], "bytes=5-")
+            self.assertEqual(headers["If-Range"], '"1234"')
 
-            self.assertEqual(content, RasterFileTest.RASTER_CONTENT)
+            self.assertEqual(info["size"], size)
+            self.assertEqual(info["sha256"], RasterFileTest.RASTER_SHA256)
+            self.assertEqual(self.getFileContent(), RasterFileTest.RASTER_CONTENT)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
+    def testRestartIfModified(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.side_effect = [
+                setupResponse(InterruptedResponse(b"old content")),
+                setupResponse(Response(RasterFileTest.RASTER_CONTENT)),
+            ]
+
+            info = client.get_raster_file(1, "FID.tif", self.filename)
+
+            self.assertEqual(info["sha256"], RasterFileTest.RASTER_SHA256)
+            self.assertEqual(self.getFileContent(), RasterFileTest.RASTER_CONTENT)
+
+    @patch("app.common.client._get")
+    def testSizeMismatch(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.return_value = setupResponse(
+                Response(
+                    RasterFileTest.RASTER_CONTENT, headers={"Content-Length": "100"}
+                )
+            )
+
+            info = client.get_raster_file(1, "FID.tif", self.filename)
+            self.assertTrue(info is None)
+
+            get_mock.return_value = setupResponse(
+                Response(RasterFileTest.RASTER_CONTENT)
+            )
+
+            info = client.get_raster_file(1, "FID.tif", self.filename, expected_size=10)
+            self.assertTrue(info is None)
+
+    @patch("app.common.client._get")
+    def testSHA256Mismatch(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.return_value = setupResponse(
+                Response(RasterFileTest.RASTER_CONTENT)
+            )
+
+            info = client.get_raster_file(
+                1, "FID.tif", self.filename, expected_sha256="1234"
+            )
+            self.assertTrue(info is None)
+
+    @patch("app.common.client._get")
     def testFailure(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(Response(None, 500))
 
-            content = client.get_raster_file(1, "FID.tif")
-            self.assertTrue(content is None)
+            info = client.get_raster_file(1, "FID.tif", self.filename)
+            self.assertTrue(info is None)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testException(self, get_mock):
         with self.flask_app.app_context():
             get_mock.side_effect = Exception()
 
-            content = client.get_raster_file(1, "FID.tif")
+            info = client.get_raster_file(1, "FID.tif", self.filename)
+            self.assertTrue(info is None)
+
+
+class VectorTileTest(BaseApiTest):
+
+    TILE_CONTENT = b"this is a vector tile"
+
+    @patch("app.common.client._get")
+    def testAreaTile(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.return_value = setupResponse(Response(VectorTileTest.TILE_CONTENT))
+
+            layer_name = path.make_unique_layer_name(path.AREA, "NUTS2")
+            content = client.get_vector_tile(layer_name, 3, 4, 2)
+
+            self.assertEqual(get_mock.call_args.args[0], "rpc/enermaps_query_mvt")
+
+            params = get_mock.call_args.kwargs["params"]
+            self.assertEqual(
+                json.loads(params["parameters"]),
+                {"data.ds_id": 0, "level": "{NUTS2}"},
+            )
+            self.assertEqual((params["z"], params["x"], params["y"]), (3, 4, 2))
+
+            self.assertEqual(content, VectorTileTest.TILE_CONTENT)
+
+    @patch("app.common.client._get")
+    def testFailure(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.return_value = setupResponse(Response(None, 500))
+
+            layer_name = path.make_unique_layer_name(path.AREA, "NUTS2")
+            content = client.get_vector_tile(layer_name, 3, 4, 2)
             self.assertTrue(content is None)
 
 
@@ -518,7 +656,7 @@ class GeoJSONTest(BaseApiTest):
 
         return json.loads(get_mock.call_args.kwargs["params"]["parameters"])
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -545,7 +683,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_VARIABLE)),
@@ -574,7 +712,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_VARIABLE)),
@@ -603,7 +741,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_VARIABLE2)),
@@ -632,7 +770,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_TIME_PERIOD)),
@@ -661,7 +799,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_TIME_PERIOD_WITH_MONTH)),
@@ -692,7 +830,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_NONE_TIME_PERIOD)),
@@ -721,7 +859,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_MONTH_TIME_PERIOD)),
@@ -750,7 +888,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_TIME_PERIOD)),
@@ -779,7 +917,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_TIME_PERIOD2)),
@@ -808,7 +946,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_FIELDS)),
@@ -840,7 +978,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_EMPTY_FIELDS)),
@@ -867,7 +1005,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_LEVEL)),
@@ -896,7 +1034,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
@@ -930,7 +1068,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
@@ -957,7 +1095,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(geojson, GeoJSONTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1010,7 +1148,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertEqual(len(geojson["features"]), 1001)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1024,7 +1162,7 @@ class GeoJSONTest(BaseApiTest):
 
             self.assertTrue(geojson is None)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1068,7 +1206,7 @@ class AeraTest(BaseApiTest):
         ],
     }
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testSuccess(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
@@ -1111,7 +1249,7 @@ class AeraTest(BaseApiTest):
 
             self.assertEqual(geojson, AeraTest.GEOJSON)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testFailure(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(Response(None, 500))
@@ -1119,7 +1257,7 @@ class AeraTest(BaseApiTest):
             geojson = client.get_area("NUTS1")
             self.assertTrue(geojson is None)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     def testException(self, get_mock):
         with self.flask_app.app_context():
             get_mock.side_effect = Exception()
@@ -1131,7 +1269,6 @@ class AeraTest(BaseApiTest):
 class LegendTest(BaseApiTest):
 
     LEGEND = {"symbology": []}
-    LEGEND2 = {"symbology": ["2"]}
 
     PARAMETERS_DEFAULT_INTERSECTING = {
         "end_at": None,
@@ -1153,7 +1290,7 @@ class LegendTest(BaseApiTest):
         },
     }
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
@@ -1165,7 +1302,7 @@ class LegendTest(BaseApiTest):
             )
 
             layer_name = path.make_unique_layer_name(path.VECTOR, 1)
-            legend = client.get_legend(layer_name, ttl_hash=100)
+            legend = client.get_legend(layer_name)
 
             self.assertEqual(get_mock.call_count, 1)
 
@@ -1197,61 +1334,106 @@ class LegendTest(BaseApiTest):
 
             self.assertEqual(legend, LegendTest.LEGEND)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
     )
-    def testCaching(self, get_mock):
+    def testFailure(self, get_mock):
         with self.flask_app.app_context():
-            get_mock.return_value = setupResponse(
-                Response(json.dumps(LegendTest.LEGEND))
-            )
+            get_mock.return_value = setupResponse(Response(None, 500))
+
+            layer_name = path.make_unique_layer_name(path.VECTOR, 1)
+            legend = client.get_legend(layer_name)
+            self.assertTrue(legend is None)
+
+    @patch("app.common.client._get")
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
+    )
+    def testException(self, get_mock):
+        with self.flask_app.app_context():
+            get_mock.side_effect = Exception()
 
             layer_name = path.make_unique_layer_name(path.VECTOR, 1)
+            legend = client.get_legend(layer_name)
+            self.assertTrue(legend is None)
+
+
+class LayerSummaryTest(BaseApiTest):
 
-            legend1 = client.get_legend(layer_name, ttl_hash=200)
+    SUMMARY = {"count": 3, "max_start_at": "2015-01-01T00:00:00", "checksum": "abc"}
 
+    @patch("app.common.client._get")
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(
+            return_value=datasets.convert(LegendTest.PARAMETERS_DEFAULT_INTERSECTING)
+        ),
+    )
+    def testSuccess(self, get_mock):
+        with self.flask_app.app_context():
             get_mock.return_value = setupResponse(
-                Response(json.dumps(LegendTest.LEGEND2))
+                Response(json.dumps(LayerSummaryTest.SUMMARY))
             )
 
-            legend2 = client.get_legend(layer_name, ttl_hash=200)
+            layer_name = path.make_unique_layer_name(path.VECTOR, 1)
+            summary = client.get_layer_summary(layer_name)
 
-            self.assertEqual(get_mock.call_count, 1)
-            self.assertEqual(legend1, legend2)
-            self.assertEqual(legend1, LegendTest.LEGEND)
+            self.assertEqual(get_mock.call_args.args[0], "rpc/enermaps_layer_summary")
 
-            legend3 = client.get_legend(layer_name, ttl_hash=300)
+            req_parameters = json.loads(
+                get_mock.call_args.kwargs["params"]["parameters"]
+            )
+            self.assertEqual(req_parameters["data.ds_id"], 1)
+            self.assertTrue("intersecting" in req_parameters)
 
-            self.assertEqual(get_mock.call_count, 2)
-            self.assertEqual(legend3, LegendTest.LEGEND2)
+            self.assertEqual(summary, LayerSummaryTest.SUMMARY)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
-        new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
+        new=Mock(
+            return_value=datasets.convert(LegendTest.PARAMETERS_DEFAULT_INTERSECTING)
+        ),
     )
     def testFailure(self, get_mock):
         with self.flask_app.app_context():
             get_mock.return_value = setupResponse(Response(None, 500))
 
             layer_name = path.make_unique_layer_name(path.VECTOR, 1)
-            legend = client.get_legend(layer_name, ttl_hash=900)
-            self.assertTrue(legend is None)
+            self.assertTrue(client.get_layer_summary(layer_name) is None)
 
-    @patch("requests.get")
-    @patch(
-        "app.common.client.get_parameters",
-        new=Mock(return_value=datasets.convert(PARAMETERS_DEFAULT_INTERSECTING)),
-    )
-    def testException(self, get_mock):
+
+class RasterFileInfoTest(BaseApiTest):
+    @patch("app.common.client._head")
+    def testSuccess(self, head_mock):
         with self.flask_app.app_context():
-            get_mock.side_effect = Exception()
+            head_mock.return_value = setupResponse(
+                Response(
+                    None, headers={"ETag": '"5f2a-1b3c"', "Content-Length": "6956"}
+                )
+            )
 
-            layer_name = path.make_unique_layer_name(path.VECTOR, 1)
-            legend = client.get_legend(layer_name, ttl_hash=900)
-            self.assertTrue(legend is None)
+            info = client.get_raster_file_info(42, "FID.tif")
+
+            self.assertTrue(head_mock.call_args.args[0].endswith("42/FID.tif"))
+            self.assertEqual(info, {"etag": '"5f2a-1b3c"', "size": 6956})
+
+    @patch("app.common.client._head")
+    def testNoETag(self, head_mock):
+        with self.flask_app.app_context():
+            head_mock.return_value = setupResponse(Response(None))
+
+            info = client.get_raster_file_info(42, "FID.tif")
+            self.assertEqual(info, {"etag": None, "size": None})
+
+    @patch("app.common.client._head")
+    def testFailure(self, head_mock):
+        with self.flask_app.app_context():
+            head_mock.return_value = setupResponse(Response(None, 404))
+            self.assertTrue(client.get_raster_file_info(42, "FID.tif") is None)
 
 
 class RastersTest(BaseApiTest):
@@ -1289,7 +1471,7 @@ class RastersTest(BaseApiTest):
         },
     ]
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1330,7 +1512,7 @@ class RastersTest(BaseApiTest):
 
             self.assertEqual(rasters, RastersTest.RASTERS)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1342,7 +1524,7 @@ class RastersTest(BaseApiTest):
             rasters = client.get_rasters("raster/42")
             self.assertTrue(rasters is None)
 
-    @patch("requests.get")
+    @patch("app.common.client._get")
     @patch(
         "app.common.client.get_parameters",
         new=Mock(return_value=datasets.convert(PARAMETERS)),
@@ -1353,3 +1535,72 @@ class RastersTest(BaseApiTest):
 
             rasters = client.get_rasters("raster/42")
             self.assertTrue(rasters is None)
+
+    def _setupPages(self, get_mock, keyset=True):
+        """Simulate a layer of 23 features, whose fid are their index"""
+
+        def _page(url, headers, params):
+            if url.endswith("rpc/enermaps_count_features"):
+                if not (keyset):
+                    return setupResponse(Response("", status_code=404))
+
+                bounds = {"count": 23, "after_fids": [None, "9", "19"]}
+                return setupResponse(Response(json.dumps(bounds)))
+
+            if url.endswith("rpc/enermaps_query_geojson_keyset"):
+                row_offset = int(params.get("after_fid", -1)) + 1
+            else:
+                self.assertTrue(url.endswith("rpc/enermaps_query_geojson"))
+                row_offset = params["row_offset"]
+
+            nb_features = max(0, min(10, 23 - row_offset))
+
+            page = copy.deepcopy(GeoJSONTest.GEOJSON)
+            if nb_features == 0:
+                page["features"] = None
+            else:
+                feature = page["features"][0]
+                page["features"] = []
+                for i in range(nb_features):
+                    page["features"].append(copy.deepcopy(feature))
+                    page["features"][-1]["id"] = row_offset + i
+
+            return setupResponse(Response(json.dumps(page)))
+
+        get_mock.side_effect = _page
+
+    @patch("app.common.client._get")
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(return_value=datasets.convert(PARAMETERS)),
+    )
+    def testConcurrentIteration(self, get_mock):
+        self._setupPages(get_mock)
+
+        with self.flask_app.app_context():
+            layer_name = path.make_unique_layer_name(path.VECTOR, 1)
+            features = list(
+                client.iter_geojson_features(layer_name, row_limit=10, workers=3)
+            )
+
+            self.assertEqual([x["id"] for x in features], list(range(23)))
+
+            # One request to count the features, then one per page
+            self.assertEqual(get_mock.call_count, 4)
+
+    @patch("app.common.client._get")
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(return_value=datasets.convert(PARAMETERS)),
+    )
+    def testConcurrentIterationWithOffsets(self, get_mock):
+        self._setupPages(get_mock, keyset=False)
+
+        with self.flask_app.app_context():
+            layer_name = path.make_unique_layer_name(path.VECTOR, 1)
+            features = list(
+                client.iter_geojson_features(layer_name, row_limit=10, workers=3)
+            )
+
+            self.assertEqual([x["id"] for x in features], list(range(23)))
+            self.assertTrue(get_mock.call_count >= 4)
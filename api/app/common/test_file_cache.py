@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from . import file_cache
+
+
+class FileCacheTest(unittest.TestCase):
+    def setUp(self):
+        file_cache.clear()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "data.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        file_cache.clear()
+
+    def write(self, data, delay=0):
+        with open(self.filename, "w") as f:
+            json.dump(data, f)
+
+        if delay != 0:
+            now = time.time() + delay
+            os.utime(self.filename, (now, now))
+
+    def testNoFile(self):
+        self.assertTrue(file_cache.get_json(self.filename) is None)
+
+    def testLoadedOnce(self):
+        self.write({"left": 0})
+
+        calls = []
+
+        def _loader(filename):
+            calls.append(filename)
+            return {"left": 0}
+
+        value1 = file_cache.get(self.filename, _loader)
+        value2 = file_cache.get(self.filename, _loader)
+
+        self.assertEqual(value1, {"left": 0})
+        self.assertTrue(value1 is value2)
+        self.assertEqual(calls, [self.filename])
+
+    def testReloadedWhenModified(self):
+        self.write({"left": 0})
+        self.assertEqual(file_cache.get_json(self.filename), {"left": 0})
+
+        self.write({"left": 10}, delay=10)
+        self.assertEqual(file_cache.get_json(self.filename), {"left": 10})
+
+    def testTags(self):
+        self.write({"left": 0})
+
+        self.assertEqual(file_cache.get_json(self.filename), {"left": 0})
+        self.assertEqual(file_cache.get_text(self.filename), '{"left": 0}')
+
+    def testInvalidFile(self):
+        with open(self.filename, "w") as f:
+            f.write("{")
+
+        self.assertTrue(file_cache.get_json(self.filename) is None)
+
+    def testEviction(self):
+        max_size = file_cache.MAX_SIZE
+        file_cache.MAX_SIZE = 20
+
+        try:
+            filenames = [os.path.join(self.tmp_dir.name, f"{i}.txt") for i in range(3)]
+            for filename in filenames:
+                with open(filename, "w") as f:
+                    f.write("0123456789")
+
+                file_cache.get_text(filename)
+
+            stats = file_cache.get_stats()
+            self.assertEqual(stats["entries"], 2)
+            self.assertEqual(stats["size"], 20)
+
+            misses = stats["misses"]
+            file_cache.get_text(filenames[0])
+            self.assertEqual(file_cache.get_stats()["misses"], misses + 1)
+        finally:
+            file_cache.MAX_SIZE = max_size
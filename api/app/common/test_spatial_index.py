@@ -0,0 +1,132 @@
+import os
+import tempfile
+import time
+import unittest
+
+from . import spatial_index
+
+
+def create_grid(size):
+    """Return the entries of a grid of size x size unit squares"""
+    entries = []
+    for x in range(size):
+        for y in range(size):
+            entries.append(((x, y, x + 1, y + 1), f"{x}-{y}"))
+    return entries
+
+
+def brute_force(entries, bounds):
+    return sorted(
+        value for box, value in entries if spatial_index.intersects(box, bounds)
+    )
+
+
+class STRTreeTest(unittest.TestCase):
+    def testEmpty(self):
+        tree = spatial_index.STRTree([])
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.query((0, 0, 1, 1)), [])
+
+    def testSingleEntry(self):
+        tree = spatial_index.STRTree([((0, 0, 1, 1), "a")])
+        self.assertEqual(tree.query((0.5, 0.5, 2, 2)), ["a"])
+        self.assertEqual(tree.query((2, 2, 3, 3)), [])
+
+    def testSameResultsAsBruteForce(self):
+        entries = create_grid(40)
+        tree = spatial_index.STRTree(entries, node_capacity=4)
+
+        self.assertTrue(len(tree.levels) > 2)
+
+        for bounds in (
+            (0.5, 0.5, 0.6, 0.6),
+            (10.5, 3.2, 17.1, 3.4),
+            (-5, -5, 100, 100),
+            (39.5, 39.5, 50, 50),
+            (41, 41, 50, 50),
+            (20, 20, 20, 20),
+        ):
+            self.assertEqual(
+                sorted(tree.query(bounds)), brute_force(entries, bounds), bounds
+            )
+
+    def testSerialization(self):
+        entries = create_grid(10)
+        tree = spatial_index.STRTree(entries, node_capacity=4)
+        tree2 = spatial_index.STRTree.from_dict(tree.to_dict())
+
+        bounds = (2.5, 2.5, 6.5, 4.5)
+        self.assertEqual(sorted(tree2.query(bounds)), brute_force(entries, bounds))
+
+
+class IndexRingsTest(unittest.TestCase):
+    def testPositions(self):
+        rings = {
+            "b.tif": [[10, 30], [20, 30], [20, 40], [10, 40], [10, 30]],
+            "a.tif": [[0, 0], [5, 0], [5, 5], [0, 5], [0, 0]],
+        }
+
+        tree = spatial_index.index_rings(rings)
+
+        self.assertEqual(tree.query((15, 35, 16, 36)), [[0, "b.tif"]])
+        self.assertEqual(tree.query((1, 1, 2, 2)), [[1, "a.tif"]])
+        self.assertEqual(tree.query((6, 6, 7, 7)), [])
+
+    def testMissingRing(self):
+        rings = {
+            "a.tif": [[0, 0], [5, 0], [5, 5], [0, 5], [0, 0]],
+            "b.tif": None,
+        }
+
+        self.assertTrue(spatial_index.index_rings(rings) is None)
+
+
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp_dir.name, "index.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def testNoFile(self):
+        self.assertTrue(spatial_index.load(self.filename) is None)
+
+    def testLoadedOnce(self):
+        spatial_index.STRTree(create_grid(3)).save(self.filename)
+
+        tree1 = spatial_index.load(self.filename)
+        tree2 = spatial_index.load(self.filename)
+
+        self.assertTrue(tree1 is not None)
+        self.assertTrue(tree1 is tree2)
+
+    def testReloadedWhenModified(self):
+        spatial_index.STRTree(create_grid(3)).save(self.filename)
+        tree1 = spatial_index.load(self.filename)
+
+        spatial_index.STRTree(create_grid(4)).save(self.filename)
+        now = time.time() + 10
+        os.utime(self.filename, (now, now))
+
+        tree2 = spatial_index.load(self.filename)
+
+        self.assertTrue(tree1 is not tree2)
+        self.assertEqual(len(tree2), 16)
+
+    def testFactory(self):
+        with open(self.filename, "w") as f:
+            f.write("{}")
+
+        calls = []
+
+        def _factory():
+            calls.append(1)
+            return spatial_index.STRTree(create_grid(2))
+
+        tree1 = spatial_index.load(self.filename, factory=_factory)
+        tree2 = spatial_index.load(self.filename, factory=_factory)
+
+        self.assertEqual(len(tree1), 4)
+        self.assertTrue(tree1 is tree2)
+        self.assertEqual(len(calls), 1)
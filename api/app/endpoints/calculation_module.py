@@ -7,7 +7,7 @@ import os
 import re
 import unicodedata
 
-from flask import Response, abort, redirect, request, send_file, url_for
+from flask import Response, abort, current_app, redirect, request, send_file, url_for
 from flask_restx import Namespace, Resource
 from werkzeug.datastructures import FileStorage
 
@@ -99,16 +99,24 @@ class CMTask(Resource):
         """Get task based on the CM name and the task ID,
         and return a dictionary as response.
         If task hasn't executed yet, empty dictionary is returned.
+
+        With the 'wait' parameter (in seconds), the response is only sent once the
+        status of the task changes, or after that duration (long polling).
         """
         task = CM.task_by_id(task_id, cm_name=cm_name)
 
+        wait = request.args.get("wait", 0, type=float)
+        wait = min(wait, float(current_app.config["CM_TASK_MAX_WAIT"]))
+        if (wait > 0) and not task.ready():
+            CM.wait_for_task(task, wait)
+
         task_status = {"status": task.status, "task_id": task_id, "cm_name": cm_name}
         if not task.ready():
             task_status["result"] = ""
             return task_status
 
         try:
-            result = task.get(timeout=0.5)
+            result = CM.get_task_result(task)
         except Exception as e:
             if task.status == "FAILURE":
                 # this is an expected failure
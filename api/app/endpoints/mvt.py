@@ -0,0 +1,67 @@
+"""
+Vector tiles of the vector and area layers, in the Mapbox Vector Tile format
+(https://github.com/mapbox/vector-tile-spec), for the frontend to render and style
+them itself instead of using the images of the WMS.
+
+The tiles are those of the XYZ grid of the WMTS: /mvt/<layer>/<z>/<x>/<y>.pbf. They
+are built by the database (see enermaps_query_mvt in db/init/postgrest.sql), with
+geometries simplified for their zoom level, and contain a single layer named
+"features".
+"""
+
+import hashlib
+import re
+
+from flask import Response, abort, current_app, request
+from flask_restx import Namespace, Resource
+
+from app.common import client, path
+from app.models.wms import tile_cache
+
+api = Namespace("mvt", "Vector tiles endpoint")
+
+TILE_REGEX = re.compile(r"^(\d+)\.pbf$")
+
+MIMETYPE = "application/vnd.mapbox-vector-tile"
+
+
+@api.route("/<path:layer_name>/<int:z>/<int:x>/<string:tile>")
+class VectorTile(Resource):
+    def get(self, layer_name, z, x, tile):
+        """Return a vector tile of a layer"""
+        match = TILE_REGEX.match(tile)
+        if match is None:
+            abort(404)
+
+        y = int(match.group(1))
+
+        if (z > current_app.config["MVT"]["MAX_ZOOM"]) or (max(x, y) >= 2 ** z):
+            abort(404)
+
+        if path.get_type(layer_name) not in (path.VECTOR, path.AREA):
+            abort(404)
+
+        # As for the WMTS, the key of the tile in the cache depends on the version of
+        # the layer, and is used as a strong ETag
+        key = tile_cache.make_tile_key(layer_name, z, x, y, MIMETYPE)
+        if (key is not None) and request.if_none_match.contains(key):
+            return self.make_response(Response(status=304), key)
+
+        content = tile_cache.get(key)
+        if content is None:
+            content = client.get_vector_tile(layer_name, z, x, y)
+            if content is None:
+                abort(404)
+
+            tile_cache.put(key, content)
+
+        etag = key if key is not None else hashlib.sha256(content).hexdigest()
+
+        response = self.make_response(Response(content, mimetype=MIMETYPE), etag)
+        return response.make_conditional(request)
+
+    def make_response(self, response, etag):
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config["MVT"]["MAX_AGE"]
+        return response
@@ -24,7 +24,7 @@ class MockCM:
         self.input_layers = []
         self.called_with_args = []
         self.status = status
-        self.result = result
+        self._result = result
         self.wiki = "https://enermaps-wiki.herokuapp.com/en/Home"
 
     def call(self, *args):
@@ -34,9 +34,10 @@ class MockCM:
     def ready(self):
         return not (self.status in ("PENDING", "REVOKED"))
 
-    def get(self, timeout=0):
-        if self.result is not None:
-            return self.result
+    @property
+    def result(self):
+        if self._result is not None:
+            return self._result
 
         raise Exception("Some problem")
 
@@ -325,6 +326,56 @@ class CMTaskTest(BaseApiTest):
         self.assertEqual(data["status"], "FAILURE")
         self.assertEqual(data["result"], "An unexpected error happened: Some problem")
 
+    @patch("app.models.calculation_module.wait_for_task")
+    @patch(
+        "app.models.calculation_module.task_by_id",
+        new=Mock(return_value=MockCM()),
+    )
+    def testWaitForPendingTask(self, wait_mock):
+        response = self.client.get(
+            "api/cm/mock_cm/task/01234567-0000-0000-0000-000000000000/?wait=10"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["status"], "PENDING")
+
+        self.assertEqual(wait_mock.call_count, 1)
+        self.assertEqual(wait_mock.call_args.args[1], 10)
+
+        # The duration of the wait is limited
+        response = self.client.get(
+            "api/cm/mock_cm/task/01234567-0000-0000-0000-000000000000/?wait=3600"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            wait_mock.call_args.args[1], self.flask_app.config["CM_TASK_MAX_WAIT"]
+        )
+
+    @patch("app.models.calculation_module.wait_for_task")
+    @patch(
+        "app.models.calculation_module.task_by_id",
+        new=Mock(return_value=MockCM(status="SUCCESS", result={"value1": 10})),
+    )
+    def testNoWaitForFinishedTask(self, wait_mock):
+        response = self.client.get(
+            "api/cm/mock_cm/task/01234567-0000-0000-0000-000000000000/?wait=10"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["status"], "SUCCESS")
+
+        self.assertEqual(wait_mock.call_count, 0)
+
+    @patch("app.models.calculation_module.wait_for_task")
+    @patch(
+        "app.models.calculation_module.task_by_id",
+        new=Mock(return_value=MockCM()),
+    )
+    def testNoWaitByDefault(self, wait_mock):
+        response = self.client.get(
+            "api/cm/mock_cm/task/01234567-0000-0000-0000-000000000000/"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(wait_mock.call_count, 0)
+
     @patch(
         "app.models.calculation_module.task_by_id",
         new=Mock(return_value=MockCM()),
@@ -0,0 +1,73 @@
+import os
+from unittest.mock import Mock, patch
+
+from app.common import path
+from app.common.test import BaseApiTest
+from app.models import geofile, storage
+
+LAYER_NAME = path.make_unique_layer_name(path.AREA, "example")
+
+TILE_URL = f"api/mvt/{LAYER_NAME}/11/1025/675.pbf"
+
+# Content of the tile returned by the database (not a valid tile, but the API doesn't
+# decode it)
+TILE_CONTENT = b"\x1a\x08features"
+
+
+class VectorTileTest(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create(LAYER_NAME)
+            os.makedirs(storage_instance.get_dir(LAYER_NAME))
+            geofile.update_layer_version(LAYER_NAME)
+
+    @patch("app.common.client.get_vector_tile", return_value=TILE_CONTENT)
+    def testTile(self, get_mock):
+        response = self.client.get(TILE_URL)
+        self.assertStatusCodeEqual(response, 200)
+        self.assertEqual(response.data, TILE_CONTENT)
+        self.assertEqual(response.mimetype, "application/vnd.mapbox-vector-tile")
+        self.assertTrue(response.headers.get("ETag") is not None)
+
+        get_mock.assert_called_once_with(LAYER_NAME, 11, 1025, 675)
+
+    @patch("app.common.client.get_vector_tile", return_value=TILE_CONTENT)
+    def testCached(self, get_mock):
+        response1 = self.client.get(TILE_URL)
+        response2 = self.client.get(TILE_URL)
+
+        self.assertEqual(response1.data, response2.data)
+        self.assertEqual(get_mock.call_count, 1)
+
+        etag = response1.headers.get("ETag")
+        response = self.client.get(TILE_URL, headers={"If-None-Match": etag})
+        self.assertStatusCodeEqual(response, 304)
+
+    @patch("app.common.client.get_vector_tile", return_value=TILE_CONTENT)
+    def testNewVersion(self, get_mock):
+        response1 = self.client.get(TILE_URL)
+
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+
+        response2 = self.client.get(TILE_URL)
+
+        self.assertNotEqual(
+            response1.headers.get("ETag"), response2.headers.get("ETag")
+        )
+        self.assertEqual(get_mock.call_count, 2)
+
+    @patch("app.common.client.get_vector_tile", new=Mock(return_value=None))
+    def testFailure(self):
+        response = self.client.get(TILE_URL)
+        self.assertStatusCodeEqual(response, 404)
+
+    def testInvalidTile(self):
+        response = self.client.get(f"api/mvt/{LAYER_NAME}/1/2/0.pbf")
+        self.assertStatusCodeEqual(response, 404)
+
+        raster_layer = path.make_unique_layer_name(path.RASTER, 1)
+        response = self.client.get(f"api/mvt/{raster_layer}/1/0/0.pbf")
+        self.assertStatusCodeEqual(response, 404)
@@ -1,3 +1,4 @@
+import copy
 import io
 import json
 import os
@@ -10,10 +11,11 @@ from owslib.wms import WebMapService
 from PIL import Image
 
 import app.common.xml as xml
-from app.common import datasets, path
+from app.common import datasets, metadata_cache, path
 from app.common.projection import epsg_to_proj4
 from app.common.test import BaseApiTest, BaseIntegrationTest
-from app.models import storage
+from app.models import geofile, storage
+from app.models.wms import capabilities
 
 GETCAPABILITIES_ARGS = {"service": "WMS", "request": "GetCapabilities"}
 WMS_VERSION = "1.3.0"
@@ -133,6 +135,80 @@ class WMSGetCapabilitiesTest(BaseApiTest):
         self.assertEqual(len(layer_names), 0, "Found a layer, expected none")
         self._validate_xml(root)
 
+    @patch(
+        "app.common.client.get_dataset_list",
+        new=Mock(return_value=DATASETS),
+    )
+    def testSavedDocument(self):
+        """Test that the capabilities document is only built once, and that its ETag
+        is honored
+        """
+        get_parameters = Mock(return_value=datasets.convert(self.PARAMETERS))
+
+        with patch("app.common.client.get_parameters", new=get_parameters):
+            response1 = self.client.get("api/wms", query_string=GETCAPABILITIES_ARGS)
+            self.assertStatusCodeEqual(response1, 200)
+
+            nb_calls = get_parameters.call_count
+
+            etag = response1.headers.get("ETag")
+            self.assertTrue(etag is not None)
+
+            response2 = self.client.get(
+                "api/wms",
+                query_string=GETCAPABILITIES_ARGS,
+                headers={"If-None-Match": etag},
+            )
+            self.assertStatusCodeEqual(response2, 304)
+
+            response3 = self.client.get("api/wms", query_string=GETCAPABILITIES_ARGS)
+            self.assertStatusCodeEqual(response3, 200)
+            self.assertEqual(response1.data, response3.data)
+
+            self.assertEqual(get_parameters.call_count, nb_calls)
+            self.assertTrue(b"__BASE_URL__" not in response3.data)
+
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(return_value=datasets.convert(PARAMETERS)),
+    )
+    def testStaleDocument(self):
+        """Test that the capabilities document is built again once it is older than
+        the cache of the metadata, and that its ETag changes along with the datasets
+        """
+        with patch("app.common.client.get_dataset_list", return_value=self.DATASETS):
+            response1 = self.client.get("api/wms", query_string=GETCAPABILITIES_ARGS)
+            self.assertStatusCodeEqual(response1, 200)
+            etag = response1.headers.get("ETag")
+
+        renamed = copy.deepcopy(self.DATASETS)
+        renamed[1]["title"] = "renamed dataset2"
+
+        with patch("app.common.client.get_dataset_list", return_value=renamed):
+            # Still fresh: the saved document is served
+            response2 = self.client.get(
+                "api/wms",
+                query_string=GETCAPABILITIES_ARGS,
+                headers={"If-None-Match": etag},
+            )
+            self.assertStatusCodeEqual(response2, 304)
+
+            with self.flask_app.app_context():
+                filename = capabilities.get_capabilities_file()
+
+            mtime = os.stat(filename).st_mtime - metadata_cache.TTL - 1
+            os.utime(filename, (mtime, mtime))
+
+            response3 = self.client.get(
+                "api/wms",
+                query_string=GETCAPABILITIES_ARGS,
+                headers={"If-None-Match": etag},
+            )
+            self.assertStatusCodeEqual(response3, 200)
+            self.assertNotEqual(response3.headers.get("ETag"), etag)
+            self.assertTrue(b"renamed dataset2" in response3.data)
+            self._validate_xml_string(response3.data)
+
     def _validate_xml_string(self, xml_string):
         """Validate a xml schema saved as string based on the xml validator."""
         root = etree.fromstring(xml_string)  # nosec
@@ -198,10 +274,6 @@ class WMSGetMapTest(BaseApiTest):
             with open(storage_instance.get_geometries_file(layer_name), "w") as f:
                 json.dump(geometries, f)
 
-    @patch(
-        "app.common.client.get_legend",
-        new=Mock(return_value=None),
-    )
     def testVectorTileWorkflow(self):
         """Retrieve a vector layer as image from WMS endpoint,
         check if the image has the right size  without being empty.
@@ -218,10 +290,6 @@ class WMSGetMapTest(BaseApiTest):
         self.assertEqual(image.size, self.TILE_SIZE)
         self.assertEqual(image.format, "PNG")
 
-    @patch(
-        "app.common.client.get_legend",
-        new=Mock(return_value=None),
-    )
     def testVectorTileWorkflowUnknownLayer(self):
         """Retrieve a vector layer as image from WMS endpoint,
         check if the image has the right size  without being empty.
@@ -232,10 +300,6 @@ class WMSGetMapTest(BaseApiTest):
         response = self.client.get("api/wms", query_string=args)
         self.assertStatusCodeEqual(response, 404)
 
-    @patch(
-        "app.common.client.get_legend",
-        new=Mock(return_value=None),
-    )
     def testRasterTileWorkflow(self):
         """Retrieve a raster layer as image from WMS endpoint,
         then check that the tile request is not empty"""
@@ -251,10 +315,6 @@ class WMSGetMapTest(BaseApiTest):
         self.assertEqual(image.size, self.TILE_SIZE)
         self.assertEqual(image.format, "PNG")
 
-    @patch(
-        "app.common.client.get_legend",
-        new=Mock(return_value=None),
-    )
     def testRasterTileWorkflowUnknownLayer(self):
         """Retrieve a raster layer as image from WMS endpoint,
         then check that the tile request is not empty"""
@@ -265,6 +325,175 @@ class WMSGetMapTest(BaseApiTest):
         self.assertStatusCodeEqual(response, 404)
 
 
+class WMSGetFeatureInfoTest(BaseApiTest):
+    """Test the wms GetFeatureInfo endpoint"""
+
+    LAYER_NAME = path.make_unique_layer_name(path.AREA, "example")
+
+    # From 0 to 20 degrees of longitude and from 40 to 55 degrees of latitude
+    PARAMETERS = {
+        "service": "WMS",
+        "request": "GetFeatureInfo",
+        "layers": LAYER_NAME,
+        "query_layers": LAYER_NAME,
+        "styles": "",
+        "info_format": "application/json",
+        "version": "1.1.1",
+        "width": "100",
+        "height": "100",
+        "srs": "EPSG:3857",
+        "bbox": "0.0,4865942.279503176,2226389.8158654715,7361866.113051185",
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create(self.LAYER_NAME)
+
+            os.makedirs(storage_instance.get_dir(self.LAYER_NAME))
+
+            shutil.copy(
+                self.get_testdata_path("example.geojson"),
+                storage_instance.get_geojson_file(self.LAYER_NAME),
+            )
+
+            proj_filepath = storage_instance.get_projection_file(self.LAYER_NAME)
+            with open(proj_filepath, "w") as fd:
+                fd.write(epsg_to_proj4(4326))
+
+    def testFeatureFound(self):
+        # Longitude 8, latitude 47.2
+        args = dict(self.PARAMETERS, x="40", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+
+        features = response.json["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["properties"], {"this": "that"})
+        self.assertEqual(features[0]["geometry"]["type"], "Polygon")
+
+    def testNoFeatureFound(self):
+        # Longitude 18, latitude 47.2
+        args = dict(self.PARAMETERS, x="90", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+        self.assertEqual(response.json["features"], [])
+
+    def testUnknownLayer(self):
+        layer_name = path.make_unique_layer_name(path.AREA, "unknown")
+        args = dict(
+            self.PARAMETERS, layers=layer_name, query_layers=layer_name, x="40", y="55"
+        )
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 404)
+
+    def testQueryLayersMismatch(self):
+        args = dict(self.PARAMETERS, query_layers="area/other", x="40", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 400)
+
+
+class WMSRasterGetFeatureInfoTest(BaseApiTest):
+    """Test the wms GetFeatureInfo endpoint on raster layers"""
+
+    LAYER_NAME = path.make_unique_layer_name(path.RASTER, 42, "heat", "2016")
+
+    # Around the center of the pixel (410, 300) of the raster file (in EPSG:3035), which
+    # has the value 58
+    PARAMETERS = {
+        "service": "WMS",
+        "request": "GetFeatureInfo",
+        "layers": LAYER_NAME,
+        "query_layers": LAYER_NAME,
+        "styles": "",
+        "info_format": "application/json",
+        "version": "1.1.1",
+        "width": "100",
+        "height": "100",
+        "srs": "EPSG:3035",
+        "bbox": "3928177.08,3226446.34,3929177.08,3227446.34",
+    }
+
+    PARAMETERS_OUTSIDE = dict(
+        PARAMETERS, bbox="928177.08,3226446.34,929177.08,3227446.34"
+    )
+
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            for time_period in ("2015", "2016"):
+                layer_name = path.make_unique_layer_name(
+                    path.RASTER, 42, "heat", time_period
+                )
+                storage_instance = storage.create(layer_name)
+
+                os.makedirs(storage_instance.get_dir(layer_name))
+
+                shutil.copy(
+                    self.get_testdata_path("hotmaps-cdd_curr_adapted.tif"),
+                    storage_instance.get_file_path(layer_name, "FID.tif"),
+                )
+
+                geometries = {
+                    "FID.tif": [[0, 60], [10, 60], [10, 30], [0, 30], [0, 60]]
+                }
+                with open(storage_instance.get_geometries_file(layer_name), "w") as f:
+                    json.dump(geometries, f)
+
+    def testValueFound(self):
+        args = dict(self.PARAMETERS, x="50", y="50")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+
+        features = response.json["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["geometry"]["type"], "Point")
+        self.assertEqual(
+            json.loads(features[0]["properties"]["variables"]), {"heat": 58.0}
+        )
+
+    def testNoValueFound(self):
+        args = dict(self.PARAMETERS_OUTSIDE, x="50", y="50")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+        self.assertEqual(response.json["features"], [])
+
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(
+            return_value={
+                "temporal_granularity": "year",
+                "start_at": "2015-01-01 00:00",
+                "end_at": "2017-01-01 00:00",
+                "default_parameters": {},
+                "time_periods": [],
+            }
+        ),
+    )
+    def testTimeSeries(self):
+        args = dict(self.PARAMETERS, x="50", y="50", time_series="true")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+
+        features = response.json["features"]
+        self.assertEqual(len(features), 1)
+
+        # No file for 2017
+        self.assertEqual(
+            json.loads(features[0]["properties"]["variables"]),
+            {"heat (2015)": 58.0, "heat (2016)": 58.0},
+        )
+
+
 class TestWMSLibCompliance(BaseIntegrationTest):
     def setUp(self, *args, **kwargs):
         """Create the wms endpoint base on the parent self.api_url"""
@@ -275,3 +504,117 @@ class TestWMSLibCompliance(BaseIntegrationTest):
         """Verify that the content of the wms can be listed"""
         wms = WebMapService(self.wms_url, version=WMS_VERSION)
         self.assertNotEqual(len(wms.contents), 0)
+
+
+class WMSGetFeatureInfoVectorTest(BaseApiTest):
+    """Test the wms GetFeatureInfo endpoint on a vector layer read from its
+    GeoPackage file
+    """
+
+    LAYER_NAME = path.make_unique_layer_name(path.VECTOR, 42, "heat")
+
+    # From 0 to 20 degrees of longitude and from 40 to 55 degrees of latitude
+    PARAMETERS = dict(
+        WMSGetFeatureInfoTest.PARAMETERS, layers=LAYER_NAME, query_layers=LAYER_NAME
+    )
+
+    FEATURES = [
+        {
+            "id": "polygon",
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [[7.0, 46.0], [9.0, 46.0], [9.0, 48.0], [7.0, 48.0], [7.0, 46.0]]
+                ],
+            },
+            "properties": {
+                "units": {"heat": "MW"},
+                "fields": {},
+                "legend": {"symbology": []},
+                "start_at": None,
+                "variables": {"heat": 12.5},
+            },
+        },
+        {
+            "id": "point",
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [18.1, 47.2]},
+            "properties": {
+                "units": {"heat": "MW"},
+                "fields": {},
+                "legend": {"symbology": []},
+                "start_at": None,
+                "variables": {"heat": 7.0},
+            },
+        },
+    ]
+
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            features = (copy.deepcopy(x) for x in self.FEATURES)
+            geofile.save_vector_features(
+                path.make_unique_layer_name(path.VECTOR, 42), features
+            )
+
+            storage_instance = storage.create(self.LAYER_NAME)
+            self.assertTrue(
+                os.path.exists(storage_instance.get_geopackage_file(self.LAYER_NAME))
+            )
+
+    def testPolygonFound(self):
+        # Longitude 8, latitude 47.2
+        args = dict(self.PARAMETERS, x="40", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+
+        features = response.json["features"]
+        self.assertEqual(len(features), 1)
+
+        # The identifier of the feature is the FID column of the GeoPackage file,
+        # and the one from the database is a regular property
+        self.assertEqual(features[0]["id"], 1)
+        self.assertEqual(features[0]["type"], "Feature")
+        self.assertEqual(features[0]["geometry"]["type"], "Polygon")
+
+        properties = features[0]["properties"]
+        self.assertEqual(properties["id"], "polygon")
+        self.assertEqual(properties["__variable__heat"], 12.5)
+        self.assertTrue("__fid__" not in properties)
+        self.assertTrue("legend" not in properties)
+
+    def testPointFound(self):
+        # Longitude 18, latitude 47.2: the point is less than 3 pixels away, and the
+        # polygon is filtered out by the spatial filter
+        args = dict(self.PARAMETERS, x="90", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+
+        features = response.json["features"]
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]["id"], 2)
+        self.assertEqual(features[0]["geometry"]["type"], "Point")
+        self.assertEqual(features[0]["properties"]["id"], "point")
+        self.assertEqual(features[0]["properties"]["__variable__heat"], 7.0)
+
+    def testNoFeatureFound(self):
+        # Longitude 3, latitude 47.2
+        args = dict(self.PARAMETERS, x="15", y="55")
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+        self.assertEqual(response.json["features"], [])
+
+    def testUnknownVariable(self):
+        layer_name = path.make_unique_layer_name(path.VECTOR, 42, "cold")
+        args = dict(
+            self.PARAMETERS, layers=layer_name, query_layers=layer_name, x="40", y="55"
+        )
+
+        response = self.client.get("api/wms", query_string=args)
+        self.assertStatusCodeEqual(response, 200)
+        self.assertEqual(response.json["features"], [])
@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import shutil
+from unittest.mock import Mock, patch
+
+from lxml import etree  # nosec
+from PIL import Image
+
+from app.common import datasets, path
+from app.common.projection import epsg_to_proj4
+from app.common.test import BaseApiTest
+from app.models import geofile, storage
+
+LAYER_NAME = path.make_unique_layer_name(path.AREA, "example")
+
+# Tile covering the features of example.geojson
+TILE_URL = f"api/wmts/{LAYER_NAME}/11/1025/675.png"
+
+NSMAP = {
+    "wmts": "http://www.opengis.net/wmts/1.0",
+    "ows": "http://www.opengis.net/ows/1.1",
+}
+
+
+class WMTSTileTest(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create(LAYER_NAME)
+
+            os.makedirs(storage_instance.get_dir(LAYER_NAME))
+
+            shutil.copy(
+                self.get_testdata_path("example.geojson"),
+                storage_instance.get_geojson_file(LAYER_NAME),
+            )
+
+            proj_filepath = storage_instance.get_projection_file(LAYER_NAME)
+            with open(proj_filepath, "w") as fd:
+                fd.write(epsg_to_proj4(4326))
+
+            geofile.update_layer_version(LAYER_NAME)
+
+    def testTile(self):
+        response = self.client.get(TILE_URL)
+        self.assertStatusCodeEqual(response, 200)
+
+        image = Image.open(io.BytesIO(response.data))
+        self.assertEqual(image.size, (256, 256))
+        self.assertEqual(image.format, "PNG")
+
+        self.assertTrue(response.headers.get("ETag") is not None)
+        self.assertTrue("public" in response.headers.get("Cache-Control"))
+
+    def testHighResolutionTile(self):
+        response = self.client.get(TILE_URL.replace(".png", "@2x.png"))
+        self.assertStatusCodeEqual(response, 200)
+
+        image = Image.open(io.BytesIO(response.data))
+        self.assertEqual(image.size, (512, 512))
+
+    def testNotModified(self):
+        response = self.client.get(TILE_URL)
+        self.assertStatusCodeEqual(response, 200)
+
+        etag = response.headers.get("ETag")
+
+        response = self.client.get(TILE_URL, headers={"If-None-Match": etag})
+        self.assertStatusCodeEqual(response, 304)
+        self.assertEqual(response.headers.get("ETag"), etag)
+
+    def testNewVersion(self):
+        response = self.client.get(TILE_URL)
+        etag = response.headers.get("ETag")
+
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+
+        response = self.client.get(TILE_URL, headers={"If-None-Match": etag})
+        self.assertStatusCodeEqual(response, 200)
+        self.assertNotEqual(response.headers.get("ETag"), etag)
+
+    def testOutsideOfGrid(self):
+        response = self.client.get(f"api/wmts/{LAYER_NAME}/1/2/0.png")
+        self.assertStatusCodeEqual(response, 404)
+
+    def testInvalidTile(self):
+        response = self.client.get(f"api/wmts/{LAYER_NAME}/1/0/0.jpg")
+        self.assertStatusCodeEqual(response, 404)
+
+    def testUnknownLayer(self):
+        layer_name = path.make_unique_layer_name(path.AREA, "unknown")
+        response = self.client.get(f"api/wmts/{layer_name}/11/1025/675.png")
+        self.assertStatusCodeEqual(response, 404)
+
+
+class WMTSGetCapabilitiesTest(BaseApiTest):
+    DATASETS = [
+        {
+            "ds_id": 2,
+            "is_raster": False,
+            "title": "dataset2",
+        },
+    ]
+
+    PARAMETERS = {
+        "end_at": None,
+        "parameters": {
+            "end_at": None,
+            "fields": [],
+            "levels": [],
+            "is_tiled": False,
+            "start_at": None,
+            "is_raster": False,
+            "variables": [],
+            "time_periods": [],
+            "temporal_granularity": None,
+        },
+        "default_parameters": {},
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            layer_name = path.make_unique_layer_name(path.VECTOR, 2)
+            storage_instance = storage.create(layer_name)
+
+            os.makedirs(storage_instance.get_dir(layer_name))
+
+            with open(storage_instance.get_bbox_file(layer_name), "w") as f:
+                json.dump({"left": 0, "right": 10, "bottom": 40, "top": 50}, f)
+
+    @patch("app.common.client.get_dataset_list", new=Mock(return_value=DATASETS))
+    @patch(
+        "app.common.client.get_parameters",
+        new=Mock(return_value=datasets.convert(PARAMETERS)),
+    )
+    def testCapabilities(self):
+        response = self.client.get(
+            "api/wmts", query_string={"service": "WMTS", "request": "GetCapabilities"}
+        )
+        self.assertStatusCodeEqual(response, 200)
+
+        root = etree.fromstring(response.data)  # nosec
+
+        identifiers = root.findall("wmts:Contents/wmts:Layer/ows:Identifier", NSMAP)
+        self.assertEqual([x.text for x in identifiers], ["vector/2"])
+
+        resource = root.find("wmts:Contents/wmts:Layer/wmts:ResourceURL", NSMAP)
+        self.assertTrue(
+            resource.get("template").endswith(
+                "/api/wmts/vector/2/{TileMatrix}/{TileCol}/{TileRow}.png"
+            )
+        )
+
+        matrices = root.findall(
+            "wmts:Contents/wmts:TileMatrixSet/wmts:TileMatrix", NSMAP
+        )
+        self.assertEqual(len(matrices), self.flask_app.config["WMTS"]["MAX_ZOOM"] + 1)
+
+    def testNoRequest(self):
+        response = self.client.get("api/wmts", query_string={"service": "WMTS"})
+        self.assertStatusCodeEqual(response, 400)
@@ -11,15 +11,12 @@ The three operations defined for a WMS are :
 For more information about the WMS, see https://portal.ogc.org/files/?artifact_id=14416.
 """
 
-import json
-
 from flask import Response, abort, request
 from flask_restx import Namespace, Resource
 
-from app.common import path
 from app.models.wms import utils
 from app.models.wms.capabilities import get_capabilities
-from app.models.wms.map import get_map_image, get_mapnik_map_for_feature_info
+from app.models.wms.map import get_feature_info, get_map_data
 
 api = Namespace("wms", "WMS compatible endpoint")
 
@@ -52,61 +49,39 @@ class WMS(Resource):
         )
 
     def get_capabilities(self, _):
-        capabilities = get_capabilities()
-        if capabilities is None:
+        result = get_capabilities(request.base_url)
+        if result is None:
             abort(404)
 
-        return Response(capabilities, mimetype="text/xml")
+        content, etag = result
+
+        response = Response(content, mimetype="text/xml")
+        response.set_etag(etag)
+        return response.make_conditional(request)
 
     def get_map(self, normalized_args):
         """Return the map."""
-        image = get_map_image(normalized_args)
-        if image is None:
+        result = get_map_data(normalized_args)
+        if result is None:
             abort(404)
 
-        mapnik_format, mime_format = utils.parse_format(normalized_args)
-        return Response(image.tostring(mapnik_format), mimetype=mime_format)
+        content, mime_format = result
+        return Response(content, mimetype=mime_format)
 
     def get_feature_info(self, normalized_args):
         """Implement the GetFeatureInfo entrypoint for the WMS endpoint"""
         # TODO: fix this to output text, xml and json !
         # currently, only support application/json as mimetype
-        if normalized_args["info_format"] != "application/json":
+        if normalized_args.get("info_format") != "application/json":
             abort(400, "this endpoint doesn't support non json return value")
 
-        mp = get_mapnik_map_for_feature_info(normalized_args)
-        if mp is None:
-            abort(404)
-
-        mp.zoom_to_box(utils.parse_envelope(normalized_args))
-
         raw_query_layers = normalized_args.get("query_layers", "")
         query_layers = utils.parse_list(raw_query_layers)
-        if set(query_layers) != {layer.name for layer in mp.layers}:
+        if set(query_layers) != set(utils.parse_layers(normalized_args)):
             abort(400, "Requested layer didnt match the query_layers parameter")
 
-        features = {"features": []}
-        for layerindex, mapnick_layer in enumerate(mp.layers):
-            mapnick_layer.queryable = True
-
-            (type, _, variable, _, _) = path.parse_unique_layer_name(mapnick_layer.name)
-
-            position = utils.parse_position(normalized_args)
-
-            layer_features = []
-            variable_found = None
-
-            featureset = mp.query_map_point(layerindex, position.x, position.y)
-            for feature in featureset:
-                geojson = json.loads(feature.to_geojson())
-                layer_features.append(geojson)
-
-                if (type == path.VECTOR) and not (variable_found):
-                    variable_found = ("properties" in geojson) and (
-                        f"__variable__{variable}" in geojson["properties"]
-                    )
-
-            if (type == path.AREA) or variable_found:
-                features["features"].extend(layer_features)
+        features = get_feature_info(normalized_args)
+        if features is None:
+            abort(404)
 
         return features
@@ -0,0 +1,87 @@
+"""
+The Web Map Tile Service (WMTS) serves the layers as tiles of a fixed grid, instead of
+images of arbitrary bounding boxes like the WMS. The tiles can thus be cached
+efficiently, by the api but also by nginx, a CDN or the browsers.
+(source : https://www.ogc.org/standards/wmts)
+
+Two operations are available:
+* GetCapabilities: /wmts?service=WMTS&request=GetCapabilities
+* GetTile, in the REST style of XYZ tiles: /wmts/<layer>/<z>/<x>/<y>.png, for a
+  256x256 tile, or /wmts/<layer>/<z>/<x>/<y>@2x.png for a 512x512 (high resolution)
+  version of the same tile
+"""
+
+import hashlib
+import re
+
+from flask import Response, abort, current_app, request
+from flask_restx import Namespace, Resource
+
+from app.models.wms import grid, tile_cache, wmts
+from app.models.wms.map import get_map_data
+
+api = Namespace("wmts", "WMTS compatible endpoint")
+
+TILE_REGEX = re.compile(r"^(\d+)(@2x)?\.png$")
+
+
+@api.route("")
+class WMTS(Resource):
+    def get(self):
+        normalized_args = {k.lower(): v for k, v in request.args.items()}
+
+        request_name = normalized_args.get("request")
+
+        if request_name == "GetCapabilities":
+            capabilities = wmts.get_capabilities(request.base_url)
+            if capabilities is None:
+                abort(404)
+
+            return Response(capabilities, mimetype="text/xml")
+
+        return abort(
+            400,
+            "Couldn't find the requested method {}, "
+            "request parameter needs to be set".format(request_name),
+        )
+
+
+@api.route("/<path:layer_name>/<int:z>/<int:x>/<string:tile>")
+class Tile(Resource):
+    def get(self, layer_name, z, x, tile):
+        """Return a tile of a layer"""
+        match = TILE_REGEX.match(tile)
+        if match is None:
+            abort(404)
+
+        y = int(match.group(1))
+        tile_size = grid.TILE_SIZE * (2 if match.group(2) is not None else 1)
+
+        if (z > current_app.config["WMTS"]["MAX_ZOOM"]) or (max(x, y) >= 2 ** z):
+            abort(404)
+
+        args = grid.get_getmap_args(layer_name, z, x, y, tile_size=tile_size)
+
+        # The key of the tile in the cache depends on the version of the layer, so it
+        # can be used as a strong ETag, checked before rendering anything
+        etag = tile_cache.make_key(args)
+        if (etag is not None) and request.if_none_match.contains(etag):
+            return self.make_response(Response(status=304), etag)
+
+        result = get_map_data(args)
+        if result is None:
+            abort(404)
+
+        content, mime_format = result
+
+        if etag is None:
+            etag = hashlib.sha256(content).hexdigest()
+
+        response = self.make_response(Response(content, mimetype=mime_format), etag)
+        return response.make_conditional(request)
+
+    def make_response(self, response, etag):
+        response.set_etag(etag)
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config["WMTS"]["MAX_AGE"]
+        return response
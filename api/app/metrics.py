@@ -0,0 +1,28 @@
+"""Counters of the caches and of the requests to the datasets server, to monitor
+their efficiency.
+
+The counters are kept by each worker process: the values returned are the ones of
+the worker handling the request, identified by its pid.
+"""
+import os
+
+from flask import Blueprint, jsonify
+
+from app.common import client, file_cache, metadata_cache
+from app.models.wms import registry, tile_cache
+
+metrics = Blueprint("metrics", __name__)
+
+
+@metrics.route("/metrics")
+def get_metrics():
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "datasets_server": client.get_stats(),
+            "metadata_cache": metadata_cache.get_stats(),
+            "file_cache": file_cache.get_stats(),
+            "tile_cache": tile_cache.get_stats(),
+            "registry": registry.get_stats(),
+        }
+    )
@@ -7,6 +7,8 @@ import json
 import logging
 import os
 import re
+import threading
+import time
 from typing import Dict, Text
 
 import kombu
@@ -20,12 +22,40 @@ INFO_STRING = re.compile("^" + TASK_MATCH + " " + CM_INFO_MATCH + "$")
 DEFAULT_BROKER = "redis://localhost"
 DEFAULT_BACKEND = "redis://localhost"
 
+# Maximal duration (in seconds) of a wait of wait_for_task() without checking the
+# status of the task, in case the notification of its change was missed
+STATUS_CHECK_INTERVAL = 5
+
+# Maximal duration (in seconds) of a wait for a message by the thread of TaskWatcher,
+# before updating its subscriptions
+LISTEN_TIMEOUT = 0.5
+
+_celery_app = None
+_celery_app_pid = None
+_celery_app_lock = threading.Lock()
+
+_task_watcher = None
+
 
 def get_celery_app():
-    """Return an instance of a celery application using either the
-    default settings taken from DEFAULT_* in this module scope or from the
-    corresponding environment variables.
+    """Return the celery application of the current process, created on first use
+    using either the default settings taken from DEFAULT_* in this module scope or
+    from the corresponding environment variables. Sharing it allows the requests to
+    reuse the connections to the broker and to the result backend.
     """
+    global _celery_app, _celery_app_pid, _task_watcher
+
+    # Connections can't be shared with the parent process
+    with _celery_app_lock:
+        if (_celery_app is None) or (_celery_app_pid != os.getpid()):
+            _celery_app = _create_celery_app()
+            _celery_app_pid = os.getpid()
+            _task_watcher = None
+
+        return _celery_app
+
+
+def _create_celery_app():
     broker = os.environ.get("CELERY_BROKER_URL", DEFAULT_BROKER)
     backend = os.environ.get("CELERY_RESULT_BACKEND", DEFAULT_BACKEND)
     app = Celery(broker=broker, backend=backend)
@@ -52,6 +82,152 @@ def task_by_id(task_id, cm_name):
     return res
 
 
+def get_task_result(task):
+    """Return the result of a finished task, or raise the exception it failed with.
+
+    Unlike AsyncResult.get(), this only reads the result stored in the backend, without
+    subscribing to it through the result consumer of celery.
+    """
+    result = task.result
+    if isinstance(result, Exception):
+        raise result
+
+    return result
+
+
+def wait_for_task(task, timeout):
+    """Wait until the status of a task changes, or the timeout (in seconds) expires.
+    The thread is woken up by the notification published by the result backend
+    (see TaskWatcher), the status being also checked regularly in case it is missed.
+    """
+    deadline = time.monotonic() + timeout
+    status = task.status
+
+    with get_task_watcher().watch(task.id) as event:
+        while task.status == status:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            event.wait(min(remaining, STATUS_CHECK_INTERVAL))
+            event.clear()
+
+
+def get_task_watcher():
+    """Return the TaskWatcher of the current process"""
+    global _task_watcher
+
+    app = get_celery_app()
+
+    with _celery_app_lock:
+        if _task_watcher is None:
+            _task_watcher = TaskWatcher(app.backend)
+
+        return _task_watcher
+
+
+class TaskWatcher:
+    """Notify the threads waiting for a change of the status of tasks.
+
+    The redis result backend publishes each new state of a task on a channel named
+    after the key of its result. A single thread per process, with a single
+    connection, subscribes to the channels of the tasks watched by all the requests
+    of the process and wakes them up.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._events = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, task_id):
+        """Return a context manager yielding an event set whenever the status of the
+        task changes, while the context is active
+        """
+        return _TaskWatch(self, self.backend.get_key_for_task(task_id))
+
+    def _add(self, channel, event):
+        with self._condition:
+            self._events.setdefault(channel, set()).add(event)
+
+            if (self._thread is None) or not (self._thread.is_alive()):
+                self._thread = threading.Thread(
+                    target=self._run, name="TaskWatcher", daemon=True
+                )
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _remove(self, channel, event):
+        with self._condition:
+            events = self._events.get(channel)
+            if events is not None:
+                events.discard(event)
+                if len(events) == 0:
+                    del self._events[channel]
+
+    def _run(self):
+        pubsub = None
+        subscribed = set()
+
+        while True:
+            with self._condition:
+                while (len(self._events) == 0) and (len(subscribed) == 0):
+                    self._condition.wait()
+
+                channels = set(self._events.keys())
+
+            try:
+                if pubsub is None:
+                    pubsub = self.backend.client.pubsub(ignore_subscribe_messages=True)
+
+                if len(channels - subscribed) > 0:
+                    pubsub.subscribe(*(channels - subscribed))
+
+                if len(subscribed - channels) > 0:
+                    pubsub.unsubscribe(*(subscribed - channels))
+
+                subscribed = channels
+
+                if len(subscribed) == 0:
+                    continue
+
+                message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+            except redis.exceptions.RedisError as err:
+                # The waiting threads keep checking the status of their task
+                logging.error("Connection to the result backend failed: %s", err)
+
+                if pubsub is not None:
+                    pubsub.reset()
+
+                pubsub = None
+                subscribed = set()
+                time.sleep(LISTEN_TIMEOUT)
+                continue
+
+            if (message is None) or (message["type"] != "message"):
+                continue
+
+            with self._condition:
+                for event in self._events.get(message["channel"], ()):
+                    event.set()
+
+
+class _TaskWatch:
+    def __init__(self, watcher, channel):
+        self.watcher = watcher
+        self.channel = channel
+        self.event = threading.Event()
+
+    def __enter__(self):
+        self.watcher._add(self.channel, self.event)
+        return self.event
+
+    def __exit__(self, *args):
+        self.watcher._remove(self.channel, self.event)
+
+
 class CalculationModule:
     """This class describes a remote long running task, also called a
     calculation module.
@@ -1,28 +1,69 @@
 """Description of each set of gis informations.
 
-Modification of layer are made quite slow, so we don't
-really prevent race condition on list vs delete. We
-also catch those on accessing the layer.
-
+The layers are rebuilt in a new version of their directory, published atomically
+once complete (see publish_layer_update()), so the requests never see a partially
+written layer.
 """
+import glob
 import json
+import math
 import os
 import shutil
+import socket
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from pathlib import Path
 from tempfile import TemporaryDirectory, mkdtemp
 
+import gdal
 import mapnik
+import numpy
 import ogr
 import osr
 from flask import current_app, safe_join
 from PIL import Image
 
 import app.common.projection as project
-from app.common import path
+from app.common import file_cache, path, spatial_index
 
 from . import storage
 
+# Name of the layer of the GeoPackage files containing the features of the vector layers
+GEOPACKAGE_LAYER = "features"
+
+# Name of the column of the GeoPackage files holding the feature ids, chosen to not
+# conflict with the properties of the features (which often contain a "fid")
+GEOPACKAGE_FID = "__fid__"
+
+# Maximal number of raster files kept open by each worker process to read the value
+# of their pixels
+MAX_OPEN_RASTERS = 32
+
+_open_rasters = OrderedDict()
+_open_rasters_lock = threading.Lock()
+
+# Age (in seconds) after which the versions of the layers left unpublished by the
+# processes of other hosts are deleted
+STAGING_MAX_AGE = 7 * 24 * 3600
+
+# Serializes the publications of the layers by the threads of the cache builder, as
+# the publication of a layer copies the links to the layers nested in it
+_publish_lock = threading.Lock()
+
+# Number of buckets of the histograms of the values of the raster layers, and number
+# of rows of pixels read at once to compute them
+STATISTICS_BUCKETS = 32
+STATISTICS_BLOCK_ROWS = 256
+
+# Tolerances (in degrees) of the simplified versions of the GeoPackage files of the
+# vector layers, from the coarsest to the finest. They are roughly half of the size of
+# a pixel of the tiles at the zoom levels 4, 7 and 10: a version is used to render the
+# images whose pixels are at least twice as big as its tolerance.
+GEOPACKAGE_GENERALIZATIONS = [0.04, 0.005, 0.0006]
+
 
 def load(name):
     """Create a new instance of RasterLayer based on its name"""
@@ -38,49 +79,58 @@ def load(name):
 
 
 def save_vector_geojson(layer_name, geojson):
+    return save_vector_features(layer_name, geojson["features"])
+
+
+def save_vector_features(layer_name, features):
+    """Save the features of a vector layer, given as an iterable. They are written to
+    the disk one by one, so they don't need to be all in memory at the same time
+    (for instance when yielded by client.iter_geojson_features()).
+    """
     type = path.get_type(layer_name)
     storage_instance = storage.create_for_layer_type(type)
 
-    # Processing
     valid_variables = []
 
-    filtered_features = []
-    for i in range(len(geojson["features"])):
-        feature = geojson["features"][i]
-
-        if (
-            ("geometry" in feature)
-            and (feature["geometry"] is not None)
-            and (len(feature["geometry"]["coordinates"]) == 0)
-        ):
-            break
+    # Save the files
+    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
+        tmp_filepath = safe_join(tmp_dir, storage_instance.GEOJSON_FILENAME)
+        proj_filepath = safe_join(tmp_dir, storage_instance.PROJECTION_FILENAME)
+        variables_filepath = safe_join(tmp_dir, storage_instance.VARIABLES_FILENAME)
 
-        properties = feature["properties"]
+        nb_features = 0
 
-        # Retrieve the list of variable names
-        for variable, value in properties["variables"].items():
-            if (variable not in valid_variables) and (value is not None):
-                valid_variables.append(variable)
+        with open(tmp_filepath, "w") as f:
+            f.write('{"type": "FeatureCollection", "features": [')
+
+            for feature in features:
+                if (
+                    ("geometry" in feature)
+                    and (feature["geometry"] is not None)
+                    and (len(feature["geometry"]["coordinates"]) == 0)
+                ):
+                    break
 
-        # Delete the legend (we don't need it)
-        del properties["legend"]
+                _process_vector_feature(feature, valid_variables)
 
-        # Add the variable values as keys accessible by mapnik
-        for variable, value in properties["variables"].items():
-            properties[f"__variable__{variable}"] = value
+                if nb_features > 0:
+                    f.write(", ")
 
-        filtered_features.append(feature)
+                f.write(json.dumps(feature))
+                nb_features += 1
 
-    geojson["features"] = filtered_features
+            f.write("]}")
 
-    # Save the files
-    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
-        tmp_filepath = safe_join(tmp_dir, storage_instance.GEOJSON_FILENAME)
-        proj_filepath = safe_join(tmp_dir, storage_instance.PROJECTION_FILENAME)
-        variables_filepath = safe_join(tmp_dir, storage_instance.VARIABLES_FILENAME)
+        # The GeoPackage is the file actually read by mapnik: unlike the GeoJSON one,
+        # it doesn't need to be parsed entirely in each worker process, and its
+        # spatial index allows to only read the features needed by a query
+        if nb_features > 0:
+            geopackage_filepath = safe_join(
+                tmp_dir, storage_instance.GEOPACKAGE_FILENAME
+            )
 
-        with open(tmp_filepath, "w") as f:
-            f.write(json.dumps(geojson))
+            if build_geopackage(tmp_filepath, geopackage_filepath):
+                build_generalizations(geopackage_filepath)
 
         with open(proj_filepath, "w") as fd:
             fd.write(
@@ -142,6 +192,151 @@ def save_vector_geojson(layer_name, geojson):
     return valid_variables
 
 
+def _process_vector_feature(feature, valid_variables):
+    """Prepare the properties of a feature to be used by mapnik, and add its
+    variables to the list of valid ones
+    """
+    properties = feature["properties"]
+
+    # The features without variable might have none instead of an empty object
+    if properties.get("variables") is None:
+        properties["variables"] = {}
+
+    # Retrieve the list of variable names
+    for variable, value in properties["variables"].items():
+        if (variable not in valid_variables) and (value is not None):
+            valid_variables.append(variable)
+
+    # Delete the legend (we don't need it)
+    del properties["legend"]
+
+    # Add the variable values as keys accessible by mapnik
+    for variable, value in properties["variables"].items():
+        properties[f"__variable__{variable}"] = value
+
+
+def build_geopackage(source_filename, target_filename, tolerance=None):
+    """Convert a GeoJSON file into a GeoPackage file with a spatial index. If a
+    tolerance is given, the geometries are simplified (preserving their topology).
+    Return False if the conversion failed.
+    """
+    # GDAL 3.0 has no keyword argument for the simplification
+    options = []
+    if tolerance is not None:
+        options = ["-simplify", repr(tolerance)]
+
+    dataset = gdal.VectorTranslate(
+        target_filename,
+        source_filename,
+        options=options,
+        format="GPKG",
+        layerName=GEOPACKAGE_LAYER,
+        layerCreationOptions=["SPATIAL_INDEX=YES", f"FID={GEOPACKAGE_FID}"],
+    )
+
+    if dataset is None:
+        print(f"Failed to convert '{source_filename}' to a GeoPackage file")
+        if os.path.exists(target_filename):
+            os.remove(target_filename)
+        return False
+
+    # Flush the file
+    dataset = None
+
+    return True
+
+
+def build_generalizations(geopackage_filename):
+    """Build the simplified versions of a GeoPackage file, next to it (see
+    GEOPACKAGE_GENERALIZATIONS). Nothing is done for the layers made of points, which
+    can't be simplified.
+    """
+    dataset = ogr.Open(geopackage_filename)
+    if dataset is None:
+        return
+
+    geometry_type = ogr.GT_Flatten(dataset.GetLayer(0).GetGeomType())
+    dataset = None
+
+    if geometry_type in (ogr.wkbPoint, ogr.wkbMultiPoint):
+        return
+
+    for index, tolerance in enumerate(GEOPACKAGE_GENERALIZATIONS):
+        build_geopackage(
+            geopackage_filename,
+            geopackage_filename.replace(".gpkg", f".{index}.gpkg"),
+            tolerance=tolerance,
+        )
+
+
+def read_raster_value(filename, x, y):
+    """Return the value of the pixel of the first band of a raster file at a
+    position (in the projection of the file), or None if there is no data there
+    """
+    dataset = _open_raster(filename)
+    if dataset is None:
+        return None
+
+    # The GDAL datasets can't be used by several threads at the same time
+    with _open_rasters_lock:
+        (
+            origin_x,
+            pixel_width,
+            _,
+            origin_y,
+            _,
+            pixel_height,
+        ) = dataset.GetGeoTransform()
+
+        column = math.floor((x - origin_x) / pixel_width)
+        row = math.floor((y - origin_y) / pixel_height)
+
+        if not (0 <= column < dataset.RasterXSize) or not (
+            0 <= row < dataset.RasterYSize
+        ):
+            return None
+
+        band = dataset.GetRasterBand(1)
+        value = float(band.ReadAsArray(column, row, 1, 1)[0][0])
+        nodata = band.GetNoDataValue()
+
+    if math.isnan(value) or ((nodata is not None) and (value == nodata)):
+        return None
+
+    return value
+
+
+def _open_raster(filename):
+    """Return the GDAL dataset of a raster file. The datasets are kept open (up to
+    MAX_OPEN_RASTERS of them), and reopened if their file is modified.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+
+    signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    with _open_rasters_lock:
+        entry = _open_rasters.get(filename)
+        if (entry is not None) and (entry[0] == signature):
+            _open_rasters.move_to_end(filename)
+            return entry[1]
+
+        dataset = gdal.Open(filename)
+        if dataset is None:
+            print(f"Failed to open the raster file '{filename}'")
+            return None
+
+        _open_rasters[filename] = (signature, dataset)
+        _open_rasters.move_to_end(filename)
+
+        while len(_open_rasters) > MAX_OPEN_RASTERS:
+            _open_rasters.popitem(last=False)
+
+    return dataset
+
+
 def save_raster_projection(layer_name, projection):
     if (projection is None) or (projection == ""):
         return
@@ -198,7 +393,21 @@ def save_raster_geometries(layer_name, rasters_list):
         target_filename = storage_instance.get_geometries_file(layer_name)
         os.makedirs(os.path.dirname(target_filename), exist_ok=True)
 
+        # Spatial index of the footprints of the raster files (only if all of them
+        # have one)
+        index = spatial_index.index_rings(geometries)
+        index_filename = storage_instance.get_geometries_index_file(layer_name)
+
         try:
+            if index is not None:
+                tmp_index_filepath = safe_join(
+                    tmp_dir, storage_instance.GEOMETRIES_INDEX_FILENAME
+                )
+                index.save(tmp_index_filepath)
+                os.replace(tmp_index_filepath, index_filename)
+            elif os.path.exists(index_filename):
+                os.remove(index_filename)
+
             os.replace(tmp_filepath, target_filename)
         except (FileExistsError, OSError):
             print("Geometries file already exists")
@@ -275,14 +484,193 @@ def save_raster_geometries(layer_name, rasters_list):
             )
 
 
-def save_raster_file(layer_name, feature_id, raster_content):
+# Creation options of the optimized raster files: tiled and compressed GeoTIFF files,
+# with internal overviews (the layout of a Cloud Optimized GeoTIFF)
+OPTIMIZED_RASTER_OPTIONS = [
+    "TILED=YES",
+    "BLOCKXSIZE=512",
+    "BLOCKYSIZE=512",
+    "COMPRESS=DEFLATE",
+    "BIGTIFF=IF_SAFER",
+]
+
+# The nearest neighbour keeps the values of the pixels, which might be classes of the
+# legend
+OVERVIEWS_RESAMPLING = "NEAREST"
+
+
+def _get_overview_levels(dataset):
+    """Return the overview levels of a raster, down to the size of a tile"""
+    levels = []
+    level = 2
+    while max(dataset.RasterXSize, dataset.RasterYSize) / level >= 256:
+        levels.append(level)
+        level *= 2
+
+    return levels
+
+
+def is_optimized_raster_file(filename):
+    """Indicates if a raster file is already tiled, compressed and has overviews"""
+    dataset = gdal.Open(filename)
+    if dataset is None:
+        return False
+
+    band = dataset.GetRasterBand(1)
+    (block_width, block_height) = band.GetBlockSize()
+
+    return (
+        (block_width == block_height)
+        and ("COMPRESSION" in dataset.GetMetadata("IMAGE_STRUCTURE"))
+        and (band.GetOverviewCount() >= len(_get_overview_levels(dataset)))
+    )
+
+
+def optimize_raster_file(filename, tmp_prefix):
+    """Convert a raster file into a tiled and compressed GeoTIFF file with internal
+    overviews, so that a zoomed out view only has to read the overview it needs.
+    Return True on success.
+    """
+    with TemporaryDirectory(prefix=tmp_prefix) as tmp_dir:
+        tiled_filepath = safe_join(tmp_dir, "tiled.tif")
+        optimized_filepath = safe_join(tmp_dir, "optimized.tif")
+
+        # GDAL 3.0 has no COG driver: the overviews are computed in a first copy of
+        # the file, then copied in front of the data by a second one
+        dataset = gdal.Translate(
+            tiled_filepath, filename, creationOptions=OPTIMIZED_RASTER_OPTIONS
+        )
+        if dataset is None:
+            print(f"Failed to optimize '{filename}'")
+            return False
+
+        levels = _get_overview_levels(dataset)
+        if len(levels) > 0:
+            dataset.BuildOverviews(OVERVIEWS_RESAMPLING, levels)
+
+        dataset = None
+
+        dataset = gdal.Translate(
+            optimized_filepath,
+            tiled_filepath,
+            creationOptions=OPTIMIZED_RASTER_OPTIONS + ["COPY_SRC_OVERVIEWS=YES"],
+        )
+        if dataset is None:
+            print(f"Failed to optimize '{filename}'")
+            return False
+
+        dataset = None
+
+        try:
+            os.replace(optimized_filepath, filename)
+        except Exception as e:
+            print(e)
+            return False
+
+    return True
+
+
+def save_raster_mosaic(layer_name):
+    """Build a VRT mosaic (with overviews) of all the raster files of a layer, so that
+    any part of the layer can be rendered from a single GDAL datasource. Return True
+    if the mosaic was created.
+    """
+    storage_instance = storage.create(layer_name)
+
+    geometries = storage_instance.get_geometries(layer_name)
+    if not geometries:
+        return False
+
+    files = [
+        storage_instance.get_file_path(layer_name, feature_id)
+        for feature_id in geometries.keys()
+    ]
+    files = [x for x in files if os.path.exists(x)]
+    if len(files) == 0:
+        return False
+
+    return build_mosaic(
+        files,
+        storage_instance.get_mosaic_file(layer_name),
+        storage_instance.get_tmp_dir(),
+    )
+
+
+def build_mosaic(files, target_filename, tmp_prefix):
+    """Build a VRT mosaic (with overviews) of a list of raster files. Return True on
+    success.
+    """
+    with TemporaryDirectory(prefix=tmp_prefix) as tmp_dir:
+        tmp_filepath = safe_join(tmp_dir, os.path.basename(target_filename))
+
+        dataset = gdal.BuildVRT(tmp_filepath, files)
+        if dataset is None:
+            print(f"Failed to create the mosaic '{target_filename}'")
+            return False
+
+        levels = _get_overview_levels(dataset)
+        if len(levels) > 0:
+            dataset.BuildOverviews(OVERVIEWS_RESAMPLING, levels)
+
+        dataset = None
+
+        try:
+            if os.path.exists(tmp_filepath + ".ovr"):
+                os.replace(tmp_filepath + ".ovr", target_filename + ".ovr")
+            elif os.path.exists(target_filename + ".ovr"):
+                os.remove(target_filename + ".ovr")
+
+            os.replace(tmp_filepath, target_filename)
+        except Exception as e:
+            print(e)
+            return False
+
+    return True
+
+
+def save_raster_file(layer_name, feature_id, raster_content, optimize=False):
     storage_instance = storage.create_for_layer_type(path.RASTER)
-    return _save_raster_file(storage_instance, layer_name, feature_id, raster_content)
+    return _save_raster_file(
+        storage_instance, layer_name, feature_id, raster_content, optimize=optimize
+    )
+
+
+def move_raster_file(layer_name, feature_id, filename, optimize=False):
+    """Add a raster file already written on disk (for instance downloaded by
+    client.get_raster_file()) to a raster layer. The file is moved, so it must be on
+    the same filesystem as the layer, like the temporary directory of the storage.
+    """
+    storage_instance = storage.create_for_layer_type(path.RASTER)
+    return _move_raster_file(
+        storage_instance, layer_name, feature_id, filename, optimize=optimize
+    )
+
+
+def link_raster_file(layer_name, feature_id, source_filename):
+    """Add an existing raster file (for instance from the previous version of the
+    layer) to a raster layer, without copying it if possible. Return False if the file
+    doesn't exist.
+    """
+    if not os.path.exists(source_filename):
+        return False
+
+    storage_instance = storage.create_for_layer_type(path.RASTER)
+
+    target_filename = storage_instance.get_file_path(layer_name, feature_id)
+    os.makedirs(os.path.dirname(target_filename), exist_ok=True)
+
+    _link_file(source_filename, target_filename)
+
+    return True
 
 
 def save_cm_file(layer_name, feature_id, raster_content):
     storage_instance = storage.create_for_layer_type(path.CM)
-    return _save_raster_file(storage_instance, layer_name, feature_id, raster_content)
+    if not _save_raster_file(storage_instance, layer_name, feature_id, raster_content):
+        return False
+
+    update_layer_version(layer_name)
+    return True
 
 
 def save_cm_result(layer_name, result):
@@ -296,63 +684,212 @@ def save_cm_parameters(layer_name, parameters):
 def get_cm_legend(layer_name):
     storage_instance = storage.create_for_layer_type(path.CM)
 
-    filename = storage_instance.get_file_path(layer_name, "result.json")
-    if not os.path.exists(filename):
+    result = file_cache.get_json(
+        storage_instance.get_file_path(layer_name, "result.json")
+    )
+    if result is None:
         return None
 
-    with open(filename, "r") as f:
-        result = json.load(f)
-
     if "legend" in result:
         return result["legend"]
 
     return None
 
 
-def _save_raster_file(storage_instance, layer_name, feature_id, raster_content):
-    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
-        subfolder = os.path.dirname(feature_id)
-        if len(subfolder) > 0:
-            os.makedirs(safe_join(tmp_dir, subfolder), exist_ok=True)
+def save_layer_legends(layer_name, legends, statistics=None):
+    """Save the legends of a layer (indexed by variable, "" being used when no
+    variable is specified), along with the statistics of its values, in the legend
+    file read when the layer is rendered. Return False if the file couldn't be
+    written.
+    """
+    storage_instance = storage.create(layer_name)
+    return _save_layer_json(
+        storage_instance.get_legend_file(layer_name),
+        {"legends": legends, "statistics": statistics},
+    )
+
+
+def save_layer_manifest(layer_name, manifest):
+    """Save the manifest of a layer, describing the upstream data it was built from
+    (see commands/cache.py). Return False if the file couldn't be written.
+    """
+    storage_instance = storage.create(layer_name)
+    return _save_layer_json(storage_instance.get_manifest_file(layer_name), manifest)
+
+
+def _save_layer_json(target_filename, content):
+    target_folder = os.path.dirname(target_filename)
+    if not os.path.exists(target_folder):
+        return False
+
+    tmp_filepath = safe_join(target_folder, f".{uuid.uuid4().hex}.tmp")
+    with open(tmp_filepath, "w") as f:
+        json.dump(content, f)
+
+    os.replace(tmp_filepath, target_filename)
+
+    return True
+
+
+def get_layer_legend(layer_name):
+    """Return the legend of a (vector or raster) layer saved in its legend file, or
+    None if there is none
+    """
+    storage_instance = storage.create(layer_name)
+
+    content = storage_instance.get_legends(layer_name)
+    if content is None:
+        return None
+
+    (_, _, variable, _, _) = path.parse_unique_layer_name(layer_name)
+
+    return content["legends"].get(variable or "")
+
+
+def has_layer_legends(layer_name):
+    """Indicates if the legend file of a (vector or raster) layer exists. The layers
+    cached before the legends were saved beside their data have none.
+    """
+    storage_instance = storage.create(layer_name)
+    return storage_instance.get_legends(layer_name) is not None
+
+
+def get_layer_statistics(layer_name):
+    """Return the statistics of the values of a raster layer saved in its legend
+    file, or None if there are none
+    """
+    storage_instance = storage.create(layer_name)
+
+    content = storage_instance.get_legends(layer_name)
+    if content is None:
+        return None
+
+    return content["statistics"]
+
+
+def compute_raster_statistics(layer_name, nb_buckets=STATISTICS_BUCKETS):
+    """Return the minimal and maximal values of the pixels of the raster files of a
+    layer, along with their number and histogram, or None if no pixel has a value.
+
+    The files are read by blocks of rows, so they don't need to fit in memory.
+    """
+    layer = load(layer_name)
+
+    filenames = [
+        raster_path
+        for _, raster_path in layer.get_rasters_in_bbox(None, None)
+        if os.path.exists(raster_path)
+    ]
+
+    min_value = None
+    max_value = None
+    count = 0
+
+    for filename in filenames:
+        for values in _iter_raster_values(filename):
+            block_min = float(values.min())
+            block_max = float(values.max())
+
+            min_value = block_min if min_value is None else min(min_value, block_min)
+            max_value = block_max if max_value is None else max(max_value, block_max)
+            count += values.size
+
+    if count == 0:
+        return None
+
+    histogram = numpy.zeros(nb_buckets, dtype=numpy.int64)
+    for filename in filenames:
+        for values in _iter_raster_values(filename):
+            histogram += numpy.histogram(
+                values, bins=nb_buckets, range=(min_value, max_value)
+            )[0]
+
+    return {
+        "min": min_value,
+        "max": max_value,
+        "count": count,
+        "histogram": [int(x) for x in histogram],
+    }
+
+
+def _iter_raster_values(filename):
+    """Yield the values of the pixels of the first band of a raster file, by blocks
+    of rows, ignoring the pixels without data
+    """
+    dataset = gdal.Open(filename)
+    if dataset is None:
+        print(f"Failed to open the raster file '{filename}'")
+        return
+
+    band = dataset.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
 
-        tmp_filepath = safe_join(tmp_dir, feature_id)
+    for row in range(0, dataset.RasterYSize, STATISTICS_BLOCK_ROWS):
+        nb_rows = min(STATISTICS_BLOCK_ROWS, dataset.RasterYSize - row)
+        values = band.ReadAsArray(0, row, dataset.RasterXSize, nb_rows).ravel()
+
+        values = values[numpy.isfinite(values)]
+        if nodata is not None:
+            values = values[values != nodata]
+
+        # Some raster files use the maximal value for a float32 as a "no data" value
+        values = values[values < 3.4e38]
+
+        if values.size > 0:
+            yield values
+
+
+def _save_raster_file(
+    storage_instance, layer_name, feature_id, raster_content, optimize=False
+):
+    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
+        tmp_filepath = safe_join(tmp_dir, os.path.basename(feature_id))
 
         with open(tmp_filepath, "wb") as f:
             f.write(raster_content)
 
-        # For CMs: extract the projection form the raster file
-        proj_filepath = None
-        if path.get_type(layer_name) == path.CM:
-            projection = project.proj4_from_geotiff(tmp_filepath)
-            if projection is None:
-                return False
+        return _move_raster_file(
+            storage_instance, layer_name, feature_id, tmp_filepath, optimize=optimize
+        )
 
-            proj_filepath = tmp_filepath.replace(".tif", ".prj")
-            with open(proj_filepath, "w") as f:
-                f.write(projection)
 
-        target_folder = storage_instance.get_dir(layer_name)
-        if len(subfolder) > 0:
-            target_folder = safe_join(target_folder, subfolder)
+def _move_raster_file(storage_instance, layer_name, feature_id, filename, optimize):
+    if optimize and not optimize_raster_file(filename, storage_instance.get_tmp_dir()):
+        return False
 
-        os.makedirs(target_folder, exist_ok=True)
+    # For CMs: extract the projection form the raster file
+    proj_filepath = None
+    if path.get_type(layer_name) == path.CM:
+        projection = project.proj4_from_geotiff(filename)
+        if projection is None:
+            return False
 
-        try:
+        proj_filepath = filename.replace(".tif", ".prj")
+        with open(proj_filepath, "w") as f:
+            f.write(projection)
+
+    target_folder = storage_instance.get_dir(layer_name)
+
+    subfolder = os.path.dirname(feature_id)
+    if len(subfolder) > 0:
+        target_folder = safe_join(target_folder, subfolder)
+
+    os.makedirs(target_folder, exist_ok=True)
+
+    try:
+        os.replace(filename, storage_instance.get_file_path(layer_name, feature_id))
+
+        if proj_filepath is not None:
             os.replace(
-                tmp_filepath, storage_instance.get_file_path(layer_name, feature_id)
+                proj_filepath,
+                storage_instance.get_projection_file(layer_name, feature_id),
             )
-
-            if proj_filepath is not None:
-                os.replace(
-                    proj_filepath,
-                    storage_instance.get_projection_file(layer_name, feature_id),
-                )
-        except (FileExistsError, OSError):
-            print("Raster file already exists")
-            return False
-        except Exception as e:
-            print(e)
-            return False
+    except (FileExistsError, OSError):
+        print("Raster file already exists")
+        return False
+    except Exception as e:
+        print(e)
+        return False
 
     return True
 
@@ -380,16 +917,263 @@ def _save_cm_json(layer_name, filename, data):
     return True
 
 
-def delete_all_features(layer_name):
+def get_layer_version(layer_name):
+    """Return the version stamp of a layer, or None if the layer doesn't have one
+    (either because it doesn't exist or because it was written before the stamps
+    were introduced).
+    """
+    storage_instance = storage.create(layer_name)
+    if storage_instance is None:
+        return None
+
+    try:
+        with open(storage_instance.get_version_file(layer_name), "r") as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+
+    if len(version) == 0:
+        return None
+
+    return version
+
+
+def update_layer_version(layer_name):
+    """Give a new version stamp to a layer. This must be called each time the files
+    of a layer are (re)written, so that everything derived from the previous version
+    of the layer (like the rendered images) isn't used anymore.
+    """
+    storage_instance = storage.create(layer_name)
+
+    target_filename = storage_instance.get_version_file(layer_name)
+    target_folder = os.path.dirname(target_filename)
+    if not os.path.exists(target_folder):
+        return None
+
+    version = uuid.uuid4().hex
+
+    tmp_filepath = safe_join(target_folder, f".{version}.tmp")
+    with open(tmp_filepath, "w") as f:
+        f.write(version)
+
+    os.replace(tmp_filepath, target_filename)
+
+    return version
+
+
+def touch_cm_layer(layer_name):
+    """Sets the modification and access times of the files of a CM layer to the
+    current time of day, to prevent them from being deleted while they are in use
+    """
+    storage_instance = storage.create_for_layer_type(path.CM)
+
+    if not os.path.exists(storage_instance.get_dir(layer_name)):
+        return
+
+    for feature_id in storage_instance.list_feature_ids(layer_name):
+        Path(storage_instance.get_file_path(layer_name, feature_id)).touch()
+
+
+def begin_layer_update(layer_name, copy=False):
+    """Start to rebuild a layer: until publish_layer_update() or abort_layer_update()
+    is called, all the files of the layer are read from and written to a new version
+    of the layer by the current process, while the other processes keep using the
+    current version.
+
+    The new version is empty, unless copy is True: it then starts with the files of
+    the current version (hard-linked, so they must be replaced and not modified in
+    place).
+
+    Return the directory of the current version of the layer.
+    """
+    storage_instance = storage.create(layer_name)
+
+    folder = storage_instance.get_published_dir(layer_name)
+
+    versions_dir = storage_instance.get_versions_dir()
+    os.makedirs(versions_dir, exist_ok=True)
+
+    staging_dir = os.path.realpath(mkdtemp(dir=versions_dir))
+    os.chmod(staging_dir, 0o755)
+
+    # Identifies the process building the version, in case it never publishes it
+    with open(f"{staging_dir}.staging", "w") as f:
+        f.write(f"{socket.gethostname()} {os.getpid()}")
+
+    if copy and os.path.exists(folder):
+        current_dir = os.path.realpath(folder)
+        for name in os.listdir(current_dir):
+            _copy_layer_entry(
+                safe_join(current_dir, name), safe_join(staging_dir, name)
+            )
+
+    storage.set_staging_dir(folder, staging_dir)
+
+    return folder
+
+
+def publish_layer_update(layer_name):
+    """Replace the current version of a layer by the one built in its staging
+    directory.
+
+    The directory of a layer is a symbolic link to its current version, replaced
+    atomically by a link to the new version, so the other processes never see a
+    partially written layer. The previous version is kept during a grace period (see
+    collect_layer_versions()), so the requests which resolved the link before it was
+    replaced can still read it until they finish.
+    """
+    storage_instance = storage.create(layer_name)
+
+    folder = storage_instance.get_published_dir(layer_name)
+    staging_dir = storage.get_staging_dir(folder)
+    if staging_dir is None:
+        return False
+
+    storage.set_staging_dir(folder, None)
+
+    versions_dir = storage_instance.get_versions_dir()
+
+    with _publish_lock:
+        os.makedirs(os.path.dirname(folder), exist_ok=True)
+
+        previous_dir = None
+        if os.path.lexists(folder):
+            previous_dir = os.path.realpath(folder)
+
+            # Keep the layers nested in the directory of the layer (for instance the
+            # time periods of a dataset) and the files of the dataset
+            for name in os.listdir(previous_dir):
+                if (name in storage_instance.DATASET_FILENAMES) or os.path.isdir(
+                    safe_join(previous_dir, name)
+                ):
+                    _copy_layer_entry(
+                        safe_join(previous_dir, name), safe_join(staging_dir, name)
+                    )
+
+            # Layer cached before the versioning of the layers: a directory can't be
+            # atomically replaced by a link, so it is moved with the other versions
+            if not os.path.islink(folder):
+                previous_dir = safe_join(versions_dir, uuid.uuid4().hex)
+                os.rename(folder, previous_dir)
+
+        link = safe_join(os.path.dirname(folder), f".{uuid.uuid4().hex}.tmp")
+        os.symlink(
+            os.path.relpath(staging_dir, os.path.realpath(os.path.dirname(folder))),
+            link,
+        )
+        os.replace(link, folder)
+
+        if previous_dir is not None:
+            Path(f"{previous_dir}.retired").touch()
+
+        _remove_file(f"{staging_dir}.staging")
+
+    collect_layer_versions(layer_name)
+
+    return True
+
+
+def abort_layer_update(layer_name):
+    """Discard the version of a layer built in its staging directory, keeping the
+    current one
+    """
     storage_instance = storage.create(layer_name)
 
-    folder = storage_instance.get_dir(layer_name, cache=True)
-    if not os.path.exists(folder):
+    folder = storage_instance.get_published_dir(layer_name)
+    staging_dir = storage.get_staging_dir(folder)
+    if staging_dir is None:
         return
 
-    with TemporaryDirectory(prefix=storage_instance.get_tmp_dir()) as tmp_dir:
-        os.rename(folder, tmp_dir)
-        shutil.rmtree(tmp_dir)
+    storage.set_staging_dir(folder, None)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    _remove_file(f"{staging_dir}.staging")
+
+
+def collect_layer_versions(layer_name, grace_period=None):
+    """Delete the previous versions of the layers (of the same storage as the given
+    one) replaced for longer than the grace period, in seconds (by default the one
+    of the configuration), and the versions left unpublished by a process that
+    doesn't exist anymore.
+    """
+    storage_instance = storage.create(layer_name)
+
+    if grace_period is None:
+        grace_period = current_app.config["CACHE"]["VERSIONS_GRACE_PERIOD"]
+
+    limit = time.time() - grace_period
+
+    versions_dir = storage_instance.get_versions_dir()
+
+    for marker in glob.glob(safe_join(versions_dir, "*.retired")):
+        try:
+            if os.path.getmtime(marker) > limit:
+                continue
+        except FileNotFoundError:
+            # Collected by another process
+            continue
+
+        shutil.rmtree(marker[: -len(".retired")], ignore_errors=True)
+        _remove_file(marker)
+
+    for marker in glob.glob(safe_join(versions_dir, "*.staging")):
+        if _is_staging_abandoned(marker):
+            shutil.rmtree(marker[: -len(".staging")], ignore_errors=True)
+            _remove_file(marker)
+
+
+def _is_staging_abandoned(marker):
+    """Indicates if the process building a version of a layer (as written in its
+    marker file) is gone. The processes of other hosts can't be checked, so their
+    versions are considered abandoned after STAGING_MAX_AGE seconds.
+    """
+    try:
+        with open(marker, "r") as f:
+            (hostname, pid) = f.read().split()
+
+        if hostname != socket.gethostname():
+            return os.path.getmtime(marker) < time.time() - STAGING_MAX_AGE
+
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        # Unreadable marker, or process of another user
+        return False
+
+    return False
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+def _copy_layer_entry(source, target):
+    """Copy a file or a directory of a version of a layer into another version,
+    without copying the content of the files if possible. The symbolic links (to the
+    versions of the nested layers) are copied as links to the same target.
+    """
+    if os.path.lexists(target):
+        return
+
+    if os.path.islink(source):
+        link_target = os.path.join(os.path.dirname(source), os.readlink(source))
+        os.symlink(os.path.relpath(link_target, os.path.dirname(target)), target)
+    elif os.path.isdir(source):
+        os.mkdir(target)
+        for name in os.listdir(source):
+            _copy_layer_entry(safe_join(source, name), safe_join(target, name))
+    else:
+        _link_file(source, target)
+
+
+def _link_file(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
 
 
 class Layer(ABC):
@@ -402,8 +1186,9 @@ class Layer(ABC):
         self.storage = storage
 
     @abstractmethod
-    def get_data_for_bounding_box(self, bbox, bbox_projection):
-        """Get layer-specific data relevant to the provided bounding box.
+    def get_data_for_bounding_box(self, bbox, bbox_projection, size=None):
+        """Get layer-specific data relevant to the provided bounding box, and to the
+        size (in pixels) of the image it will be rendered into, if known.
 
         Consider the data as an opaque array, that can be given to
         'as_mapnik_layers()' later. For example:
@@ -435,10 +1220,62 @@ class Layer(ABC):
 class RasterLayer(Layer):
     @property
     def is_queryable(self):
-        return False
+        return True
+
+    def get_values_at(self, x, y, projection, tolerance=0.0):
+        """Return the values of the pixels found at a position, given in the
+        projection, as a list of (feature id, value) tuples: one for each raster file
+        covering the position and having data there.
 
-    def get_data_for_bounding_box(self, bbox, bbox_projection):
-        return self.get_rasters_in_bbox(bbox, bbox_projection)
+        Only the raster files whose footprint is near the position are opened, and a
+        single pixel is read from each of them.
+        """
+        tolerance = max(tolerance, 1e-6)
+        bbox = mapnik.Box2d(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+
+        type = path.get_type(self.name)
+
+        default_projection = None
+        if type == path.RASTER:
+            default_projection = self.storage.get_projection(self.name)
+            if default_projection is None:
+                default_projection = project.epsg_string_to_proj4(
+                    current_app.config["RASTER_PROJECTION_SYSTEM"]
+                )
+
+        values = []
+        for feature_id, raster_path in self.get_rasters_in_bbox(bbox, projection):
+            if type == path.CM:
+                raster_projection = self.storage.get_projection(self.name, feature_id)
+            else:
+                raster_projection = default_projection
+
+            if raster_projection is None:
+                continue
+
+            transform = mapnik.ProjTransform(
+                mapnik.Projection("+init=" + projection),
+                mapnik.Projection(raster_projection),
+            )
+
+            point = transform.forward(mapnik.Coord(x, y))
+
+            value = read_raster_value(raster_path, point.x, point.y)
+            if value is not None:
+                values.append((feature_id, value))
+
+        return values
+
+    def get_data_for_bounding_box(self, bbox, bbox_projection, size=None):
+        rasters = self.get_rasters_in_bbox(bbox, bbox_projection)
+
+        # When the layer has a mosaic, all the raster files can be rendered at once
+        if len(rasters) > 0:
+            mosaic_filename = self.storage.get_mosaic_file(self.name)
+            if os.path.exists(mosaic_filename):
+                return [(self.storage.MOSAIC_FILENAME, mosaic_filename)]
+
+        return rasters
 
     def as_mapnik_layers(self, data=None):
         """Return the Layer as a list of mapnik layers"""
@@ -582,7 +1419,29 @@ class RasterLayer(Layer):
     def _get_rasters_in_polygons(self, geometries, polygons):
         rasters = []
 
-        for feature_id, coordinates in geometries.items():
+        # Only the raster files whose footprint intersects the bounding box of one of
+        # the polygons need to be checked precisely, in the order of the geometries
+        # file
+        index = self.storage.get_geometries_index(self.name)
+        if index is not None:
+            candidates = {}
+
+            for polygon in polygons:
+                (min_x, max_x, min_y, max_y) = polygon.GetEnvelope()
+                for position, feature_id in index.query((min_x, min_y, max_x, max_y)):
+                    candidates[position] = feature_id
+
+            candidates = [
+                (feature_id, geometries.get(feature_id))
+                for _, feature_id in sorted(candidates.items())
+            ]
+        else:
+            candidates = geometries.items()
+
+        for feature_id, coordinates in candidates:
+            if coordinates is None:
+                continue
+
             raster_ring = ogr.Geometry(ogr.wkbLinearRing)
 
             for p in coordinates:
@@ -605,7 +1464,35 @@ class RasterLayer(Layer):
 class VectorLayer(Layer):
     """Future implementation of a vector layer."""
 
-    def get_data_for_bounding_box(self, bbox, bbox_projection):
+    def get_data_for_bounding_box(self, bbox, bbox_projection, size=None):
+        geographic_bbox = self._to_geographic(bbox, bbox_projection)
+
+        if not self._intersects(geographic_bbox):
+            return []
+
+        # Use the coarsest simplified version of the layer whose tolerance is at most
+        # half of the size of a pixel
+        if (geographic_bbox is not None) and (size is not None) and (size.width > 0):
+            pixel_size = geographic_bbox.width() / size.width
+
+            for index, tolerance in enumerate(GEOPACKAGE_GENERALIZATIONS):
+                if tolerance * 2 > pixel_size:
+                    continue
+
+                geopackage_file = self.storage.get_geopackage_file(
+                    self.name, generalization=index
+                )
+                if os.path.exists(geopackage_file):
+                    return [geopackage_file]
+
+                break
+
+        # Layers cached before the introduction of the GeoPackage files only have
+        # the GeoJSON one
+        geopackage_file = self.storage.get_geopackage_file(self.name)
+        if os.path.exists(geopackage_file):
+            return [geopackage_file]
+
         geojson_file = self.storage.get_geojson_file(self.name)
         if not os.path.exists(geojson_file):
             print(f"GeoJSON file '{geojson_file}' was not found")
@@ -613,6 +1500,39 @@ class VectorLayer(Layer):
 
         return [geojson_file]
 
+    @staticmethod
+    def _to_geographic(bbox, bbox_projection):
+        """Return the bounding box in longitude/latitude, or None if unknown"""
+        if (bbox is None) or (bbox_projection is None):
+            return None
+
+        transform = mapnik.ProjTransform(
+            mapnik.Projection("+init=" + bbox_projection),
+            mapnik.Projection("+init=epsg:4326"),
+        )
+
+        return transform.forward(bbox)
+
+    def _intersects(self, geographic_bbox):
+        """Indicates if the bounding box (in longitude/latitude) might contain
+        features of the layer
+        """
+        if geographic_bbox is None:
+            return True
+
+        layer_bbox = self.storage.get_bbox(self.name)
+        if layer_bbox is None:
+            return True
+
+        return geographic_bbox.intersects(
+            mapnik.Box2d(
+                layer_bbox["left"],
+                layer_bbox["bottom"],
+                layer_bbox["right"],
+                layer_bbox["top"],
+            )
+        )
+
     def as_mapnik_layers(self, data=None):
         if data is None:
             data = self.get_data_for_bounding_box(None, None)
@@ -629,7 +1549,12 @@ class VectorLayer(Layer):
             )
 
         layer = mapnik.Layer(self.name)
-        layer.datasource = mapnik.GeoJSON(file=data[0])
+
+        if data[0].endswith(".gpkg"):
+            layer.datasource = mapnik.Ogr(file=data[0], layer=GEOPACKAGE_LAYER)
+        else:
+            layer.datasource = mapnik.GeoJSON(file=data[0])
+
         layer.srs = projection
         layer.queryable = True
         layer.name = self.name
@@ -643,26 +1568,100 @@ class VectorLayer(Layer):
         """
         return True
 
-    def get_legend_images(self, legend):
-        """Create images containing the colors defined in the legend. The caller is
-        responsible to delete the folder when the images aren't needed anymore.
+    def get_features_at(self, x, y, projection, tolerance=0.0):
+        """Return the features (as GeoJSON dicts) found at a position, given in
+        the projection: the polygons containing it, and the other geometries closer
+        than the tolerance (in units of the projection). Return None if the layer has
+        no data.
+
+        The candidates are retrieved from the spatial index of the GeoPackage file of
+        the layer, so only a few features are read from the disk.
         """
-        images_folder = mkdtemp(prefix=self.storage.get_tmp_dir())
-
-        images = []
-        for index, symbol in enumerate(legend["symbology"]):
-            color = (
-                int(symbol["red"]),
-                int(symbol["green"]),
-                int(symbol["blue"]),
-                int(symbol["opacity"] * 255),
+        data = self.get_data_for_bounding_box(None, None)
+        if len(data) == 0:
+            return None
+
+        layer_projection = self.storage.get_projection(self.name)
+        if layer_projection is None:
+            layer_projection = project.epsg_string_to_proj4(
+                current_app.config["VECTOR_PROJECTION_SYSTEM"]
             )
 
-            filename = safe_join(images_folder, f"{index:02}.png")
+        transform = mapnik.ProjTransform(
+            mapnik.Projection("+init=" + projection),
+            mapnik.Projection(layer_projection),
+        )
+
+        point = transform.forward(mapnik.Coord(x, y))
+        box = transform.forward(
+            mapnik.Box2d(x - tolerance, y - tolerance, x + tolerance, y + tolerance)
+        )
+
+        point_geometry = ogr.Geometry(ogr.wkbPoint)
+        point_geometry.AddPoint_2D(point.x, point.y)
+
+        box_geometry = ogr.CreateGeometryFromWkt(
+            f"POLYGON(({box.minx} {box.miny}, {box.maxx} {box.miny}, "
+            f"{box.maxx} {box.maxy}, {box.minx} {box.maxy}, {box.minx} {box.miny}))"
+        )
+
+        dataset = ogr.Open(data[0])
+        if dataset is None:
+            print(f"Failed to open '{data[0]}'")
+            return None
+
+        ogr_layer = dataset.GetLayer(0)
+        ogr_layer.SetSpatialFilterRect(box.minx, box.miny, box.maxx, box.maxy)
+
+        features = []
+        for feature in ogr_layer:
+            geometry = feature.GetGeometryRef()
+            if geometry is None:
+                continue
+
+            geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+            if geometry_type in (ogr.wkbPolygon, ogr.wkbMultiPolygon):
+                found = geometry.Intersects(point_geometry)
+            else:
+                found = geometry.Intersects(box_geometry)
+
+            if found:
+                features.append(feature.ExportToJson(as_object=True))
+
+        return features
+
+    def get_legend_images(self, legend, legend_hash):
+        """Return the images containing the colors defined in the legend. The images
+        are only created the first time they are needed for a given legend.
+        """
+        images_folder = self.storage.get_legend_images_dir(legend_hash)
+
+        images = [
+            safe_join(images_folder, f"{index:02}.png")
+            for index in range(len(legend["symbology"]))
+        ]
+
+        if os.path.exists(images_folder):
+            return images
+
+        with TemporaryDirectory(prefix=self.storage.get_tmp_dir()) as tmp_dir:
+            for index, symbol in enumerate(legend["symbology"]):
+                color = (
+                    int(symbol["red"]),
+                    int(symbol["green"]),
+                    int(symbol["blue"]),
+                    int(symbol["opacity"] * 255),
+                )
+
+                img = Image.new("RGBA", (4, 4), color=color)
+                img.save(safe_join(tmp_dir, f"{index:02}.png"))
 
-            img = Image.new("RGBA", (4, 4), color=color)
-            img.save(filename)
+            os.makedirs(os.path.dirname(images_folder), exist_ok=True)
 
-            images.append(filename)
+            try:
+                os.replace(tmp_dir, images_folder)
+            except OSError:
+                # Already created by another worker
+                pass
 
-        return (images, images_folder)
+        return images
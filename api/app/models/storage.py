@@ -1,12 +1,52 @@
 import glob
 import io
-import json
 import os
 import zipfile
 
-from flask import current_app, safe_join
+from flask import current_app, g, has_request_context, safe_join
 
-from app.common import path
+from app.common import file_cache, path, spatial_index
+
+# Staging directories of the layers being rebuilt by the current process, indexed by
+# the directory of the layer they will replace: all the files of those layers are read
+# and written in their staging directory until it is published (see
+# geofile.begin_layer_update())
+_staging_dirs = {}
+
+
+def set_staging_dir(folder, staging_dir):
+    if staging_dir is not None:
+        _staging_dirs[folder] = staging_dir
+    else:
+        _staging_dirs.pop(folder, None)
+
+
+def get_staging_dir(folder):
+    return _staging_dirs.get(folder)
+
+
+def _resolve(folder):
+    """Return the directory actually containing the files of a layer: its staging
+    directory if it is being rebuilt by the current process, or else the version of
+    the layer it points to. During a request, the version is resolved only once, so
+    all the files read by the request belong to the same version of the layer even if
+    a new one is published meanwhile (see geofile.publish_layer_update()).
+    """
+    staging_dir = _staging_dirs.get(folder)
+    if staging_dir is not None:
+        return staging_dir
+
+    if not has_request_context():
+        return folder
+
+    pinned_dirs = g.setdefault("pinned_layer_dirs", {})
+
+    resolved = pinned_dirs.get(folder)
+    if resolved is None:
+        resolved = os.path.realpath(folder)
+        pinned_dirs[folder] = resolved
+
+    return resolved
 
 
 def create(layer_name):
@@ -30,7 +70,15 @@ class BaseRasterStorage(object):
 
     PROJECTION_FILENAME = "projection.txt"
     GEOMETRIES_FILENAME = "geometries.json"
+    GEOMETRIES_INDEX_FILENAME = "geometries.index.json"
     BBOX_FILENAME = "bbox.json"
+    VERSION_FILENAME = "version.txt"
+    MOSAIC_FILENAME = "mosaic.vrt"
+    LEGEND_FILENAME = "legend.json"
+    MANIFEST_FILENAME = "manifest.json"
+
+    # Files of the dataset stored in the directory of its layer, when it has only one
+    DATASET_FILENAMES = [PROJECTION_FILENAME]
 
     def get_root_dir(self, cache=False):
         raise NotImplementedError
@@ -38,6 +86,9 @@ class BaseRasterStorage(object):
     def get_tmp_dir(self):
         raise NotImplementedError
 
+    def get_versions_dir(self):
+        raise NotImplementedError
+
     def get_dir(self, layer_name, cache=False):
         raise NotImplementedError
 
@@ -57,34 +108,77 @@ class BaseRasterStorage(object):
             self.get_dir(layer_name, cache=True), BaseRasterStorage.GEOMETRIES_FILENAME
         )
 
+    def get_geometries_index_file(self, layer_name):
+        return safe_join(
+            self.get_dir(layer_name, cache=True),
+            BaseRasterStorage.GEOMETRIES_INDEX_FILENAME,
+        )
+
     def get_bbox_file(self, layer_name):
         return safe_join(
             self.get_dir(layer_name, cache=True), BaseRasterStorage.BBOX_FILENAME
         )
 
+    def get_version_file(self, layer_name):
+        return safe_join(
+            self.get_dir(layer_name, cache=True), BaseRasterStorage.VERSION_FILENAME
+        )
+
+    def get_mosaic_file(self, layer_name):
+        return safe_join(
+            self.get_dir(layer_name, cache=True), BaseRasterStorage.MOSAIC_FILENAME
+        )
+
+    def get_legend_file(self, layer_name):
+        return safe_join(
+            self.get_dir(layer_name, cache=True), BaseRasterStorage.LEGEND_FILENAME
+        )
+
+    def get_manifest_file(self, layer_name):
+        return safe_join(
+            self.get_dir(layer_name, cache=True), BaseRasterStorage.MANIFEST_FILENAME
+        )
+
     def get_geometries(self, layer_name):
         filename = self.get_geometries_file(layer_name)
-        if not os.path.exists(filename):
-            return None
-
-        with open(filename, "r") as f:
-            return json.load(f)
+        return file_cache.get_json(filename)
+
+    def get_geometries_index(self, layer_name):
+        """Return the spatial index of the footprints of the raster files, or None if
+        the geometries file doesn't contain any polygon
+        """
+        index = spatial_index.load(self.get_geometries_index_file(layer_name))
+        if index is not None:
+            return index
+
+        # Layers cached before the index was introduced: build it from the geometries
+        # file (only once per process)
+        def _factory():
+            geometries = self.get_geometries(layer_name)
+            if not geometries:
+                return None
+
+            return spatial_index.index_rings(geometries)
+
+        return spatial_index.load(
+            self.get_geometries_file(layer_name), factory=_factory
+        )
 
     def get_projection(self, layer_name):
         filename = self.get_projection_file(layer_name)
-        if not os.path.exists(filename):
-            return None
-
-        with open(filename, "r") as f:
-            return f.read()
+        return file_cache.get_text(filename)
 
     def get_bbox(self, layer_name):
         filename = self.get_bbox_file(layer_name)
-        if not os.path.exists(filename):
-            return None
+        return file_cache.get_json(filename)
 
-        with open(filename, "r") as f:
-            return json.load(f)
+    def get_legends(self, layer_name):
+        filename = self.get_legend_file(layer_name)
+        return file_cache.get_json(filename)
+
+    def get_manifest(self, layer_name):
+        filename = self.get_manifest_file(layer_name)
+        return file_cache.get_json(filename)
 
 
 class RasterStorage(BaseRasterStorage):
@@ -97,14 +191,21 @@ class RasterStorage(BaseRasterStorage):
     def get_tmp_dir(self):
         return safe_join(current_app.config["WMS_CACHE_DIR"], "tmp")
 
+    def get_versions_dir(self):
+        return safe_join(current_app.config["WMS_CACHE_DIR"], "versions")
+
     def get_dir(self, layer_name, cache=False):
         if not (cache) and (current_app.config["RASTER_CACHE_DIR"] is not None):
             (_, id, _, _, _) = path.parse_unique_layer_name(layer_name)
             return safe_join(self.get_root_dir(), str(id))
         else:
-            return safe_join(
-                self.get_root_dir(cache=cache), path.to_folder_path(layer_name)
-            )
+            return _resolve(self.get_published_dir(layer_name))
+
+    def get_published_dir(self, layer_name):
+        """Return the directory of the layer used by the other processes, even while
+        the layer is rebuilt by the current one
+        """
+        return safe_join(self.get_root_dir(cache=True), path.to_folder_path(layer_name))
 
 
 class CMStorage(BaseRasterStorage):
@@ -114,7 +215,16 @@ class CMStorage(BaseRasterStorage):
     def get_tmp_dir(self):
         return safe_join(current_app.config["CM_OUTPUTS_DIR"], "tmp")
 
+    def get_versions_dir(self):
+        return safe_join(current_app.config["CM_OUTPUTS_DIR"], "versions")
+
     def get_dir(self, layer_name, cache=False):
+        return _resolve(self.get_published_dir(layer_name))
+
+    def get_published_dir(self, layer_name):
+        """Return the directory of the layer used by the other processes, even while
+        the layer is rebuilt by the current one
+        """
         return safe_join(self.get_root_dir(), path.to_folder_path(layer_name))
 
     def list_feature_ids(self, layer_name):
@@ -129,11 +239,7 @@ class CMStorage(BaseRasterStorage):
 
     def get_projection(self, layer_name, feature_id):
         filename = self.get_projection_file(layer_name, feature_id)
-        if not os.path.exists(filename):
-            return None
-
-        with open(filename, "r") as f:
-            return f.read()
+        return file_cache.get_text(filename)
 
     def as_zip(self, layer_name):
         cm_dir = self.get_dir(layer_name)
@@ -141,7 +247,9 @@ class CMStorage(BaseRasterStorage):
         if not os.path.exists(cm_dir):
             return None
 
-        filenames = os.listdir(cm_dir)
+        filenames = [
+            x for x in os.listdir(cm_dir) if x != BaseRasterStorage.VERSION_FILENAME
+        ]
         if len(filenames) == 0:
             return None
 
@@ -160,10 +268,17 @@ class CMStorage(BaseRasterStorage):
 class BaseVectorStorage(object):
 
     GEOJSON_FILENAME = "data.geojson"
+    GEOPACKAGE_FILENAME = "data.gpkg"
     PROJECTION_FILENAME = "projection.txt"
     VARIABLES_FILENAME = "variables.json"
     COMBINATIONS_FILENAME = "combinations.json"
     BBOX_FILENAME = "bbox.json"
+    VERSION_FILENAME = "version.txt"
+    LEGEND_FILENAME = "legend.json"
+    MANIFEST_FILENAME = "manifest.json"
+
+    # Files of the dataset stored in the directory of its layer, when it has only one
+    DATASET_FILENAMES = [COMBINATIONS_FILENAME]
 
     def get_root_dir(self, cache=False):
         raise NotImplementedError
@@ -172,14 +287,37 @@ class BaseVectorStorage(object):
         return safe_join(current_app.config["WMS_CACHE_DIR"], "tmp")
 
     def get_dir(self, layer_name, cache=False):
+        return _resolve(self.get_published_dir(layer_name))
+
+    def get_published_dir(self, layer_name):
+        """Return the directory of the layer used by the other processes, even while
+        the layer is rebuilt by the current one
+        """
         return safe_join(self.get_root_dir(), path.to_folder_path(layer_name))
 
+    def get_versions_dir(self):
+        return safe_join(current_app.config["WMS_CACHE_DIR"], "versions")
+
     def get_file_path(self, layer_name, filename):
         return safe_join(self.get_dir(layer_name), filename)
 
     def get_geojson_file(self, layer_name):
         return self.get_file_path(layer_name, BaseVectorStorage.GEOJSON_FILENAME)
 
+    def get_geopackage_file(self, layer_name, generalization=None):
+        """Return the path of the GeoPackage file of the layer, or of one of its
+        simplified versions (see geofile.GEOPACKAGE_GENERALIZATIONS)
+        """
+        if generalization is None:
+            return self.get_file_path(layer_name, BaseVectorStorage.GEOPACKAGE_FILENAME)
+
+        return self.get_file_path(
+            layer_name,
+            BaseVectorStorage.GEOPACKAGE_FILENAME.replace(
+                ".gpkg", f".{generalization}.gpkg"
+            ),
+        )
+
     def get_projection_file(self, layer_name):
         return self.get_file_path(layer_name, BaseVectorStorage.PROJECTION_FILENAME)
 
@@ -192,29 +330,37 @@ class BaseVectorStorage(object):
     def get_bbox_file(self, layer_name):
         return self.get_file_path(layer_name, BaseVectorStorage.BBOX_FILENAME)
 
+    def get_version_file(self, layer_name):
+        return self.get_file_path(layer_name, BaseVectorStorage.VERSION_FILENAME)
+
+    def get_legend_file(self, layer_name):
+        return self.get_file_path(layer_name, BaseVectorStorage.LEGEND_FILENAME)
+
+    def get_manifest_file(self, layer_name):
+        return self.get_file_path(layer_name, BaseVectorStorage.MANIFEST_FILENAME)
+
+    def get_legend_images_dir(self, legend_hash):
+        return safe_join(current_app.config["WMS_CACHE_DIR"], "legends", legend_hash)
+
     def get_projection(self, layer_name):
         filename = self.get_projection_file(layer_name)
-        if not os.path.exists(filename):
-            return None
-
-        with open(filename, "r") as f:
-            return f.read()
+        return file_cache.get_text(filename)
 
     def get_combinations(self, layer_name):
         filename = self.get_combinations_file(layer_name)
-        if not os.path.exists(filename):
-            return None
-
-        with open(filename, "r") as f:
-            return json.load(f)
+        return file_cache.get_json(filename)
 
     def get_bbox(self, layer_name):
         filename = self.get_bbox_file(layer_name)
-        if not os.path.exists(filename):
-            return None
+        return file_cache.get_json(filename)
+
+    def get_legends(self, layer_name):
+        filename = self.get_legend_file(layer_name)
+        return file_cache.get_json(filename)
 
-        with open(filename, "r") as f:
-            return json.load(f)
+    def get_manifest(self, layer_name):
+        filename = self.get_manifest_file(layer_name)
+        return file_cache.get_json(filename)
 
 
 class VectorStorage(BaseVectorStorage):
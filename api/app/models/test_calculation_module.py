@@ -1,8 +1,21 @@
 import logging
-from unittest.mock import patch
+import queue
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import redis
 
 from app.common.test import BaseApiTest
-from app.models.calculation_module import from_registration_string, list_cms
+from app.models.calculation_module import (
+    TaskWatcher,
+    from_registration_string,
+    get_celery_app,
+    get_task_result,
+    list_cms,
+    wait_for_task,
+)
 
 CM_STRING_NO_INFO = "[CMName]"
 CM_STRING_BAD_JSON = "[CMName cm_info={]"
@@ -38,3 +51,155 @@ class TestCMS(BaseApiTest):
         """Test a valid cm info parsing."""
         cm = from_registration_string(CM_STRING0)
         self.assertEqual(cm.__doc__, "doc")
+
+    def testSharedCeleryApp(self):
+        self.assertTrue(get_celery_app() is get_celery_app())
+
+    def testTaskResult(self):
+        task = Mock(result={"value": 1})
+        self.assertEqual(get_task_result(task), {"value": 1})
+
+        task = Mock(result=ValueError("Some problem"))
+        with self.assertRaises(ValueError):
+            get_task_result(task)
+
+
+class FakePubSub:
+    def __init__(self, errors=()):
+        self.channels = set()
+        self.unsubscribed = set()
+        self.messages = queue.Queue()
+        self.errors = list(errors)
+        self.nb_resets = 0
+
+    def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+        self.unsubscribed.update(channels)
+
+    def get_message(self, timeout=0.0):
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reset(self):
+        self.channels = set()
+        self.nb_resets += 1
+
+    def publish(self, channel):
+        self.messages.put({"type": "message", "channel": channel, "data": b"{}"})
+
+
+class FakeBackend:
+    def __init__(self, pubsubs):
+        self.pubsubs = list(pubsubs)
+        self.client = Mock()
+        self.client.pubsub.side_effect = lambda **kwargs: self.pubsubs.pop(0)
+
+    @staticmethod
+    def get_key_for_task(task_id):
+        return b"celery-task-meta-" + task_id.encode()
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+
+    return True
+
+
+@patch("app.models.calculation_module.LISTEN_TIMEOUT", 0.01)
+class TestTaskWatcher(unittest.TestCase):
+    CHANNEL = b"celery-task-meta-task1"
+
+    def testMessageWakesWaiter(self):
+        pubsub = FakePubSub()
+        watcher = TaskWatcher(FakeBackend([pubsub]))
+
+        with watcher.watch("task1") as event:
+            self.assertTrue(wait_until(lambda: self.CHANNEL in pubsub.channels))
+            self.assertFalse(event.is_set())
+
+            # Messages of other tasks are ignored
+            pubsub.publish(b"celery-task-meta-task2")
+            self.assertFalse(event.wait(0.1))
+
+            pubsub.publish(self.CHANNEL)
+            self.assertTrue(event.wait(2))
+
+    def testUnsubscribeOnExit(self):
+        pubsub = FakePubSub()
+        watcher = TaskWatcher(FakeBackend([pubsub]))
+
+        with watcher.watch("task1"):
+            with watcher.watch("task1"):
+                self.assertTrue(wait_until(lambda: self.CHANNEL in pubsub.channels))
+
+            # Still watched by the outer context
+            time.sleep(0.05)
+            self.assertTrue(self.CHANNEL in pubsub.channels)
+
+        self.assertTrue(wait_until(lambda: self.CHANNEL in pubsub.unsubscribed))
+        self.assertEqual(pubsub.channels, set())
+
+    def testRedisError(self):
+        pubsub1 = FakePubSub(errors=[redis.exceptions.ConnectionError("lost")])
+        pubsub2 = FakePubSub()
+        watcher = TaskWatcher(FakeBackend([pubsub1, pubsub2]))
+
+        with self.assertLogs(level=logging.ERROR):
+            with watcher.watch("task1") as event:
+                # The thread starts again with a new connection
+                self.assertTrue(wait_until(lambda: self.CHANNEL in pubsub2.channels))
+                self.assertEqual(pubsub1.nb_resets, 1)
+                self.assertTrue(watcher._thread.is_alive())
+
+                pubsub2.publish(self.CHANNEL)
+                self.assertTrue(event.wait(2))
+
+    def testWaitForTask(self):
+        pubsub = FakePubSub()
+        watcher = TaskWatcher(FakeBackend([pubsub]))
+        task = Mock(id="task1", status="PENDING")
+
+        def _finish():
+            wait_until(lambda: self.CHANNEL in pubsub.channels)
+            task.status = "SUCCESS"
+            pubsub.publish(self.CHANNEL)
+
+        thread = threading.Thread(target=_finish)
+
+        with patch(
+            "app.models.calculation_module.get_task_watcher", return_value=watcher
+        ):
+            time_started = time.monotonic()
+            thread.start()
+            wait_for_task(task, 10)
+            thread.join()
+
+        self.assertEqual(task.status, "SUCCESS")
+        self.assertLess(time.monotonic() - time_started, 2)
+
+    def testWaitForTaskTimeout(self):
+        watcher = TaskWatcher(FakeBackend([FakePubSub()]))
+        task = Mock(id="task1", status="PENDING")
+
+        with patch(
+            "app.models.calculation_module.get_task_watcher", return_value=watcher
+        ):
+            time_started = time.monotonic()
+            wait_for_task(task, 0.2)
+            duration = time.monotonic() - time_started
+
+        self.assertGreaterEqual(duration, 0.2)
+        self.assertLess(duration, 2)
+        self.assertEqual(task.status, "PENDING")
@@ -2,14 +2,17 @@ import copy
 import json
 import os
 import shutil
+import socket
 
 import mapnik
+from flask import safe_join
 
 from app.common import path
 from app.common.projection import epsg_string_to_proj4
 from app.common.test import BaseApiTest
 
 from . import geofile, storage
+from .wms.utils import Size
 
 
 class TestLoad(BaseApiTest):
@@ -134,6 +137,133 @@ class TestSaveVectorGeoJSON(BaseApiTest):
             self.assertTrue("__variable__var2" in geojson["features"][0]["properties"])
             self.assertTrue("__variable__var3" in geojson["features"][0]["properties"])
 
+    def testFeatureWithoutVariables(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            feature = copy.deepcopy(TestSaveVectorGeoJSON.GEOJSON["features"][0])
+            feature["properties"]["variables"] = None
+            feature["properties"]["units"] = None
+
+            valid_variables = geofile.save_vector_features(layer_name, [feature])
+            self.assertEqual(valid_variables, [])
+
+            with open(f"{self.wms_cache_dir}/vectors/42/data.geojson", "r") as f:
+                geojson = json.load(f)
+
+            self.assertEqual(geojson["features"][0]["properties"]["variables"], {})
+
+    def testFeaturesIterable(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            features = (
+                copy.deepcopy(x) for x in TestSaveVectorGeoJSON.GEOJSON["features"]
+            )
+
+            valid_variables = geofile.save_vector_features(layer_name, features)
+            self.assertEqual(valid_variables, ["var1", "var2"])
+
+            with open(f"{self.wms_cache_dir}/vectors/42/data.geojson", "r") as f:
+                geojson = json.load(f)
+
+            self.assertEqual(geojson["type"], "FeatureCollection")
+            self.assertEqual(len(geojson["features"]), 1)
+
+    def testGeoPackageFile(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            geofile.save_vector_geojson(
+                layer_name, copy.deepcopy(TestSaveVectorGeoJSON.GEOJSON)
+            )
+
+            filename = f"{self.wms_cache_dir}/vectors/42/data.gpkg"
+            self.assertTrue(os.path.exists(filename))
+
+            layer = geofile.load(layer_name)
+            self.assertEqual(layer.get_data_for_bounding_box(None, None), [filename])
+
+            mapnik_layers = layer.as_mapnik_layers()
+            self.assertEqual(len(mapnik_layers), 1)
+
+            fields = mapnik_layers[0].datasource.fields()
+            self.assertTrue("__variable__var1" in fields)
+            self.assertTrue("variables" in fields)
+            self.assertTrue("legend" not in fields)
+
+    def testGeoPackageGeneralizations(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            geojson = copy.deepcopy(TestSaveVectorGeoJSON.GEOJSON)
+            geojson["features"] = geojson["features"][:1]
+            geojson["features"][0]["geometry"] = {
+                "type": "Polygon",
+                "coordinates": [
+                    [[7.0, 46.0], [7.5, 46.01], [8.0, 46.0], [8.0, 47.0], [7.0, 46.0]]
+                ],
+            }
+
+            geofile.save_vector_geojson(layer_name, geojson)
+
+            folder = f"{self.wms_cache_dir}/vectors/42"
+            for index in range(len(geofile.GEOPACKAGE_GENERALIZATIONS)):
+                self.assertTrue(os.path.exists(f"{folder}/data.{index}.gpkg"))
+
+            layer = geofile.load(layer_name)
+            bbox = mapnik.Box2d(7.0, 45.0, 8.0, 47.0)
+
+            # One pixel is 0.1 degree wide: the coarsest version is used
+            data = layer.get_data_for_bounding_box(
+                bbox, "epsg:4326", size=Size(width=10, height=10)
+            )
+            self.assertEqual(data, [f"{folder}/data.0.gpkg"])
+
+            # One pixel is 0.002 degree wide: the finest version is used
+            data = layer.get_data_for_bounding_box(
+                bbox, "epsg:4326", size=Size(width=500, height=500)
+            )
+            self.assertEqual(data, [f"{folder}/data.2.gpkg"])
+
+            # Very small pixels: the original geometries are used
+            data = layer.get_data_for_bounding_box(
+                bbox, "epsg:4326", size=Size(width=10000, height=10000)
+            )
+            self.assertEqual(data, [f"{folder}/data.gpkg"])
+
+    def testNoGeneralizationOfPoints(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            geofile.save_vector_geojson(
+                layer_name, copy.deepcopy(TestSaveVectorGeoJSON.GEOJSON)
+            )
+
+            self.assertFalse(
+                os.path.exists(f"{self.wms_cache_dir}/vectors/42/data.0.gpkg")
+            )
+
+    def testDataOutsideOfBoundingBox(self):
+        with self.flask_app.app_context():
+            layer_name = "vector/42"
+
+            geofile.save_vector_geojson(
+                layer_name, copy.deepcopy(TestSaveVectorGeoJSON.GEOJSON)
+            )
+
+            layer = geofile.load(layer_name)
+
+            data = layer.get_data_for_bounding_box(
+                mapnik.Box2d(7.0, 45.0, 8.0, 47.0), "epsg:4326"
+            )
+            self.assertEqual(len(data), 1)
+
+            data = layer.get_data_for_bounding_box(
+                mapnik.Box2d(-10.0, 30.0, -5.0, 35.0), "epsg:4326"
+            )
+            self.assertEqual(data, [])
+
     def testVariablesFile(self):
         with self.flask_app.app_context():
             layer_name = "vector/42"
@@ -283,6 +413,13 @@ class TestSaveRasterGeometries(BaseApiTest):
             self.assertAlmostEqual(bbox["bottom"], 30)
             self.assertAlmostEqual(bbox["top"], 40)
 
+            filename = f"{self.wms_cache_dir}/rasters/{folder}/geometries.index.json"
+            self.assertTrue(os.path.exists(filename))
+
+            index = storage.create(layer_name).get_geometries_index(layer_name)
+            self.assertEqual(index.query((15, 35, 16, 36)), [[0, "FID1.tif"]])
+            self.assertEqual(index.query((25, 35, 26, 36)), [])
+
     def testFailureNoFeatures(self):
         with self.flask_app.app_context():
             layer_name = path.make_unique_layer_name(
@@ -334,6 +471,12 @@ class TestSaveRasterGeometries(BaseApiTest):
 
             self.assertTrue(geometries["FID1.tif"] is None)
 
+            self.assertFalse(
+                os.path.exists(
+                    f"{self.wms_cache_dir}/rasters/{folder}/geometries.index.json"
+                )
+            )
+
             filename = f"{self.wms_cache_dir}/rasters/{folder}/bbox.json"
             self.assertTrue(os.path.exists(filename))
 
@@ -395,6 +538,12 @@ class TestSaveRasterGeometries(BaseApiTest):
 
             self.assertTrue(geometries["FID1.tif"] is None)
 
+            self.assertFalse(
+                os.path.exists(
+                    f"{self.wms_cache_dir}/rasters/{folder}/geometries.index.json"
+                )
+            )
+
             filename = f"{self.wms_cache_dir}/rasters/{folder}/bbox.json"
             self.assertTrue(os.path.exists(filename))
 
@@ -444,6 +593,43 @@ class TestSaveRasterFile(BaseApiTest):
                 )
             )
 
+    def testOptimized(self):
+        with self.flask_app.app_context():
+            raster_filename = self.get_testdata_path("hotmaps-cdd_curr_adapted.tif")
+            with open(raster_filename, "rb") as f:
+                content = f.read()
+
+            self.assertTrue(
+                geofile.save_raster_file(
+                    "raster/42", "file.tif", content, optimize=True
+                )
+            )
+
+            storage_instance = storage.create("raster/42")
+            filename = storage_instance.get_file_path("raster/42", "file.tif")
+
+            self.assertTrue(os.path.exists(filename))
+            self.assertTrue(geofile.is_optimized_raster_file(filename))
+
+    def testMove(self):
+        with self.flask_app.app_context():
+            filename = os.path.join(self.wms_cache_dir, "downloaded.tif")
+            shutil.copy(
+                self.get_testdata_path("hotmaps-cdd_curr_adapted.tif"), filename
+            )
+
+            self.assertTrue(
+                geofile.move_raster_file("raster/42", "subfolder/file.tif", filename)
+            )
+
+            storage_instance = storage.create("raster/42")
+            self.assertTrue(
+                os.path.exists(
+                    storage_instance.get_file_path("raster/42", "subfolder/file.tif")
+                )
+            )
+            self.assertFalse(os.path.exists(filename))
+
 
 class TestSaveCMFile(BaseApiTest):
     def testSave(self):
@@ -519,6 +705,294 @@ class TestSaveCMParameters(BaseApiTest):
             self.assertEqual(data, TestSaveCMParameters.PARAMETERS)
 
 
+class TestLayerVersion(BaseApiTest):
+    def testNoLayer(self):
+        with self.flask_app.app_context():
+            self.assertTrue(geofile.get_layer_version("raster/42") is None)
+            self.assertTrue(geofile.update_layer_version("raster/42") is None)
+
+    def testNoVersion(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("raster/42")
+            os.makedirs(storage_instance.get_dir("raster/42", cache=True))
+
+            self.assertTrue(geofile.get_layer_version("raster/42") is None)
+
+    def testUpdate(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            os.makedirs(storage_instance.get_dir("vector/42"))
+
+            version1 = geofile.update_layer_version("vector/42")
+            self.assertTrue(version1 is not None)
+            self.assertEqual(geofile.get_layer_version("vector/42"), version1)
+
+            version2 = geofile.update_layer_version("vector/42")
+            self.assertNotEqual(version1, version2)
+            self.assertEqual(geofile.get_layer_version("vector/42"), version2)
+
+    def testSaveCMFile(self):
+        with self.flask_app.app_context():
+            layer_name = "cm/some_name/01234567-0000-0000-0000-000000000000"
+
+            raster_filename = self.get_testdata_path("hotmaps-cdd_curr_adapted.tif")
+            with open(raster_filename, "rb") as f:
+                content = f.read()
+
+            self.assertTrue(geofile.save_cm_file(layer_name, "file1.tif", content))
+            version1 = geofile.get_layer_version(layer_name)
+            self.assertTrue(version1 is not None)
+
+            self.assertTrue(geofile.save_cm_file(layer_name, "file2.tif", content))
+            self.assertNotEqual(geofile.get_layer_version(layer_name), version1)
+
+
+class TestLayerLegends(BaseApiTest):
+    LEGEND = {"symbology": [{"red": 255, "green": 0, "blue": 0, "value": 1}]}
+    LEGEND2 = {"symbology": [{"red": 0, "green": 0, "blue": 255, "value": 1}]}
+
+    def testNoLegendFile(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            os.makedirs(storage_instance.get_dir("vector/42"))
+
+            self.assertTrue(geofile.get_layer_legend("vector/42") is None)
+            self.assertTrue(geofile.get_layer_statistics("vector/42") is None)
+            self.assertFalse(geofile.has_layer_legends("vector/42"))
+
+    def testNoLayer(self):
+        with self.flask_app.app_context():
+            self.assertFalse(geofile.save_layer_legends("vector/42", {}))
+
+    def testVectorVariables(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            os.makedirs(storage_instance.get_dir("vector/42"))
+
+            legends = {"": self.LEGEND, "heat": self.LEGEND2}
+            self.assertTrue(geofile.save_layer_legends("vector/42", legends))
+
+            self.assertEqual(geofile.get_layer_legend("vector/42"), self.LEGEND)
+            self.assertTrue(geofile.has_layer_legends("vector/42"))
+
+            layer_name = path.make_unique_layer_name(path.VECTOR, 42, "heat")
+            self.assertEqual(geofile.get_layer_legend(layer_name), self.LEGEND2)
+
+            layer_name = path.make_unique_layer_name(path.VECTOR, 42, "cold")
+            self.assertTrue(geofile.get_layer_legend(layer_name) is None)
+
+    def testRasterStatistics(self):
+        with self.flask_app.app_context():
+            layer_name = path.make_unique_layer_name(path.RASTER, 42, "heat")
+            storage_instance = storage.create(layer_name)
+
+            os.makedirs(storage_instance.get_dir(layer_name))
+
+            shutil.copy(
+                self.get_testdata_path("hotmaps-cdd_curr_adapted.tif"),
+                storage_instance.get_file_path(layer_name, "FID.tif"),
+            )
+
+            with open(storage_instance.get_geometries_file(layer_name), "w") as f:
+                json.dump({"FID.tif": None}, f)
+
+            statistics = geofile.compute_raster_statistics(layer_name)
+
+            # The pixels with the value 0 have no data
+            self.assertEqual(statistics["min"], 1.0)
+            self.assertEqual(statistics["max"], 253.0)
+            self.assertEqual(statistics["count"], 3238)
+            self.assertEqual(len(statistics["histogram"]), geofile.STATISTICS_BUCKETS)
+            self.assertEqual(sum(statistics["histogram"]), 3238)
+
+            legends = {"heat": self.LEGEND}
+            self.assertTrue(
+                geofile.save_layer_legends(layer_name, legends, statistics=statistics)
+            )
+
+            self.assertEqual(geofile.get_layer_legend(layer_name), self.LEGEND)
+            self.assertEqual(geofile.get_layer_statistics(layer_name), statistics)
+
+    def testRasterStatisticsNoFile(self):
+        with self.flask_app.app_context():
+            layer_name = path.make_unique_layer_name(path.RASTER, 42, "heat")
+            self.assertTrue(geofile.compute_raster_statistics(layer_name) is None)
+
+
+class TestLayerUpdate(BaseApiTest):
+    MANIFEST = {"summary": {"count": 3, "max_start_at": None, "checksum": "abc"}}
+    MANIFEST2 = {"summary": {"count": 4, "max_start_at": None, "checksum": "def"}}
+
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            os.makedirs(safe_join(folder, "nested"))
+
+            with open(safe_join(folder, "old.txt"), "w") as f:
+                f.write("old")
+
+            with open(storage_instance.get_combinations_file("vector/42"), "w") as f:
+                json.dump({}, f)
+
+    def testPublish(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            self.assertEqual(geofile.begin_layer_update("vector/42"), folder)
+            self.assertNotEqual(storage_instance.get_dir("vector/42"), folder)
+
+            self.assertTrue(geofile.save_layer_manifest("vector/42", self.MANIFEST))
+
+            # The current version of the layer is untouched
+            self.assertFalse(
+                os.path.exists(
+                    safe_join(folder, storage.VectorStorage.MANIFEST_FILENAME)
+                )
+            )
+            self.assertTrue(os.path.exists(safe_join(folder, "old.txt")))
+
+            self.assertTrue(geofile.publish_layer_update("vector/42"))
+
+            self.assertEqual(storage_instance.get_dir("vector/42"), folder)
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST)
+            self.assertFalse(os.path.exists(safe_join(folder, "old.txt")))
+
+            # The nested layers and the files of the dataset are kept
+            self.assertTrue(os.path.isdir(safe_join(folder, "nested")))
+            self.assertEqual(storage_instance.get_combinations("vector/42"), {})
+
+    def testAbort(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            geofile.begin_layer_update("vector/42")
+            staging_dir = storage_instance.get_dir("vector/42")
+
+            self.assertTrue(geofile.save_layer_manifest("vector/42", self.MANIFEST))
+
+            geofile.abort_layer_update("vector/42")
+
+            self.assertFalse(os.path.exists(staging_dir))
+            self.assertEqual(storage_instance.get_dir("vector/42"), folder)
+            self.assertTrue(storage_instance.get_manifest("vector/42") is None)
+            self.assertTrue(os.path.exists(safe_join(folder, "old.txt")))
+
+    def testVersions(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            geofile.begin_layer_update("vector/42")
+            geofile.save_layer_manifest("vector/42", self.MANIFEST)
+            self.assertTrue(geofile.publish_layer_update("vector/42"))
+
+            self.assertTrue(os.path.islink(folder))
+            version1 = os.path.realpath(folder)
+
+            geofile.begin_layer_update("vector/42")
+            geofile.save_layer_manifest("vector/42", self.MANIFEST2)
+            self.assertTrue(geofile.publish_layer_update("vector/42"))
+
+            self.assertNotEqual(os.path.realpath(folder), version1)
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST2)
+            self.assertTrue(os.path.isdir(safe_join(folder, "nested")))
+
+            # The previous version is kept during the grace period
+            geofile.collect_layer_versions("vector/42")
+            self.assertTrue(os.path.exists(version1))
+
+            geofile.collect_layer_versions("vector/42", grace_period=0)
+            self.assertFalse(os.path.exists(version1))
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST2)
+
+    def testPinnedVersion(self):
+        with self.flask_app.app_context():
+            geofile.begin_layer_update("vector/42")
+            geofile.save_layer_manifest("vector/42", self.MANIFEST)
+            geofile.publish_layer_update("vector/42")
+
+        with self.flask_app.test_request_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            geofile.begin_layer_update("vector/42")
+            geofile.save_layer_manifest("vector/42", self.MANIFEST2)
+            geofile.publish_layer_update("vector/42")
+
+            # The request keeps reading the version it started with
+            self.assertEqual(storage_instance.get_dir("vector/42"), folder)
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST)
+
+        with self.flask_app.test_request_context():
+            storage_instance = storage.create("vector/42")
+            self.assertNotEqual(storage_instance.get_dir("vector/42"), folder)
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST2)
+
+    def testCopy(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_dir("vector/42")
+
+            geofile.begin_layer_update("vector/42", copy=True)
+            staging_dir = storage_instance.get_dir("vector/42")
+            self.assertTrue(os.path.exists(safe_join(staging_dir, "old.txt")))
+
+            geofile.save_layer_manifest("vector/42", self.MANIFEST)
+            self.assertTrue(geofile.publish_layer_update("vector/42"))
+
+            self.assertTrue(os.path.exists(safe_join(folder, "old.txt")))
+            self.assertEqual(storage_instance.get_manifest("vector/42"), self.MANIFEST)
+
+    def testCollectAbandonedVersions(self):
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            folder = storage_instance.get_published_dir("vector/42")
+
+            geofile.begin_layer_update("vector/42")
+            staging_dir = storage_instance.get_dir("vector/42")
+
+            # Still being built by the current process
+            geofile.collect_layer_versions("vector/42", grace_period=0)
+            self.assertTrue(os.path.exists(staging_dir))
+
+            # Process gone without publishing the version
+            storage.set_staging_dir(folder, None)
+            with open(f"{staging_dir}.staging", "w") as f:
+                f.write(f"{socket.gethostname()} 4194305")
+
+            geofile.collect_layer_versions("vector/42", grace_period=0)
+            self.assertFalse(os.path.exists(staging_dir))
+            self.assertFalse(os.path.exists(f"{staging_dir}.staging"))
+
+    def testPublishWithoutUpdate(self):
+        with self.flask_app.app_context():
+            self.assertFalse(geofile.publish_layer_update("vector/42"))
+
+    def testLinkRasterFile(self):
+        with self.flask_app.app_context():
+            raster_filename = self.get_testdata_path("hotmaps-cdd_curr_adapted.tif")
+
+            self.assertTrue(
+                geofile.link_raster_file("raster/42", "sub/FID.tif", raster_filename)
+            )
+
+            storage_instance = storage.create("raster/42")
+            filename = storage_instance.get_file_path("raster/42", "sub/FID.tif")
+
+            with open(filename, "rb") as f1, open(raster_filename, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            self.assertFalse(
+                geofile.link_raster_file("raster/42", "FID2.tif", "missing.tif")
+            )
+
+
 class TestRasterLayerIntersectionsBase(BaseApiTest):
     def setUp(self):
         super().setUp()
@@ -1146,3 +1620,68 @@ class TestRasterLayerDataAndMapnik(
             )
 
             self.assertEqual(len(data), 0)
+
+
+class TestRasterLayerMosaic(TestRasterLayerDataAndMapnikBase):
+    def getLayerName(self):
+        return path.make_unique_layer_name(path.RASTER, 42, variable="heat")
+
+    def createGeometryFile(self, filename):
+        data = {
+            "FID.tif": [[0, 60], [10, 60], [10, 30], [0, 30], [0, 60]],
+            "FID2.tif": [[0, 60], [10, 60], [10, 30], [0, 30], [0, 60]],
+        }
+
+        with open(filename, "w") as f:
+            json.dump(data, f)
+
+    def testSaveMosaic(self):
+        with self.flask_app.app_context():
+            layer_name = self.getLayerName()
+            storage_instance = storage.create(layer_name)
+
+            self.assertTrue(geofile.save_raster_mosaic(layer_name))
+            self.assertTrue(
+                os.path.exists(storage_instance.get_mosaic_file(layer_name))
+            )
+
+    def testDataWithMosaic(self):
+        with self.flask_app.app_context():
+            layer_name = self.getLayerName()
+            layer = geofile.load(layer_name)
+
+            geofile.save_raster_mosaic(layer_name)
+
+            data = layer.get_data_for_bounding_box(
+                mapnik.Box2d(0, 30, 10, 60), "EPSG:4326"
+            )
+
+            self.assertEqual(
+                data,
+                [("mosaic.vrt", layer.storage.get_mosaic_file(layer_name))],
+            )
+
+            layers = layer.as_mapnik_layers(data)
+            self.assertEqual(len(layers), 1)
+
+    def testDataNotIntersectsBoundingBox(self):
+        with self.flask_app.app_context():
+            layer_name = self.getLayerName()
+            layer = geofile.load(layer_name)
+
+            geofile.save_raster_mosaic(layer_name)
+
+            data = layer.get_data_for_bounding_box(
+                mapnik.Box2d(40, -70, 60, -60), "EPSG:4326"
+            )
+
+            self.assertEqual(len(data), 0)
+
+    def testNoGeometryFile(self):
+        with self.flask_app.app_context():
+            layer_name = self.getLayerName()
+            storage_instance = storage.create(layer_name)
+
+            os.remove(storage_instance.get_geometries_file(layer_name))
+
+            self.assertFalse(geofile.save_raster_mosaic(layer_name))
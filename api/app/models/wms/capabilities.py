@@ -1,24 +1,145 @@
-"""Functions related to the "GetCapabilities" operation of the Web Map Service (WMS)"""
+"""Functions related to the "GetCapabilities" operation of the Web Map Service (WMS)
 
+Building the capabilities document requires one request to PostgREST per dataset,
+and reading the bounding box of each layer: it is thus built once after each update
+of the cache (or by the "update-capabilities" command), and saved in the cache
+folder. The requests are served from the saved document, with the URL of the WMS
+inserted in place of a placeholder.
+
+As the datasets may change without the cache being updated, the saved document is
+built again once it is older than the cache of the metadata (DATASETS_METADATA_TTL)
+by the first request noticing it, the other ones being served the previous version
+meanwhile.
+"""
+
+import hashlib
 import itertools
 import os
+import time
+from tempfile import mkstemp
+from xml.sax.saxutils import escape  # nosec
 
 import osr
-from flask import current_app, request
+from flask import current_app, safe_join
 from lxml import etree  # nosec
 
 import app.common.projection as project
 from app.common import client
 from app.common import datasets as datasets_fcts
-from app.common import path, xml
+from app.common import file_cache, metadata_cache, path, xml
 from app.models import storage
 
 current_file_dir = os.path.dirname(os.path.abspath(__file__))
 
+CAPABILITIES_FILENAME = "capabilities.xml"
+
+# Replaced by the URL of the WMS when the saved document is served
+BASE_URL_PLACEHOLDER = "__BASE_URL__"
+
+
+def get_capabilities(base_url):
+    """Return the xml description of the capabilities of the WMS available at
+    base_url, along with an ETag identifying it, or None if it can't be built.
+
+    The document is built and saved the first time it is needed, and built again
+    once it is older than the cache of the metadata.
+    """
+    filename = get_capabilities_file()
+
+    _refresh_if_stale(filename)
+
+    document = file_cache.get(filename, _load_document, tag="capabilities")
+    if document is None:
+        if not save_capabilities():
+            return None
+
+        document = file_cache.get(filename, _load_document, tag="capabilities")
+        if document is None:
+            return None
+
+    (content, digest) = document
+
+    content = content.replace(
+        BASE_URL_PLACEHOLDER.encode(), escape(base_url, {'"': "&quot;"}).encode()
+    )
+    etag = hashlib.sha256(f"{digest} {base_url}".encode()).hexdigest()
+
+    return (content, etag)
+
+
+def get_capabilities_file():
+    return safe_join(current_app.config["WMS_CACHE_DIR"], CAPABILITIES_FILENAME)
+
+
+def save_capabilities():
+    """Build the capabilities document and save it in the cache folder (only if it
+    changed). Return False if it couldn't be built.
+    """
+    content = build_capabilities()
+    if content is None:
+        return False
+
+    filename = get_capabilities_file()
+
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == content:
+                return True
+    except OSError:
+        pass
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    (fd, tmp_filename) = mkstemp(dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        print(f"Failed to save the capabilities: {e}")
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        return False
+
+    return True
 
-def get_capabilities():
+
+def _refresh_if_stale(filename):
+    """Build the saved document again if it is older than the cache of the metadata.
+
+    Its modification time is updated first, so the other requests (and workers)
+    don't build it at the same time, nor retry before TTL seconds if it failed.
+    """
+    try:
+        mtime = os.stat(filename).st_mtime
+    except OSError:
+        return
+
+    if time.time() - mtime < metadata_cache.TTL:
+        return
+
+    try:
+        os.utime(filename)
+    except OSError:
+        return
+
+    if not save_capabilities():
+        print("Failed to build the capabilities again, the previous ones are served")
+
+
+def _load_document(filename):
+    try:
+        with open(filename, "rb") as f:
+            content = f.read()
+    except OSError:
+        return None
+
+    return (content, hashlib.sha256(content).hexdigest())
+
+
+def build_capabilities():
     """Return an xml description of the capabilities of the current WMS
-    set of endpoints.
+    set of endpoints, with a placeholder instead of its URL.
 
     This method starts with a preexisting XML template, parses it then
     insert dynamic element from the list of layers and from the flask
@@ -43,7 +164,7 @@ def get_capabilities():
     capabilities = root.findall("Capability//OnlineResource", root.nsmap)
     capabilities += root.findall("Service//OnlineResource", root.nsmap)
     for element in capabilities:
-        element.set("{http://www.w3.org/1999/xlink}href", request.base_url)
+        element.set("{http://www.w3.org/1999/xlink}href", BASE_URL_PLACEHOLDER)
 
     get_map = root.find("Capability/Request/GetMap", root.nsmap)
     for get_map_format in current_app.config["WMS"]["GETMAP"]["ALLOWED_OUTPUTS"]:
@@ -59,7 +180,7 @@ def get_capabilities():
         type = path.RASTER if dataset["is_raster"] else path.VECTOR
 
         layer_node = etree.Element("Layer")
-        layer_node.set("queryable", "0" if dataset["is_raster"] else "1")
+        layer_node.set("queryable", "1")
         layer_node.set("opaque", "0")
 
         title_node = etree.Element("Title")
@@ -148,7 +269,7 @@ def get_layer_capabilities(
         return
 
     sublayer_node = etree.Element("Layer")
-    sublayer_node.set("queryable", "0" if dataset["is_raster"] else "1")
+    sublayer_node.set("queryable", "1")
     sublayer_node.set("opaque", "0")
 
     title_node = etree.Element("Title")
@@ -225,3 +346,37 @@ def get_layer_capabilities(
         sublayer_node.append(bbox_node)
 
     parent_layer.append(sublayer_node)
+
+
+def get_layer_names(dataset):
+    """Return the names of the layers of a dataset (as listed in the capabilities of
+    the WMS) that are in the cache
+    """
+    type = path.RASTER if dataset["is_raster"] else path.VECTOR
+
+    parameters = client.get_parameters(dataset["ds_id"])
+    if parameters is None:
+        return []
+
+    datasets_fcts.process_parameters(
+        parameters,
+        dataset_id=dataset["ds_id"],
+        is_raster=dataset["is_raster"],
+    )
+
+    variables = parameters["variables"] or [None]
+    time_periods = parameters["time_periods"] or [None]
+
+    layer_names = []
+    for variable, time_period in itertools.product(variables, time_periods):
+        layer_name = path.make_unique_layer_name(
+            type, dataset["ds_id"], variable=variable, time_period=time_period
+        )
+
+        storage_instance = storage.create_for_layer_type(type)
+        if (layer_name is not None) and (
+            storage_instance.get_bbox(layer_name) is not None
+        ):
+            layer_names.append(layer_name)
+
+    return layer_names
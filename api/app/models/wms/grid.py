@@ -0,0 +1,114 @@
+"""Grid of the XYZ tiles displayed by the frontend, in the Web Mercator projection.
+
+This is the grid used by Leaflet (and the "GoogleMapsCompatible" tile matrix set of
+WMTS): at zoom level z, the world is divided in 2^z x 2^z tiles of 256x256 pixels,
+numbered from the top-left corner.
+"""
+import math
+
+TILE_SIZE = 256
+PROJECTION = "EPSG:3857"
+
+# Scale denominator of the zoom level 0, for 256x256 tiles and pixels of 0.28 mm
+SCALE_DENOMINATOR = 559082264.0287178
+
+# Half of the width of the world in Web Mercator coordinates
+EXTENT = 20037508.342789244
+
+# Latitude of the top and bottom edges of the grid
+MAX_LATITUDE = 85.0511287798066
+
+
+def get_tile_bbox(z, x, y):
+    """Return the bounding box (min_x, min_y, max_x, max_y) of a tile, in Web Mercator
+    coordinates
+    """
+    tile_extent = 2 * EXTENT / 2 ** z
+
+    min_x = -EXTENT + x * tile_extent
+    max_y = EXTENT - y * tile_extent
+
+    return (min_x, max_y - tile_extent, min_x + tile_extent, max_y)
+
+
+def get_tile(bbox):
+    """Return the (z, x, y) coordinates of the tile whose bounding box, in Web
+    Mercator coordinates, is the given one, or None if it isn't a tile of the grid
+    """
+    (min_x, min_y, max_x, max_y) = bbox
+    tile_extent = max_x - min_x
+
+    if (tile_extent <= 0) or (abs(max_y - min_y - tile_extent) > tile_extent * 1e-6):
+        return None
+
+    def _to_integer(value):
+        result = round(value)
+        return result if abs(value - result) < 1e-6 else None
+
+    z = _to_integer(math.log2(2 * EXTENT / tile_extent))
+    x = _to_integer((min_x + EXTENT) / tile_extent)
+    y = _to_integer((EXTENT - max_y) / tile_extent)
+
+    if (z is None) or (x is None) or (y is None) or (z < 0):
+        return None
+
+    if (min(x, y) < 0) or (max(x, y) >= 2 ** z):
+        return None
+
+    return (z, x, y)
+
+
+def get_metatile(z, x, y, size):
+    """Return the (x, y) coordinates of the top-left tile of the metatile (a block of
+    size x size tiles) containing a tile, along with the actual size of the metatile
+    (smaller at the lowest zoom levels)
+    """
+    size = min(size, 2 ** z)
+    return (x - x % size, y - y % size, size)
+
+
+def get_tile_at(z, longitude, latitude):
+    """Return the (x, y) coordinates of the tile containing a point"""
+    n = 2 ** z
+
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n)
+
+    return (max(0, min(n - 1, x)), max(0, min(n - 1, y)))
+
+
+def get_tiles_in_bbox(z, west, south, east, north):
+    """Return the list of the (x, y) coordinates of the tiles covering a bounding box
+    given in longitude/latitude
+    """
+    (min_x, min_y) = get_tile_at(z, west, north)
+    (max_x, max_y) = get_tile_at(z, east, south)
+
+    return [(x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1)]
+
+
+def format_bbox(bbox):
+    """Return a bounding box formatted like the "bbox" parameter of the WMS"""
+    return ",".join([repr(v) for v in bbox])
+
+
+def get_getmap_args(layer_name, z, x, y, format="image/png", tile_size=TILE_SIZE):
+    """Return the parameters of the "GetMap" request of a tile, as sent by the
+    frontend. A tile size bigger than TILE_SIZE gives a high resolution version of the
+    tile.
+    """
+    return {
+        "service": "WMS",
+        "request": "GetMap",
+        "layers": layer_name,
+        "styles": "",
+        "format": format,
+        "transparent": "true",
+        "version": "1.1.1",
+        "width": str(tile_size),
+        "height": str(tile_size),
+        "srs": PROJECTION,
+        "bbox": format_bbox(get_tile_bbox(z, x, y)),
+    }
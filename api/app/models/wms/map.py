@@ -1,24 +1,77 @@
 """Functions related to the "GetMap" operation of the Web Map Service (WMS)"""
 
+import json
 import os
-import shutil
+from functools import lru_cache
 
 import mapnik
 import seaborn as sns
+from flask import current_app
 
-from app.common import client, path
-from app.models import geofile
-from app.models.wms import utils
+from app.common import client, datasets, path
+from app.models import geofile, storage
+from app.models.wms import grid, registry, tile_cache, utils
+
+
+def get_map_data(normalized_args, metatile=None):
+    """Return the encoded image described by the WMS parameters along with its
+    mimetype, or None if no layer could be rendered. The image is retrieved from the
+    tile cache if possible.
+
+    The tiles are rendered by metatiles if metatile is True, or if it is None and the
+    metatiles are enabled in the configuration.
+    """
+    mapnik_format, mime_format = utils.parse_format(normalized_args)
+
+    # The CM outputs are deleted once they haven't been used for some time, and they
+    # might not be accessed at all if the image is already in a cache
+    for layer_name in utils.parse_layers(normalized_args):
+        if path.get_type(layer_name) == path.CM:
+            geofile.touch_cm_layer(layer_name)
+
+    key = tile_cache.make_key(normalized_args)
+
+    content = tile_cache.get(key)
+    if content is not None:
+        return (content, mime_format)
+
+    if metatile is None:
+        metatile = current_app.config["WMS"]["METATILE"]["ENABLED"]
+
+    # The tiles of the grid are rendered by metatiles, as long as they can be cached
+    tile = None
+    if metatile and (key is not None):
+        tile = get_requested_tile(normalized_args)
+    if tile is not None:
+        content = get_metatile_data(normalized_args, tile, mapnik_format)
+        if content is None:
+            return None
+    else:
+        image = get_map_image(normalized_args)
+        if image is None:
+            return None
+
+        content = image.tostring(mapnik_format)
+        tile_cache.put(key, content)
+
+    return (content, mime_format)
 
 
 def get_map_image(normalized_args):
     size = utils.parse_size(normalized_args)
     bbox = utils.parse_envelope(normalized_args)
     bbox_projection = utils.parse_projection(normalized_args)
+    layers = utils.parse_layers(normalized_args)
+
+    return render_image(layers, size, bbox, bbox_projection)
+
 
+def render_image(layers, size, bbox, bbox_projection):
+    """Render the layers into an image of the given size, or return None if none of
+    them could be rendered
+    """
     image = mapnik.Image(size.width, size.height)
 
-    layers = utils.parse_layers(normalized_args)
     success = False
     for index, layer_name in enumerate(layers):
         if add_layer_to_image(index, layer_name, size, bbox, bbox_projection, image):
@@ -30,6 +83,97 @@ def get_map_image(normalized_args):
     return image
 
 
+def get_requested_tile(normalized_args):
+    """Return the (z, x, y, tile size) description of the tile of the grid (see
+    grid.py) requested by the WMS parameters, or None if they don't describe such a
+    tile
+    """
+    if utils.parse_projection(normalized_args) != grid.PROJECTION.lower():
+        return None
+
+    size = utils.parse_size(normalized_args)
+    if (size.width != size.height) or (
+        size.width not in (grid.TILE_SIZE, 2 * grid.TILE_SIZE)
+    ):
+        return None
+
+    bbox = utils.parse_envelope(normalized_args)
+
+    tile = grid.get_tile((bbox.minx, bbox.miny, bbox.maxx, bbox.maxy))
+    if tile is None:
+        return None
+
+    return tile + (size.width,)
+
+
+def get_metatile_data(normalized_args, tile, mapnik_format):
+    """Render the metatile containing the requested tile in a single pass, store all
+    its tiles in the tile cache and return the encoded requested tile.
+
+    The metatile is rendered with a buffer around it, so that the symbols and labels
+    crossing the edges of its tiles are drawn consistently.
+    """
+    (z, x, y, tile_size) = tile
+
+    config = current_app.config["WMS"]["METATILE"]
+    buffer = int(config["BUFFER"])
+
+    # The number of pixels of the metatile doesn't depend on the size of the tiles
+    (x0, y0, n) = grid.get_metatile(
+        z, x, y, max(1, int(config["SIZE"]) * grid.TILE_SIZE // tile_size)
+    )
+
+    def _get_tile_args(tile_x, tile_y):
+        tile_bbox = grid.get_tile_bbox(z, tile_x, tile_y)
+        return dict(normalized_args, bbox=grid.format_bbox(tile_bbox))
+
+    layers = utils.parse_layers(normalized_args)
+
+    with tile_cache.lock(f"{','.join(layers)} {z} {x0} {y0} {tile_size}"):
+        # Another process might have rendered the metatile in the meantime
+        content = tile_cache.get(tile_cache.make_key(normalized_args))
+        if content is not None:
+            return content
+
+        top_left = grid.get_tile_bbox(z, x0, y0)
+        bottom_right = grid.get_tile_bbox(z, x0 + n - 1, y0 + n - 1)
+        margin = buffer * (top_left[2] - top_left[0]) / tile_size
+
+        bbox = mapnik.Box2d(
+            top_left[0] - margin,
+            bottom_right[1] - margin,
+            bottom_right[2] + margin,
+            top_left[3] + margin,
+        )
+
+        size = n * tile_size + 2 * buffer
+
+        image = render_image(
+            layers,
+            utils.Size(width=size, height=size),
+            bbox,
+            utils.parse_projection(normalized_args),
+        )
+        if image is None:
+            return None
+
+        for i in range(n):
+            for j in range(n):
+                view = image.view(
+                    buffer + i * tile_size, buffer + j * tile_size, tile_size, tile_size
+                )
+
+                tile_content = view.tostring(mapnik_format)
+                tile_cache.put(
+                    tile_cache.make_key(_get_tile_args(x0 + i, y0 + j)), tile_content
+                )
+
+                if (x0 + i == x) and (y0 + j == y):
+                    content = tile_content
+
+    return content
+
+
 def add_layer_to_image(index, layer_name, size, bbox, bbox_projection, image):
     # Create the mapnik layers
     layer = geofile.load(layer_name)
@@ -39,10 +183,52 @@ def add_layer_to_image(index, layer_name, size, bbox, bbox_projection, image):
     if not os.path.exists(layer.storage.get_dir(layer_name, cache=True)):
         return False
 
-    layer_data = layer.get_data_for_bounding_box(bbox, bbox_projection)
+    layer_data = layer.get_data_for_bounding_box(bbox, bbox_projection, size=size)
     if (layer_data is None) or (len(layer_data) == 0):
         return True
 
+    legend = get_layer_legend(layer_name)
+
+    # The mapnik maps can only be reused as long as the files of the layer aren't
+    # modified
+    version = geofile.get_layer_version(layer_name)
+
+    # Render the mapnik layers into the image
+    for i in range(0, len(layer_data), 9):
+        data = layer_data[i : i + 9]
+
+        key = None
+        if version is not None:
+            key = (
+                layer_name,
+                version,
+                registry.hash_legend(legend),
+                index,
+                bbox_projection,
+                tuple(data),
+            )
+
+        # The map is taken out of the registry while rendering, as its size and
+        # bounding box are modified
+        mp = registry.maps.take(key)
+        if mp is None:
+            mp = create_map(index, layer_name, layer, data, legend, bbox_projection)
+
+        mp.resize(size.width, size.height)
+        mp.zoom_to_box(bbox)
+        mapnik.render(mp, image)
+
+        registry.maps.set(key, mp)
+
+    return True
+
+
+def create_map(index, layer_name, layer, data, legend, bbox_projection):
+    """Create a mapnik map containing the mapnik layers corresponding to the data of
+    the layer, along with their styles
+    """
+    mp = mapnik.Map(1, 1, "+init=" + bbox_projection)
+
     # Create the style for the lines (if necessary)
     (type, _, variable, _, _) = path.parse_unique_layer_name(layer_name)
 
@@ -50,114 +236,208 @@ def add_layer_to_image(index, layer_name, size, bbox, bbox_projection, image):
     line_style_name = None
 
     if type == path.VECTOR:
-        line_style, line_style_name = make_line_style(variable)
+        line_style, line_style_name = registry.get_or_create_style(
+            ("line", variable), lambda: make_line_style(variable)
+        )
     elif type == path.AREA:
-        line_style, line_style_name = make_line_style(None)
+        line_style, line_style_name = registry.get_or_create_style(
+            ("line", None), lambda: make_line_style(None)
+        )
 
     if line_style is not None:
         line_style_name += f"_{index}"
+        mp.append_style(line_style_name, line_style)
 
-    # Render the mapnik layers into the image
-    legend_style_created = False
     legend_style = None
     legend_style_name = None
-    legend_images_folder = None
 
-    for i in range(0, len(layer_data) + 1, 9):
-        mp = mapnik.Map(size.width, size.height, "+init=" + bbox_projection)
+    for mapnik_layer in layer.as_mapnik_layers(data=data):
+        # Create the style for the legend (if necessary)
+        if (legend is not None) and (legend_style_name is None):
+            legend_style, legend_style_name = create_style_from_legend(
+                layer_name, layer, mapnik_layer, legend
+            )
+
+            if legend_style is not None:
+                legend_style_name += f"_{index}"
+                mp.append_style(legend_style_name, legend_style)
 
+        # Apply the styles to the mapnik layers
         if line_style is not None:
-            mp.append_style(line_style_name, line_style)
+            mapnik_layer.styles.append(line_style_name)
 
         if legend_style is not None:
-            mp.append_style(legend_style_name, legend_style)
-
-        for mapnik_layer in layer.as_mapnik_layers(data=layer_data[i : i + 9]):
-            # Create the style for the legend (if necessary)
-            if not (legend_style_created) and (
-                path.get_type(layer_name) in (path.RASTER, path.VECTOR, path.CM)
-            ):
-                (
-                    legend_style,
-                    legend_style_name,
-                    legend_images_folder,
-                ) = create_style_from_legend(layer_name, layer, mapnik_layer)
-
-                if legend_style is not None:
-                    legend_style_name += f"_{index}"
-                    mp.append_style(legend_style_name, legend_style)
+            mapnik_layer.styles.append(legend_style_name)
 
-                legend_style_created = True
+        mp.layers.append(mapnik_layer)
 
-            # Apply the styles to the mapnik layers
-            if line_style is not None:
-                mapnik_layer.styles.append(line_style_name)
-
-            if legend_style is not None:
-                mapnik_layer.styles.append(legend_style_name)
-
-            mp.layers.append(mapnik_layer)
+    return mp
 
-        mp.zoom_to_box(bbox)
-        mapnik.render(mp, image)
 
-    # Cleanup
-    if legend_images_folder is not None:
-        shutil.rmtree(legend_images_folder)
+def get_feature_info(normalized_args):
+    """Return the features of the layers found at the position given by the
+    "GetFeatureInfo" parameters, as a GeoJSON FeatureCollection, or None if one of the
+    layers can't be queried.
 
-    return True
+    The features of the vector and area layers are looked up in the spatial index of
+    each layer, without rendering anything: the polygons must contain the position,
+    while the points and lines must be within 3 pixels of it.
 
+    For the raster and CM layers, the value of the pixel at the position is read from
+    each raster file covering it, and returned as a point feature. With the vendor
+    parameter "time_series=true", the values of all the time periods of the dataset
+    of a raster layer are returned at once.
+    """
+    bbox = utils.parse_envelope(normalized_args)
+    bbox_projection = utils.parse_projection(normalized_args)
+    size = utils.parse_size(normalized_args)
+    position = utils.parse_position(normalized_args)
 
-def get_mapnik_map_for_feature_info(normalized_args):
-    """Return the Mapnik object (with hardcoded symbology/rule)."""
+    time_series = normalized_args.get("time_series", "").lower() == "true"
 
-    bbox_projection = utils.parse_projection(normalized_args)
+    resolution = bbox.width() / size.width
+    x = bbox.minx + position.x * resolution
+    y = bbox.maxy - position.y * bbox.height() / size.height
 
-    size = utils.parse_size(normalized_args)
-    mp = mapnik.Map(size.width, size.height, "+init=" + bbox_projection)
+    features = []
 
     layers = utils.parse_layers(normalized_args)
-    for index, layer_name in enumerate(layers):
-        # Only authorized for vector and area layers
-        if path.get_type(layer_name) not in (path.VECTOR, path.AREA):
+    for layer_name in layers:
+        (type, id, variable, time_period, _) = path.parse_unique_layer_name(layer_name)
+        if type is None:
             return None
 
         layer = geofile.load(layer_name)
-        if layer is None:
+        if (layer is None) or not (os.path.exists(layer.storage.get_dir(layer_name))):
             return None
 
-        mapnik_layers = layer.as_mapnik_layers()
-        if (mapnik_layers is None) or (len(mapnik_layers) == 0):
+        if type in (path.RASTER, path.CM):
+            if time_series and (type == path.RASTER) and (time_period is not None):
+                layer_names = _get_time_series_layer_names(id, variable)
+            else:
+                layer_names = [(layer_name, variable)]
+
+            values = {}
+            for name, label in layer_names:
+                layer_values = geofile.load(name).get_values_at(
+                    x, y, bbox_projection, tolerance=resolution
+                )
+
+                if len(layer_values) > 0:
+                    values[label or "value"] = layer_values[0][1]
+
+            if len(values) > 0:
+                features.append(
+                    _make_value_feature(layer_name, x, y, bbox_projection, values)
+                )
+
+            continue
+
+        layer_features = layer.get_features_at(
+            x, y, bbox_projection, tolerance=3 * resolution
+        )
+        if layer_features is None:
             return None
 
-        for mapnik_layer in mapnik_layers:
-            mp.layers.append(mapnik_layer)
+        # Only return the features of the vector layers having the variable
+        if type == path.VECTOR:
+            if not any(
+                f"__variable__{variable}" in feature["properties"]
+                for feature in layer_features
+            ):
+                continue
 
-    return mp
+        features.extend(layer_features)
 
+    return {"features": features}
 
-def delete_image_folders(mp):
-    for folder in mp.legend_images_folders:
-        shutil.rmtree(folder)
 
+def _get_time_series_layer_names(id, variable):
+    """Return the names of the raster layers of a dataset holding a variable, one for
+    each time period available on the disk, along with the labels of their values
+    """
+    parameters = client.get_parameters(id)
+    if parameters is None:
+        return []
 
-def create_style_from_legend(layer_name, layer, mapnik_layer):
-    (type, layer_id, variable, _, _) = path.parse_unique_layer_name(layer_name)
+    datasets.process_parameters(parameters, dataset_id=id, is_raster=True)
+
+    layer_names = []
+    for time_period in parameters.get("time_periods", []):
+        layer_name = path.make_unique_layer_name(
+            path.RASTER, id, variable=variable, time_period=time_period
+        )
+        if layer_name is None:
+            continue
+
+        storage_instance = storage.create(layer_name)
+        if not os.path.exists(storage_instance.get_dir(layer_name)):
+            continue
+
+        if variable is not None:
+            label = f"{variable} ({time_period})"
+        else:
+            label = time_period
+
+        layer_names.append((layer_name, label))
+
+    return layer_names
+
+
+def _make_value_feature(layer_name, x, y, projection, values):
+    """Return a GeoJSON point feature holding the values read in a raster layer at a
+    position, formatted like the features of the vector layers
+    """
+    transform = mapnik.ProjTransform(
+        mapnik.Projection("+init=" + projection),
+        mapnik.Projection("+init=epsg:4326"),
+    )
+    point = transform.forward(mapnik.Coord(x, y))
+
+    return {
+        "type": "Feature",
+        "id": layer_name,
+        "geometry": {"type": "Point", "coordinates": [point.x, point.y]},
+        "properties": {
+            "variables": json.dumps(values),
+            "units": json.dumps({}),
+        },
+    }
+
+
+def get_layer_legend(layer_name):
+    """Return the legend used to style a layer, or None if the layer isn't styled
+    according to a legend. The legends of the vector and raster layers are read from
+    the legend files written by the cache builder. Only the layers cached without
+    legend file (before the legend files existed, until 'flask update-legends' is
+    run) use the legend stored in the database.
+    """
+    (type, _, _, _, _) = path.parse_unique_layer_name(layer_name)
 
-    # Get the layer style and type
     if type in (path.VECTOR, path.RASTER):
-        legend = client.get_legend(layer_name, ttl_hash=client.get_ttl_hash(30))
+        legend = geofile.get_layer_legend(layer_name)
+        if (legend is None) and not geofile.has_layer_legends(layer_name):
+            legend = get_database_legend(
+                layer_name, geofile.get_layer_version(layer_name)
+            )
     elif type == path.CM:
         legend = geofile.get_cm_legend(layer_name)
     else:
-        legend = None
+        return None
 
     if (legend is None) or (len(legend["symbology"]) == 0):
         legend = create_default_legend(type)
 
+    return legend
+
+
+def create_style_from_legend(layer_name, layer, mapnik_layer, legend):
+    (type, layer_id, variable, _, _) = path.parse_unique_layer_name(layer_name)
+
+    legend_hash = registry.hash_legend(legend)
+
     mapnik_style = None
     style_name = None
-    legend_images_folder = None
 
     if type == path.VECTOR:
         if variable is None:
@@ -170,22 +450,51 @@ def create_style_from_legend(layer_name, layer, mapnik_layer):
                 variable = variables[0].replace("__variable__", "")
 
         if mapnik_layer.datasource.geometry_type() is mapnik.DataGeometryType.Polygon:
-            mapnik_style, style_name = make_polygon_style(variable, legend)
+            mapnik_style, style_name = registry.get_or_create_style(
+                (layer_name, legend_hash, "polygon", variable),
+                lambda: make_polygon_style(variable, legend),
+            )
         else:
-            legend_images, legend_images_folder = layer.get_legend_images(legend)
-            mapnik_style, style_name = make_point_style(variable, legend, legend_images)
+            mapnik_style, style_name = registry.get_or_create_style(
+                (layer_name, legend_hash, "point", variable),
+                lambda: make_point_style(
+                    variable, legend, layer.get_legend_images(legend, legend_hash)
+                ),
+            )
 
     elif type in (path.RASTER, path.CM):
-        mapnik_style, style_name = make_raster_style(legend)
+        mapnik_style, style_name = registry.get_or_create_style(
+            (layer_name, legend_hash, "raster"), lambda: make_raster_style(legend)
+        )
+
+    return (mapnik_style, style_name)
 
-    return (mapnik_style, style_name, legend_images_folder)
 
+@lru_cache(maxsize=128)
+def get_database_legend(layer_name, version):
+    """Return the legend of a layer stored in the database. The legend is shared by
+    all the callers, and must not be modified. The version of the layer is part of
+    the cache key, so the legend is fetched again once the layer is updated.
+    """
+    current_app.logger.warning(
+        f"No legend file for layer <{layer_name}>, run 'flask update-legends'"
+    )
+    return client.get_legend(layer_name)
 
-def create_default_legend(type):
+
+@lru_cache(maxsize=32)
+def create_default_legend(type, min_value=None, max_value=None):
+    """Return a legend with shades of red spread over a range of values (by default,
+    the one of the images with 8-bit pixels). The legend is shared by all the
+    callers, and must not be modified.
+    """
     legend = {"symbology": []}
 
-    min_value = 1 if type in (path.RASTER, path.CM) else 0
-    max_value = 255
+    if min_value is None:
+        min_value = 1 if type in (path.RASTER, path.CM) else 0
+
+    if max_value is None:
+        max_value = 255
     color = (1, 0, 0)  # Default red
     nb_of_colors = 8
 
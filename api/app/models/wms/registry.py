@@ -0,0 +1,121 @@
+"""Per-worker registry of the mapnik objects used by the "GetMap" operation.
+
+Compiling the styles of a layer and opening its datasources is a large part of the
+cost of rendering an image, while those objects only change when the legend or the
+files of the layer change. The registry keeps them across requests, so that a warm
+request only has to set the size and bounding box of an already built map before
+rendering it.
+
+Each worker process has its own registry: mapnik objects can't be shared between
+processes. A map is taken out of the registry while it is rendered, and put back
+afterwards, so it is never rendered by two threads at once: a concurrent request for
+the same layer builds its own map instead.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# Maximal number of entries kept in each part of the registry
+MAX_STYLES = 256
+MAX_MAPS = 64
+
+
+class LRURegistry(object):
+    """Mapping keeping at most `max_entries` entries, evicting the least recently
+    used ones first.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key is None:
+            return None
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def take(self, key):
+        """Remove the entry of the key from the registry, and return its value (or
+        None), giving the caller exclusive use of it until it is set again
+        """
+        if key is None:
+            return None
+
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if key is None:
+            return
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+styles = LRURegistry(MAX_STYLES)
+maps = LRURegistry(MAX_MAPS)
+
+
+def hash_legend(legend):
+    """Return a hash identifying the content of a legend"""
+    if legend is None:
+        return None
+
+    return hashlib.sha256(json.dumps(legend, sort_keys=True).encode()).hexdigest()
+
+
+def get_or_create_style(key, factory):
+    """Return the (style, style name) tuple registered under the key, creating it
+    with factory() if necessary
+    """
+    result = styles.get(key)
+    if result is None:
+        result = factory()
+        styles.set(key, result)
+
+    return result
+
+
+def clear():
+    """Forget all the mapnik objects of the current worker process"""
+    styles.clear()
+    maps.clear()
+
+
+def get_stats():
+    """Return the counters of the registry of the current worker process"""
+    return {
+        "styles": len(styles.entries),
+        "style_hits": styles.hits,
+        "style_misses": styles.misses,
+        "maps": len(maps.entries),
+        "map_hits": maps.hits,
+        "map_misses": maps.misses,
+    }
@@ -0,0 +1,77 @@
+import unittest
+
+from . import grid
+
+
+class GetTileBboxTest(unittest.TestCase):
+    def testWorld(self):
+        bbox = grid.get_tile_bbox(0, 0, 0)
+        self.assertEqual(bbox, (-grid.EXTENT, -grid.EXTENT, grid.EXTENT, grid.EXTENT))
+
+    def testTopLeft(self):
+        (min_x, min_y, max_x, max_y) = grid.get_tile_bbox(2, 0, 0)
+
+        self.assertAlmostEqual(min_x, -grid.EXTENT)
+        self.assertAlmostEqual(max_x, -grid.EXTENT / 2)
+        self.assertAlmostEqual(min_y, grid.EXTENT / 2)
+        self.assertAlmostEqual(max_y, grid.EXTENT)
+
+
+class GetTileAtTest(unittest.TestCase):
+    def testCorners(self):
+        self.assertEqual(grid.get_tile_at(3, -180, 90), (0, 0))
+        self.assertEqual(grid.get_tile_at(3, 180, -90), (7, 7))
+
+    def testCenter(self):
+        self.assertEqual(grid.get_tile_at(1, 10, 45), (1, 0))
+        self.assertEqual(grid.get_tile_at(1, -10, -45), (0, 1))
+
+
+class GetTilesInBboxTest(unittest.TestCase):
+    def testWorld(self):
+        self.assertEqual(len(grid.get_tiles_in_bbox(2, -180, -90, 180, 90)), 16)
+
+    def testEurope(self):
+        tiles = grid.get_tiles_in_bbox(4, -10, 35, 30, 70)
+        self.assertEqual(tiles, [(x, y) for x in range(7, 10) for y in range(3, 7)])
+
+
+class GetGetMapArgsTest(unittest.TestCase):
+    def testBbox(self):
+        args = grid.get_getmap_args("raster/42", 1, 1, 0)
+
+        self.assertEqual(args["layers"], "raster/42")
+        self.assertEqual(args["srs"], "EPSG:3857")
+        self.assertEqual(
+            [float(x) for x in args["bbox"].split(",")],
+            [0.0, 0.0, grid.EXTENT, grid.EXTENT],
+        )
+
+
+class GetTileTest(unittest.TestCase):
+    def testTile(self):
+        self.assertEqual(grid.get_tile(grid.get_tile_bbox(5, 17, 10)), (5, 17, 10))
+        self.assertEqual(grid.get_tile(grid.get_tile_bbox(0, 0, 0)), (0, 0, 0))
+
+    def testFormattedBbox(self):
+        bbox = grid.format_bbox(grid.get_tile_bbox(12, 2100, 1400))
+        self.assertEqual(
+            grid.get_tile([float(x) for x in bbox.split(",")]), (12, 2100, 1400)
+        )
+
+    def testNotATile(self):
+        (min_x, min_y, max_x, max_y) = grid.get_tile_bbox(5, 17, 10)
+
+        self.assertIsNone(grid.get_tile((min_x + 1000, min_y, max_x + 1000, max_y)))
+        self.assertIsNone(grid.get_tile((min_x, min_y, max_x, max_y + 1000)))
+        self.assertIsNone(grid.get_tile((0, 0, 1000, 1000)))
+
+
+class GetMetatileTest(unittest.TestCase):
+    def testMetatile(self):
+        self.assertEqual(grid.get_metatile(10, 17, 10, 8), (16, 8, 8))
+        self.assertEqual(grid.get_metatile(10, 16, 15, 8), (16, 8, 8))
+
+    def testLowZoomLevel(self):
+        self.assertEqual(grid.get_metatile(1, 1, 0, 8), (0, 0, 2))
+        self.assertEqual(grid.get_metatile(0, 0, 0, 8), (0, 0, 1))
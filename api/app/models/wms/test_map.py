@@ -0,0 +1,56 @@
+import os
+from unittest.mock import patch
+
+from app.common import path
+from app.common.test import BaseApiTest
+from app.models import geofile, storage
+from app.models.wms import map as wms_map
+
+LEGEND = {"symbology": [{"red": 255, "green": 0, "blue": 0, "value": 1}]}
+LEGEND2 = {"symbology": [{"red": 0, "green": 0, "blue": 255, "value": 1}]}
+
+
+@patch("app.common.client.get_legend")
+class TestGetLayerLegend(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        wms_map.get_database_legend.cache_clear()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create("vector/42")
+            os.makedirs(storage_instance.get_dir("vector/42"))
+
+    def testLegendFile(self, get_legend_mock):
+        with self.flask_app.app_context():
+            self.assertTrue(geofile.save_layer_legends("vector/42", {"": LEGEND}))
+            self.assertEqual(wms_map.get_layer_legend("vector/42"), LEGEND)
+            get_legend_mock.assert_not_called()
+
+    def testMissingVariable(self, get_legend_mock):
+        with self.flask_app.app_context():
+            self.assertTrue(geofile.save_layer_legends("vector/42", {"": LEGEND}))
+
+            layer_name = path.make_unique_layer_name(path.VECTOR, 42, "heat")
+            self.assertEqual(
+                wms_map.get_layer_legend(layer_name),
+                wms_map.create_default_legend(path.VECTOR),
+            )
+            get_legend_mock.assert_not_called()
+
+    def testNoLegendFile(self, get_legend_mock):
+        with self.flask_app.app_context():
+            get_legend_mock.return_value = LEGEND2
+
+            self.assertEqual(wms_map.get_layer_legend("vector/42"), LEGEND2)
+            self.assertEqual(wms_map.get_layer_legend("vector/42"), LEGEND2)
+            get_legend_mock.assert_called_once_with("vector/42")
+
+    def testNoLegendInDatabase(self, get_legend_mock):
+        with self.flask_app.app_context():
+            get_legend_mock.return_value = None
+
+            self.assertEqual(
+                wms_map.get_layer_legend("vector/42"),
+                wms_map.create_default_legend(path.VECTOR),
+            )
@@ -0,0 +1,90 @@
+import unittest
+
+from . import registry
+
+
+class LRURegistryTest(unittest.TestCase):
+    def testEviction(self):
+        lru = registry.LRURegistry(2)
+
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+
+        self.assertEqual(lru.get("a"), 1)
+        self.assertTrue(lru.get("b") is None)
+        self.assertEqual(lru.get("c"), 3)
+
+    def testNoKey(self):
+        lru = registry.LRURegistry(2)
+
+        lru.set(None, 1)
+        self.assertTrue(lru.get(None) is None)
+        self.assertEqual(len(lru.entries), 0)
+
+    def testTake(self):
+        lru = registry.LRURegistry(2)
+
+        lru.set("a", 1)
+        self.assertEqual(lru.take("a"), 1)
+
+        # Another user of the key doesn't get the same value until it is set again
+        self.assertTrue(lru.take("a") is None)
+        self.assertTrue(lru.get("a") is None)
+
+        lru.set("a", 1)
+        self.assertEqual(lru.get("a"), 1)
+
+    def testCounters(self):
+        lru = registry.LRURegistry(2)
+
+        lru.get("a")
+        lru.set("a", 1)
+        lru.get("a")
+
+        self.assertEqual(lru.hits, 1)
+        self.assertEqual(lru.misses, 1)
+
+
+class HashLegendTest(unittest.TestCase):
+    LEGEND = {
+        "symbology": [
+            {"red": 255, "green": 0, "blue": 0, "value": 1, "opacity": 1.0},
+        ]
+    }
+
+    def testSameLegend(self):
+        legend = {"symbology": [dict(reversed(self.LEGEND["symbology"][0].items()))]}
+        self.assertEqual(
+            registry.hash_legend(self.LEGEND), registry.hash_legend(legend)
+        )
+
+    def testDifferentLegend(self):
+        legend = {"symbology": [dict(self.LEGEND["symbology"][0], red=0)]}
+        self.assertNotEqual(
+            registry.hash_legend(self.LEGEND), registry.hash_legend(legend)
+        )
+
+    def testNoLegend(self):
+        self.assertTrue(registry.hash_legend(None) is None)
+
+
+class GetOrCreateStyleTest(unittest.TestCase):
+    def setUp(self):
+        registry.clear()
+
+    def testCreatedOnce(self):
+        calls = []
+
+        def _factory():
+            calls.append(1)
+            return ("STYLE", "style_name")
+
+        self.assertEqual(
+            registry.get_or_create_style("key", _factory), ("STYLE", "style_name")
+        )
+        self.assertEqual(
+            registry.get_or_create_style("key", _factory), ("STYLE", "style_name")
+        )
+        self.assertEqual(len(calls), 1)
@@ -0,0 +1,301 @@
+import fcntl
+import os
+import shutil
+import time
+from unittest.mock import patch
+
+from app.common import path
+from app.common.test import BaseApiTest
+from app.models import geofile, storage
+from app.models.wms import grid, tile_cache
+
+LAYER_NAME = path.make_unique_layer_name(path.AREA, "example")
+
+GETMAP_ARGS = {
+    "service": "WMS",
+    "request": "GetMap",
+    "layers": LAYER_NAME,
+    "styles": "",
+    "format": "image/png",
+    "transparent": "true",
+    "version": "1.1.1",
+    "width": "256",
+    "height": "256",
+    "srs": "EPSG:3857",
+    "bbox": "19567.87924100512,6809621.975869781,39135.75848201024,6829189.85511079",
+}
+
+
+class TileCacheTestBase(BaseApiTest):
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create(LAYER_NAME)
+            os.makedirs(storage_instance.get_dir(LAYER_NAME))
+
+
+class TestMakeKey(TileCacheTestBase):
+    def testNoVersion(self):
+        with self.flask_app.app_context():
+            self.assertTrue(tile_cache.make_key(GETMAP_ARGS) is None)
+
+    def testDisabled(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+            self.flask_app.config["WMS"]["TILE_CACHE"]["ENABLED"] = False
+            try:
+                self.assertTrue(tile_cache.make_key(GETMAP_ARGS) is None)
+            finally:
+                self.flask_app.config["WMS"]["TILE_CACHE"]["ENABLED"] = True
+
+    def testSameParameters(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+
+            key1 = tile_cache.make_key(GETMAP_ARGS)
+            key2 = tile_cache.make_key(dict(GETMAP_ARGS))
+
+            self.assertTrue(key1 is not None)
+            self.assertEqual(key1, key2)
+
+    def testEquivalentBoundingBox(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+
+            args = dict(GETMAP_ARGS)
+            args["bbox"] = ",".join(
+                ["19567.879241005120", "6809621.97586978"]
+                + GETMAP_ARGS["bbox"].split(",")[2:]
+            )
+
+            self.assertEqual(
+                tile_cache.make_key(GETMAP_ARGS), tile_cache.make_key(args)
+            )
+
+    def testDifferentParameters(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+
+            key = tile_cache.make_key(GETMAP_ARGS)
+
+            for name, value in (
+                ("width", "512"),
+                ("format", "image/jpg"),
+                ("bbox", "0,6809621.975869781,39135.75848201024,6829189.85511079"),
+            ):
+                args = dict(GETMAP_ARGS)
+                args[name] = value
+                self.assertNotEqual(key, tile_cache.make_key(args), name)
+
+    def testNewVersion(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+            key1 = tile_cache.make_key(GETMAP_ARGS)
+
+            geofile.update_layer_version(LAYER_NAME)
+            key2 = tile_cache.make_key(GETMAP_ARGS)
+
+            self.assertNotEqual(key1, key2)
+
+
+class TestGetPut(TileCacheTestBase):
+    def testMiss(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+            key = tile_cache.make_key(GETMAP_ARGS)
+
+            misses = tile_cache.stats["misses"]
+            self.assertTrue(tile_cache.get(key) is None)
+            self.assertEqual(tile_cache.stats["misses"], misses + 1)
+
+    def testMemoryHit(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+            key = tile_cache.make_key(GETMAP_ARGS)
+
+            tile_cache.put(key, b"IMAGE")
+
+            hits = tile_cache.stats["memory_hits"]
+            self.assertEqual(tile_cache.get(key), b"IMAGE")
+            self.assertEqual(tile_cache.stats["memory_hits"], hits + 1)
+
+    def testDiskHit(self):
+        with self.flask_app.app_context():
+            geofile.update_layer_version(LAYER_NAME)
+            key = tile_cache.make_key(GETMAP_ARGS)
+
+            tile_cache.put(key, b"IMAGE")
+            tile_cache._get_memory_cache().clear()
+
+            hits = tile_cache.stats["disk_hits"]
+            self.assertEqual(tile_cache.get(key), b"IMAGE")
+            self.assertEqual(tile_cache.stats["disk_hits"], hits + 1)
+
+    def testNoKey(self):
+        with self.flask_app.app_context():
+            tile_cache.put(None, b"IMAGE")
+            self.assertTrue(tile_cache.get(None) is None)
+            self.assertFalse(os.path.exists(tile_cache.DiskCache.get_dir()))
+
+
+class TestMemoryCache(BaseApiTest):
+    def testEviction(self):
+        cache = tile_cache.MemoryCache(10)
+
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        cache.get("a")
+        cache.set("c", b"1234")
+
+        self.assertEqual(cache.get("a"), b"1234")
+        self.assertTrue(cache.get("b") is None)
+        self.assertEqual(cache.get("c"), b"1234")
+        self.assertEqual(cache.size, 8)
+
+    def testTooBig(self):
+        cache = tile_cache.MemoryCache(10)
+        cache.set("a", b"12345678901")
+        self.assertTrue(cache.get("a") is None)
+        self.assertEqual(cache.size, 0)
+
+
+class TestDiskCache(BaseApiTest):
+    def testEviction(self):
+        with self.flask_app.app_context():
+            cache = tile_cache.DiskCache()
+
+            cache.set("aa", b"1234", 100)
+            cache.set("bb", b"1234", 100)
+            os.utime(cache.get_file_path("aa"), (0, 0))
+
+            cache.evict(6)
+
+            self.assertFalse(os.path.exists(cache.get_file_path("aa")))
+            self.assertTrue(os.path.exists(cache.get_file_path("bb")))
+
+    def testTmpFiles(self):
+        with self.flask_app.app_context():
+            cache = tile_cache.DiskCache()
+            cache.set("aa", b"1234", 100)
+
+            folder = os.path.dirname(cache.get_file_path("aa"))
+            for name in (".old.tmp", ".new.tmp"):
+                with open(os.path.join(folder, name), "wb") as f:
+                    f.write(b"1234")
+
+            os.utime(os.path.join(folder, ".old.tmp"), (0, 0))
+
+            cache.evict(100)
+
+            self.assertFalse(os.path.exists(os.path.join(folder, ".old.tmp")))
+            self.assertTrue(os.path.exists(os.path.join(folder, ".new.tmp")))
+            self.assertTrue(os.path.exists(cache.get_file_path("aa")))
+
+    def testSharedWrittenSize(self):
+        with self.flask_app.app_context():
+            cache1 = tile_cache.DiskCache()
+            cache2 = tile_cache.DiskCache()
+
+            with patch.object(tile_cache.DiskCache, "start_eviction") as start_mock:
+                cache1.set("aa", b"1234", 100)
+                cache2.set("bb", b"1234", 100)
+                start_mock.assert_not_called()
+
+                # A tenth of the maximal size was written by both caches
+                cache1.set("cc", b"1234", 100)
+                start_mock.assert_called_once_with(100)
+
+                cache2.set("dd", b"1234", 100)
+                start_mock.assert_called_once_with(100)
+
+    def testBackgroundEviction(self):
+        with self.flask_app.app_context():
+            cache = tile_cache.DiskCache()
+
+            cache.set("aa", b"1234", 100)
+            os.utime(cache.get_file_path("aa"), (0, 0))
+            cache.set("bb", b"1234", 6)
+
+            for _ in range(100):
+                if not cache.evicting:
+                    break
+                time.sleep(0.01)
+
+            self.assertFalse(os.path.exists(cache.get_file_path("aa")))
+            self.assertTrue(os.path.exists(cache.get_file_path("bb")))
+
+    def testEvictionInProgress(self):
+        with self.flask_app.app_context():
+            cache = tile_cache.DiskCache()
+
+            cache.set("aa", b"1234", 100)
+            cache.set("bb", b"1234", 100)
+
+            lock_filename = os.path.join(cache.get_dir(), cache.EVICTION_LOCK_FILENAME)
+            with open(lock_filename, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                cache.evict(6)
+
+            self.assertTrue(os.path.exists(cache.get_file_path("aa")))
+
+
+class TestGetMapWorkflow(TileCacheTestBase):
+    def setUp(self):
+        super().setUp()
+
+        with self.flask_app.app_context():
+            storage_instance = storage.create(LAYER_NAME)
+
+            shutil.copy(
+                self.get_testdata_path("example.geojson"),
+                storage_instance.get_geojson_file(LAYER_NAME),
+            )
+
+            geofile.update_layer_version(LAYER_NAME)
+
+    def testCachedResponse(self):
+        response1 = self.client.get("api/wms", query_string=GETMAP_ARGS)
+        self.assertStatusCodeEqual(response1, 200)
+
+        hits = tile_cache.stats["memory_hits"]
+
+        response2 = self.client.get("api/wms", query_string=GETMAP_ARGS)
+        self.assertStatusCodeEqual(response2, 200)
+
+        self.assertEqual(tile_cache.stats["memory_hits"], hits + 1)
+        self.assertEqual(response1.data, response2.data)
+        self.assertEqual(response2.mimetype, "image/png")
+
+    def testMetatile(self):
+        self.flask_app.config["WMS"]["METATILE"]["ENABLED"] = True
+        try:
+            response = self.client.get("api/wms", query_string=GETMAP_ARGS)
+            self.assertStatusCodeEqual(response, 200)
+
+            # The neighbouring tile belongs to the same metatile, so it was rendered
+            # and cached along with the requested one
+            hits = tile_cache.stats["memory_hits"]
+
+            response = self.client.get(
+                "api/wms", query_string=grid.get_getmap_args(LAYER_NAME, 11, 1024, 675)
+            )
+            self.assertStatusCodeEqual(response, 200)
+
+            self.assertEqual(tile_cache.stats["memory_hits"], hits + 1)
+        finally:
+            self.flask_app.config["WMS"]["METATILE"]["ENABLED"] = False
+
+    def testNoMetatileByDefault(self):
+        response = self.client.get("api/wms", query_string=GETMAP_ARGS)
+        self.assertStatusCodeEqual(response, 200)
+
+        # Only the requested tile was rendered
+        hits = tile_cache.stats["memory_hits"]
+
+        response = self.client.get(
+            "api/wms", query_string=grid.get_getmap_args(LAYER_NAME, 11, 1024, 675)
+        )
+        self.assertStatusCodeEqual(response, 200)
+
+        self.assertEqual(tile_cache.stats["memory_hits"], hits)
@@ -0,0 +1,423 @@
+"""Cache of the images rendered by the "GetMap" operation of the Web Map Service.
+
+Rendering an image with mapnik is by far the most expensive part of the WMS, and
+while the user is panning the map the same images are requested again and again.
+The encoded images are thus kept in two levels of cache:
+
+* an in-memory cache, private to each worker process
+* an on-disk cache (in WMS_CACHE_DIR/tiles), shared by all the worker processes
+
+Both levels are bounded in size and evict their least recently used entries first.
+
+The entries are keyed on the normalized WMS parameters and on the version stamp of
+each requested layer (see geofile.update_layer_version()). As the stamp of a layer
+changes each time the layer is rewritten by the cache builder, an image rendered from
+an outdated layer can't be reached anymore, and is evicted over time. Layers without
+a version stamp are never cached.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+from flask import current_app, safe_join
+
+from app.models import geofile
+from app.models.wms import utils
+
+# Version of the format of the keys, to change each time the rendering is modified in
+# a way that makes the images already in the cache invalid
+KEY_VERSION = 1
+
+# Number of significant digits kept from the coordinates of the bounding box, enough
+# to distinguish the pixels of a 2048x2048 image at any zoom level
+BBOX_PRECISION = 10
+
+# Number of lock files shared by all the rendering jobs (see lock())
+NB_LOCKS = 256
+
+# Age (in seconds) after which the temporary files left by a killed worker are
+# deleted by the eviction passes
+TMP_MAX_AGE = 3600
+
+
+class MemoryCache(object):
+    """In-memory LRU cache of byte strings, bounded by the total size of its
+    values.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            content = self.entries.get(key)
+            if content is not None:
+                self.entries.move_to_end(key)
+
+            return content
+
+    def set(self, key, content):
+        if len(content) > self.max_size:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self.entries[key] = content
+            self.size += len(content)
+
+            while self.size > self.max_size:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiskCache(object):
+    """On-disk LRU cache of byte strings, bounded by the total size of its files.
+
+    The modification time of the files is updated on each hit, so the files not used
+    for the longest time are the first to be evicted. The workers share the number
+    of bytes written since the last eviction pass (in a file of the cache), and the
+    worker making it reach a tenth of the maximal size starts a new pass, in a
+    background thread so the request isn't delayed: the cache can thus be a little
+    bigger than its maximal size between two passes.
+    """
+
+    WRITTEN_FILENAME = ".written"
+    EVICTION_LOCK_FILENAME = ".eviction.lock"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.evicting = False
+
+    @staticmethod
+    def get_dir():
+        return safe_join(current_app.config["WMS_CACHE_DIR"], "tiles")
+
+    def get_file_path(self, key):
+        return safe_join(self.get_dir(), key[:2], key)
+
+    def get(self, key):
+        filename = self.get_file_path(key)
+
+        try:
+            with open(filename, "rb") as f:
+                content = f.read()
+
+            os.utime(filename)
+        except OSError:
+            return None
+
+        return content
+
+    def set(self, key, content, max_size):
+        if len(content) > max_size:
+            return
+
+        filename = self.get_file_path(key)
+        folder = os.path.dirname(filename)
+
+        try:
+            os.makedirs(folder, exist_ok=True)
+
+            fd, tmp_filepath = mkstemp(dir=folder, prefix=".", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+
+            os.replace(tmp_filepath, filename)
+        except OSError as e:
+            current_app.logger.error(f"Failed to save the image in the cache: {e}")
+            return
+
+        if self.add_written(len(content), max_size / 10):
+            self.start_eviction(max_size)
+
+    def add_written(self, size, threshold):
+        """Add a number of bytes to the ones written by all the workers since the last
+        eviction pass. Return True if they reach the threshold, the count being then
+        reset.
+        """
+        filename = safe_join(self.get_dir(), self.WRITTEN_FILENAME)
+
+        try:
+            with open(filename, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    written = int(f.read() or 0) + size
+
+                    due = written >= threshold
+                    if due:
+                        written = 0
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write(str(written))
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            current_app.logger.error(f"Failed to update the size of the cache: {e}")
+            return False
+
+        return due
+
+    def start_eviction(self, max_size):
+        """Run an eviction pass in a background thread, unless one is already running
+        in the current process
+        """
+        with self.lock:
+            if self.evicting:
+                return
+
+            self.evicting = True
+
+        thread = threading.Thread(
+            target=self._run_eviction,
+            args=(current_app._get_current_object(), max_size),
+            name="DiskCacheEviction",
+            daemon=True,
+        )
+        thread.start()
+
+    def _run_eviction(self, app, max_size):
+        try:
+            with app.app_context():
+                self.evict(max_size)
+        except Exception as e:
+            app.logger.error(f"Failed to evict the images of the cache: {e}")
+        finally:
+            with self.lock:
+                self.evicting = False
+
+    def evict(self, max_size):
+        """Delete the least recently used files until the cache takes less than 90%
+        of its maximal size, along with the old temporary files. Nothing is done if
+        another process is already doing it.
+        """
+        folder = self.get_dir()
+        os.makedirs(folder, exist_ok=True)
+
+        with open(safe_join(folder, self.EVICTION_LOCK_FILENAME), "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                self._evict(folder, max_size)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _evict(self, folder, max_size):
+        entries = []
+        total_size = 0
+
+        tmp_deadline = time.time() - TMP_MAX_AGE
+
+        for root, _, filenames in os.walk(folder):
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                try:
+                    st = os.stat(filepath)
+                except OSError:
+                    continue
+
+                # The files of the cache itself, and the temporary files (removed
+                # once old enough to not be written anymore)
+                if filename.startswith("."):
+                    if filename.endswith(".tmp") and (st.st_mtime < tmp_deadline):
+                        _remove_file(filepath)
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, filepath))
+                total_size += st.st_size
+
+        if total_size <= max_size:
+            return
+
+        entries.sort()
+
+        for _, size, filepath in entries:
+            if total_size <= max_size * 0.9:
+                break
+
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue
+
+            total_size -= size
+            stats["evictions"] += 1
+
+
+def _remove_file(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+
+stats = {
+    "memory_hits": 0,
+    "disk_hits": 0,
+    "misses": 0,
+    "evictions": 0,
+}
+
+_memory_cache = None
+_disk_cache = DiskCache()
+
+
+def _get_config():
+    return current_app.config["WMS"]["TILE_CACHE"]
+
+
+def _get_memory_cache():
+    global _memory_cache
+
+    max_size = int(_get_config()["MEMORY_SIZE"])
+    if (_memory_cache is None) or (_memory_cache.max_size != max_size):
+        _memory_cache = MemoryCache(max_size)
+
+    return _memory_cache
+
+
+def make_key(normalized_args):
+    """Return the key identifying the image described by the (normalized) WMS
+    parameters, or None if that image must not be cached.
+    """
+    if not _get_config()["ENABLED"]:
+        return None
+
+    layers = utils.parse_layers(normalized_args)
+    size = utils.parse_size(normalized_args)
+    bbox = utils.parse_envelope(normalized_args)
+    bbox_projection = utils.parse_projection(normalized_args)
+
+    versions = []
+    for layer_name in layers:
+        version = geofile.get_layer_version(layer_name)
+        if version is None:
+            return None
+
+        versions.append(version)
+
+    coordinates = [
+        f"{x:.{BBOX_PRECISION}g}" for x in (bbox.minx, bbox.miny, bbox.maxx, bbox.maxy)
+    ]
+
+    parts = [
+        str(KEY_VERSION),
+        ",".join(layers),
+        ",".join(versions),
+        normalized_args.get("styles", ""),
+        bbox_projection,
+        ",".join(coordinates),
+        f"{size.width}x{size.height}",
+        normalized_args.get("format", ""),
+        normalized_args.get("transparent", "").lower(),
+    ]
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def make_tile_key(layer_name, z, x, y, format):
+    """Return the key identifying a tile (z, x, y) of the XYZ grid of a layer in a
+    format that isn't produced by the WMS (like vector tiles), or None if that tile
+    must not be cached.
+    """
+    if not _get_config()["ENABLED"]:
+        return None
+
+    version = geofile.get_layer_version(layer_name)
+    if version is None:
+        return None
+
+    parts = [str(KEY_VERSION), layer_name, version, f"{z}/{x}/{y}", format]
+
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+def get(key):
+    """Return the encoded image corresponding to the key, or None if it isn't in the
+    cache.
+    """
+    if key is None:
+        return None
+
+    content = _get_memory_cache().get(key)
+    if content is not None:
+        stats["memory_hits"] += 1
+        return content
+
+    content = _disk_cache.get(key)
+    if content is not None:
+        stats["disk_hits"] += 1
+        _get_memory_cache().set(key, content)
+        return content
+
+    stats["misses"] += 1
+    return None
+
+
+def put(key, content):
+    """Store the encoded image corresponding to the key in the cache"""
+    if key is None:
+        return
+
+    _get_memory_cache().set(key, content)
+    _disk_cache.set(key, content, int(_get_config()["DISK_SIZE"]))
+
+
+@contextmanager
+def lock(name):
+    """Context manager preventing several processes to do the job identified by the
+    name at the same time (like rendering the same metatile), so that the ones
+    waiting can retrieve its result from the cache instead of doing it again.
+
+    The jobs share a fixed number of lock files, so that they don't need to be
+    deleted: two unrelated jobs might thus sometimes wait for each other.
+    """
+    folder = safe_join(current_app.config["WMS_CACHE_DIR"], "locks")
+    os.makedirs(folder, exist_ok=True)
+
+    index = int(hashlib.sha256(name.encode()).hexdigest()[:8], 16) % NB_LOCKS
+
+    with open(safe_join(folder, str(index)), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_stats():
+    """Return the counters of the cache of the current worker process"""
+    result = dict(stats)
+
+    lookups = result["memory_hits"] + result["disk_hits"] + result["misses"]
+    if lookups > 0:
+        result["hit_rate"] = (result["memory_hits"] + result["disk_hits"]) / lookups
+    else:
+        result["hit_rate"] = None
+
+    if _memory_cache is not None:
+        result["memory_size"] = _memory_cache.size
+        result["memory_entries"] = len(_memory_cache.entries)
+
+    return result
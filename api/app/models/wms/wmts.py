@@ -0,0 +1,122 @@
+"""Functions related to the Web Map Tile Service (WMTS)
+
+The tiles are served on the grid of the XYZ tiles of the frontend (see grid.py), known
+in WMTS as the "GoogleMapsCompatible" tile matrix set, and rendered like the images of
+the WMS.
+"""
+from flask import current_app
+from lxml import etree  # nosec
+
+from app.common import client, path
+from app.models import storage
+from app.models.wms import grid
+from app.models.wms.capabilities import get_layer_names
+
+WMTS_NAMESPACE = "http://www.opengis.net/wmts/1.0"
+OWS_NAMESPACE = "http://www.opengis.net/ows/1.1"
+XLINK_NAMESPACE = "http://www.w3.org/1999/xlink"
+
+TILE_MATRIX_SET = "GoogleMapsCompatible"
+
+
+def _wmts(tag):
+    return f"{{{WMTS_NAMESPACE}}}{tag}"
+
+
+def _ows(tag):
+    return f"{{{OWS_NAMESPACE}}}{tag}"
+
+
+def _add(parent, tag, text=None, **attributes):
+    node = etree.SubElement(parent, tag, **attributes)
+    if text is not None:
+        node.text = str(text)
+    return node
+
+
+def get_capabilities(base_url):
+    """Return an xml description of the capabilities of the WMTS, whose tiles are
+    available under base_url
+    """
+    datasets = client.get_dataset_list()
+    if len(datasets) == 0:
+        return None
+
+    root = etree.Element(
+        _wmts("Capabilities"),
+        nsmap={None: WMTS_NAMESPACE, "ows": OWS_NAMESPACE, "xlink": XLINK_NAMESPACE},
+        version="1.0.0",
+    )
+
+    identification = _add(root, _ows("ServiceIdentification"))
+    _add(identification, _ows("Title"), "EnerMaps")
+    _add(identification, _ows("ServiceType"), "OGC WMTS")
+    _add(identification, _ows("ServiceTypeVersion"), "1.0.0")
+
+    contents = _add(root, _wmts("Contents"))
+
+    for dataset in datasets:
+        for layer_name in get_layer_names(dataset):
+            add_layer(contents, dataset, layer_name, base_url)
+
+    add_tile_matrix_set(contents)
+
+    etree.indent(root, space="    ")
+
+    return etree.tostring(root, pretty_print=True)
+
+
+def add_layer(contents, dataset, layer_name, base_url):
+    (type, _, variable, time_period, _) = path.parse_unique_layer_name(layer_name)
+
+    bbox = storage.create(layer_name).get_bbox(layer_name)
+
+    layer_node = _add(contents, _wmts("Layer"))
+
+    title = " / ".join(
+        [dataset["title"]] + [str(x) for x in (variable, time_period) if x is not None]
+    )
+    _add(layer_node, _ows("Title"), title)
+
+    bbox_node = _add(layer_node, _ows("WGS84BoundingBox"))
+    _add(bbox_node, _ows("LowerCorner"), f"{bbox['left']} {bbox['bottom']}")
+    _add(bbox_node, _ows("UpperCorner"), f"{bbox['right']} {bbox['top']}")
+
+    _add(layer_node, _ows("Identifier"), layer_name)
+
+    style_node = _add(layer_node, _wmts("Style"), isDefault="true")
+    _add(style_node, _ows("Identifier"), "default")
+
+    _add(layer_node, _wmts("Format"), "image/png")
+
+    link_node = _add(layer_node, _wmts("TileMatrixSetLink"))
+    _add(link_node, _wmts("TileMatrixSet"), TILE_MATRIX_SET)
+
+    _add(
+        layer_node,
+        _wmts("ResourceURL"),
+        format="image/png",
+        resourceType="tile",
+        template=f"{base_url}/{layer_name}/{{TileMatrix}}/{{TileCol}}/{{TileRow}}.png",
+    )
+
+
+def add_tile_matrix_set(contents):
+    matrix_set_node = _add(contents, _wmts("TileMatrixSet"))
+    _add(matrix_set_node, _ows("Identifier"), TILE_MATRIX_SET)
+    _add(matrix_set_node, _ows("SupportedCRS"), "urn:ogc:def:crs:EPSG::3857")
+    _add(
+        matrix_set_node,
+        _wmts("WellKnownScaleSet"),
+        "urn:ogc:def:wkss:OGC:1.0:GoogleMapsCompatible",
+    )
+
+    for z in range(0, current_app.config["WMTS"]["MAX_ZOOM"] + 1):
+        matrix_node = _add(matrix_set_node, _wmts("TileMatrix"))
+        _add(matrix_node, _ows("Identifier"), z)
+        _add(matrix_node, _wmts("ScaleDenominator"), grid.SCALE_DENOMINATOR / 2 ** z)
+        _add(matrix_node, _wmts("TopLeftCorner"), f"{-grid.EXTENT} {grid.EXTENT}")
+        _add(matrix_node, _wmts("TileWidth"), grid.TILE_SIZE)
+        _add(matrix_node, _wmts("TileHeight"), grid.TILE_SIZE)
+        _add(matrix_node, _wmts("MatrixWidth"), 2 ** z)
+        _add(matrix_node, _wmts("MatrixHeight"), 2 ** z)
@@ -0,0 +1,19 @@
+from app.common.test import BaseApiTest
+
+
+class MetricsTest(BaseApiTest):
+    def testMetrics(self):
+        response = self.client.get("metrics")
+        self.assertStatusCodeEqual(response, 200)
+
+        for section in (
+            "datasets_server",
+            "metadata_cache",
+            "file_cache",
+            "tile_cache",
+            "registry",
+        ):
+            self.assertTrue(section in response.json)
+
+        self.assertTrue("hit_rate" in response.json["metadata_cache"])
+        self.assertTrue("mean_latency" in response.json["datasets_server"])
@@ -11,6 +11,10 @@ import sys
 from app import create_app
 
 workers = multiprocessing.cpu_count() + 1
+
+# The workers are single-threaded, since the rendering isn't thread-safe: the
+# requests waiting for the status of a CM task to change are answered by another
+# server (see gunicorn_tasks.py)
 timeout = 2000
 
 
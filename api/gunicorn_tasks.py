@@ -0,0 +1,16 @@
+"""Configuration file for the gunicorn server answering the requests waiting for the
+status of a CM task to change (see endpoints/calculation_module.py), routed to it by
+the frontend.
+
+Each of those requests holds a thread while it waits, so the server uses threaded
+workers. That is only safe because no other request is sent to it: the rendering of
+the maps isn't thread-safe, and is done by the single-threaded workers of the main
+server (see gunicorn.py).
+"""
+
+worker_class = "gthread"
+workers = 2
+threads = 32
+
+# The requests wait at most CM_TASK_MAX_WAIT seconds
+timeout = 120
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Benchmark of the "GetMap" operation of the WMS on synthetic layers.
+
+A raster layer (split in several GeoTIFF files) and a vector layer (a grid of
+polygons) are generated in a temporary WMS cache, then GetMap requests covering them
+are sent to the api, with the tile cache disabled so that each request is rendered:
+
+* "cold": the registry of mapnik objects is emptied before each request, which is
+  the behaviour of the api before the registry was introduced
+* "warm": the mapnik styles and maps are reused across requests
+
+Run it from the api folder:
+
+    python3 scripts/benchmark_getmap.py --requests 200
+
+The raster layer is rendered through its VRT mosaic, unless --no-mosaic is given (to
+measure the rendering of the files in batches of 9).
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import Mock, patch
+
+import gdal
+import numpy as np
+import osr
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from app.common import path  # noqa: E402
+from app.common.projection import epsg_to_proj4  # noqa: E402
+from app.models import geofile, storage  # noqa: E402
+from app.models.wms import registry  # noqa: E402
+
+# Area covered by the synthetic layers (longitude/latitude)
+WEST, EAST, SOUTH, NORTH = 5.0, 15.0, 45.0, 50.0
+
+RASTER_LAYER = path.make_unique_layer_name(path.RASTER, 1000, "value")
+VECTOR_LAYER = path.make_unique_layer_name(path.VECTOR, 1001, "value")
+
+ZOOM = 7
+TILE_SIZE = 256
+EARTH_RADIUS = 6378137.0
+
+
+def get_parser():
+    """Return the argument parser of the benchmark"""
+    parser = argparse.ArgumentParser(__name__)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--raster-files", type=int, default=4)
+    parser.add_argument("--raster-size", type=int, default=1000)
+    parser.add_argument("--polygons", type=int, default=50)
+    parser.add_argument("--no-mosaic", action="store_true")
+    return parser
+
+
+def create_raster_layer(nb_files, raster_size, mosaic):
+    """Create a raster layer made of nb_files GeoTIFF files side by side"""
+    storage_instance = storage.create(RASTER_LAYER)
+    folder = storage_instance.get_dir(RASTER_LAYER, cache=True)
+    os.makedirs(folder)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    driver = gdal.GetDriverByName("GTiff")
+    width = (EAST - WEST) / nb_files
+    geometries = {}
+
+    for n in range(nb_files):
+        feature_id = f"{n:03}.tif"
+        west = WEST + n * width
+
+        dataset = driver.Create(
+            storage_instance.get_file_path(RASTER_LAYER, feature_id),
+            raster_size,
+            raster_size,
+            1,
+            gdal.GDT_Float32,
+        )
+        dataset.SetGeoTransform(
+            (
+                west,
+                width / raster_size,
+                0,
+                NORTH,
+                0,
+                -(NORTH - SOUTH) / raster_size,
+            )
+        )
+        dataset.SetProjection(srs.ExportToWkt())
+        dataset.GetRasterBand(1).WriteArray(
+            np.random.uniform(1, 255, (raster_size, raster_size)).astype(np.float32)
+        )
+        dataset = None
+
+        geometries[feature_id] = [
+            [west, NORTH],
+            [west + width, NORTH],
+            [west + width, SOUTH],
+            [west, SOUTH],
+            [west, NORTH],
+        ]
+
+    with open(storage_instance.get_geometries_file(RASTER_LAYER), "w") as f:
+        json.dump(geometries, f)
+
+    geofile.save_raster_projection(RASTER_LAYER, epsg_to_proj4(4326))
+
+    if mosaic:
+        geofile.save_raster_mosaic(RASTER_LAYER)
+
+    geofile.update_layer_version(RASTER_LAYER)
+
+
+def create_vector_layer(nb_polygons):
+    """Create a vector layer made of a grid of nb_polygons x nb_polygons squares"""
+    dx = (EAST - WEST) / nb_polygons
+    dy = (NORTH - SOUTH) / nb_polygons
+
+    features = []
+    for i in range(nb_polygons):
+        for j in range(nb_polygons):
+            x = WEST + i * dx
+            y = SOUTH + j * dy
+            value = float(np.random.uniform(0, 255))
+
+            features.append(
+                {
+                    "type": "Feature",
+                    "id": f"{i}-{j}",
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [
+                            [[x, y], [x + dx, y], [x + dx, y + dy], [x, y + dy], [x, y]]
+                        ],
+                    },
+                    "properties": {
+                        "legend": {"symbology": []},
+                        "variables": {"value": value},
+                    },
+                }
+            )
+
+    geofile.save_vector_geojson(
+        VECTOR_LAYER, {"type": "FeatureCollection", "features": features}
+    )
+    geofile.update_layer_version(VECTOR_LAYER)
+
+
+def get_tiles():
+    """Return the bounding boxes (in EPSG:3857) of the tiles covering the area"""
+
+    def _to_tile(longitude, latitude):
+        n = 2 ** ZOOM
+        x = int((longitude + 180.0) / 360.0 * n)
+        y = int(
+            (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n
+        )
+        return x, y
+
+    extent = 2 * math.pi * EARTH_RADIUS
+    tile_extent = extent / 2 ** ZOOM
+
+    min_x, min_y = _to_tile(WEST, NORTH)
+    max_x, max_y = _to_tile(EAST, SOUTH)
+
+    tiles = []
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            left = -extent / 2 + x * tile_extent
+            top = extent / 2 - y * tile_extent
+            tiles.append(f"{left},{top - tile_extent},{left + tile_extent},{top}")
+
+    return tiles
+
+
+def run(client, layer_name, tiles, nb_requests, cold):
+    """Send the GetMap requests and return the number of requests per second"""
+    registry.clear()
+
+    start = time.perf_counter()
+
+    for n in range(nb_requests):
+        if cold:
+            registry.clear()
+
+        response = client.get(
+            "api/wms",
+            query_string={
+                "service": "WMS",
+                "request": "GetMap",
+                "layers": layer_name,
+                "styles": "",
+                "format": "image/png",
+                "transparent": "true",
+                "version": "1.1.1",
+                "width": str(TILE_SIZE),
+                "height": str(TILE_SIZE),
+                "srs": "EPSG:3857",
+                "bbox": tiles[n % len(tiles)],
+            },
+        )
+
+        if response.status_code != 200:
+            raise RuntimeError(f"GetMap failed with status {response.status_code}")
+
+    return nb_requests / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    flask_app = create_app(testing=True)
+    wms_cache_dir = tempfile.mkdtemp()
+    flask_app.config["WMS_CACHE_DIR"] = wms_cache_dir
+    flask_app.config["WMS"]["TILE_CACHE"]["ENABLED"] = False
+
+    try:
+        with patch("app.common.client.get_legend", new=Mock(return_value=None)):
+            with flask_app.app_context():
+                create_raster_layer(
+                    args.raster_files, args.raster_size, not args.no_mosaic
+                )
+                create_vector_layer(args.polygons)
+
+            client = flask_app.test_client()
+            tiles = get_tiles()
+
+            for layer_name in (RASTER_LAYER, VECTOR_LAYER):
+                cold = run(client, layer_name, tiles, args.requests, cold=True)
+                warm = run(client, layer_name, tiles, args.requests, cold=False)
+
+                print(
+                    f"{layer_name}: {cold:.1f} requests/s without registry,"
+                    f" {warm:.1f} requests/s with registry ({warm / cold:.2f}x)"
+                )
+    finally:
+        shutil.rmtree(wms_cache_dir)
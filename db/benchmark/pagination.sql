@@ -0,0 +1,103 @@
+-- Compare the offset and keyset pagination of the GeoJSON queries on a vector dataset,
+-- by requesting its first, middle and last pages with both functions.
+--
+-- Usage, on an integrated dataset:
+--   psql -h 127.0.0.1 -U test dataset -v ds_id=2 -v row_limit=1000 -f pagination.sql
+--
+-- Without ds_id, a synthetic dataset is generated instead (by default 1 000 000 rows
+-- in the data table, spread over 10 000 features), and both functions are run on it
+-- twice: reading the data table, then the features table filled by
+-- enermaps_refresh_features. Everything is done in a transaction rolled back at the
+-- end, so the database is left untouched:
+--   psql -h 127.0.0.1 -U test dataset -v row_limit=1000 -v nb_rows=1000000 \
+--        -v nb_fids=10000 -f pagination.sql
+
+\set ON_ERROR_STOP on
+
+\if :{?row_limit}
+\else
+    \set row_limit 1000
+\endif
+
+CREATE FUNCTION pg_temp.benchmark_pagination(parameters text, row_limit int)
+    RETURNS void
+    AS $$
+    DECLARE
+        bounds jsonb;
+        nb_pages int;
+        page int;
+        started_at timestamptz;
+    BEGIN
+        started_at := clock_timestamp();
+        bounds := enermaps_count_features(parameters, row_limit);
+        nb_pages := jsonb_array_length(bounds->'after_fids');
+        RAISE NOTICE '% features, % pages (count: % ms)',
+            bounds->>'count', nb_pages,
+            round(extract(epoch FROM clock_timestamp() - started_at)::numeric * 1000);
+
+        FOREACH page IN ARRAY ARRAY[0, nb_pages / 2, nb_pages - 1] LOOP
+            started_at := clock_timestamp();
+            PERFORM enermaps_query_geojson(parameters, row_limit, page * row_limit);
+            RAISE NOTICE 'page %: offset % ms', page,
+                round(extract(epoch FROM clock_timestamp() - started_at)::numeric * 1000);
+
+            started_at := clock_timestamp();
+            PERFORM enermaps_query_geojson_keyset(parameters, row_limit,
+                                                  bounds->'after_fids'->>page);
+            RAISE NOTICE 'page %: keyset % ms', page,
+                round(extract(epoch FROM clock_timestamp() - started_at)::numeric * 1000);
+        END LOOP;
+    END;
+    $$
+    LANGUAGE plpgsql;
+
+\if :{?ds_id}
+    SELECT pg_temp.benchmark_pagination(
+        json_build_object('data.ds_id', :ds_id)::text, :row_limit);
+\else
+    \if :{?nb_rows}
+    \else
+        \set nb_rows 1000000
+    \endif
+    \if :{?nb_fids}
+    \else
+        \set nb_fids 10000
+    \endif
+
+    -- Identifier unlikely to be used by an integrated dataset
+    \set ds_id 2147483647
+
+    BEGIN;
+
+    INSERT INTO datasets (ds_id, metadata, shared_id)
+        VALUES (:ds_id, '{}', 'pagination-benchmark');
+
+    -- The features are points on a grid with a spacing of 100 meters
+    INSERT INTO spatial (fid, ds_id, geometry)
+        SELECT 'BENCHMARK_' || lpad(i::text, 8, '0'), :ds_id,
+               ST_SetSRID(ST_MakePoint(4000000 + (i % 1000) * 100,
+                                       3000000 + (i / 1000) * 100), 3035)
+            FROM generate_series(0, :nb_fids - 1) AS i;
+
+    -- Each feature has nb_rows / nb_fids variables
+    INSERT INTO data (fields, variable, unit, value, ds_id, fid, isRaster)
+        SELECT '{}', 'variable_' || (i / :nb_fids), 'MW', random() * 1000, :ds_id,
+               'BENCHMARK_' || lpad((i % :nb_fids)::text, 8, '0'), false
+            FROM generate_series(0, :nb_rows - 1) AS i;
+
+    ANALYZE spatial;
+    ANALYZE data;
+
+    \echo 'Synthetic dataset, data table:'
+    SELECT pg_temp.benchmark_pagination(
+        json_build_object('data.ds_id', :ds_id)::text, :row_limit);
+
+    SELECT enermaps_refresh_features(:ds_id);
+    ANALYZE features;
+
+    \echo 'Synthetic dataset, features table:'
+    SELECT pg_temp.benchmark_pagination(
+        json_build_object('data.ds_id', :ds_id)::text, :row_limit);
+
+    ROLLBACK;
+\endif
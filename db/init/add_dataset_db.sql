@@ -33,7 +33,8 @@ CREATE TABLE public.spatial
     cntr_code char(2),
     levl_code levl DEFAULT 'geometry',
     ds_id int,
-    geometry geometry(Geometry,3035)
+    geometry geometry(Geometry,3035),
+    geojson jsonb
 );
 
 CREATE TABLE public.data
@@ -59,6 +60,20 @@ CREATE TABLE public.visualization
     timestamp timestamp with time zone DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Variables of the data aggregated by feature (see enermaps_refresh_features)
+CREATE TABLE public.features
+(
+    fid varchar(200),
+    ds_id int,
+    start_at timestamp without time zone,
+    fields jsonb,
+    dt double precision,
+    z double precision,
+    vis_id uuid,
+    variables jsonb,
+    units jsonb
+);
+
 CREATE TABLE public.stats
 (
     index SERIAL PRIMARY KEY,
@@ -86,6 +101,13 @@ ALTER TABLE data
     ON DELETE CASCADE
 ;
 
+ALTER TABLE features
+    ADD CONSTRAINT fk_ds_id
+    FOREIGN KEY(ds_id)
+    REFERENCES datasets(ds_id)
+    ON DELETE CASCADE
+;
+
 ALTER TABLE data
     ADD CONSTRAINT fk_vis_id
     FOREIGN KEY(vis_id)
@@ -99,6 +121,7 @@ CREATE INDEX on data(israster);
 CREATE INDEX on data(vis_id);
 CREATE INDEX on data(start_at);
 CREATE INDEX on data(vis_id);
+CREATE INDEX on features(ds_id, fid);
 CREATE INDEX on spatial(ds_id);
 CREATE INDEX on spatial(levl_code);
 CREATE INDEX ON spatial USING gist(geometry);
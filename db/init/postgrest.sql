@@ -2,21 +2,35 @@
 \set db_db `echo "${DB_DB}"`
 \c :db_db;
 
-CREATE ROLE api_anon nologin;
+-- The roles are only created if they don't exist yet, so this script can be run again
+-- on an existing database to update the functions (see db/migrations)
+DO $$
+DECLARE
+    role_name text;
+BEGIN
+    FOREACH role_name IN ARRAY ARRAY['api_anon', 'api_user', 'legend_editor', 'data_loader'] LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_roles WHERE rolname = role_name) THEN
+            EXECUTE format('CREATE ROLE %I nologin', role_name);
+        END IF;
+    END LOOP;
+END
+$$;
+
 GRANT usage ON schema public TO api_anon;
 GRANT api_anon TO test;
 
-CREATE ROLE api_user nologin;
 GRANT api_user TO test;
 
-CREATE ROLE legend_editor nologin;
 GRANT legend_editor TO test;
 
+GRANT data_loader TO test;
+
 GRANT USAGE ON schema public TO api_user;
 GRANT SELECT ON public.spatial TO api_user;
 GRANT SELECT ON public.data TO api_user;
 GRANT SELECT ON public.datasets TO api_user;
 GRANT SELECT ON public.visualization TO api_user;
+GRANT SELECT ON public.features TO api_user;
 
 
 -- Query returning geojson with flexible json input (actually in text format, to be PostgREST-friendly)
@@ -68,43 +82,157 @@ $$
 LANGUAGE plpgsql
 IMMUTABLE;
 
--- Main function
-CREATE OR REPLACE FUNCTION enermaps_query_geojson(parameters text,
-                                                    row_limit int default 100,
-                                                    row_offset int default 0)
-    RETURNS JSONB
+-- Utility function to create the conditions of a where-clause from the json parameters
+-- of the queries ('TRUE' if there is no parameter)
+CREATE OR REPLACE FUNCTION enermaps_where_conditions(parameters text)
+    RETURNS text
     AS $$
     DECLARE
-        -- where string
-        where_string text := 'WHERE ';
-        -- variables to loop on the json input
+        conditions text[] := '{}';
         _key text;
         _value text;
-        _subkey text;
-        _subvalue text;
-        counter int := 0;
-        -- output
-        out_jsonb jsonb;
     BEGIN
         FOR _key, _value IN
            SELECT * FROM json_each_text(parameters::json)
             LOOP
             IF _key = 'level' THEN
-                where_string := where_string || 'spatial.levl_code = ANY(''' || _value || '''::levl[])';
+                conditions := conditions || ('spatial.levl_code = ANY(''' || _value || '''::levl[])');
             ELSIF _key = 'intersecting' THEN
-                where_string := where_string || 'ST_intersects(spatial.geometry,ST_TRANSFORM(ST_GeometryFromText(''' || _value || ''',4326),3035))';
+                conditions := conditions || ('ST_intersects(spatial.geometry,ST_TRANSFORM(ST_GeometryFromText(''' || _value || ''',4326),3035))');
             ELSIF is_json_object(_value) THEN
-                where_string := where_string ||  create_json_where(_key, _value::json);
+                conditions := conditions || create_json_where(_key, _value::json);
             ELSIF _value is null THEN
-                where_string := where_string || _key || ' IS NULL ';
+                conditions := conditions || (_key || ' IS NULL ');
             ELSE
-                where_string := where_string || _key || ' = ' || _value;
-            END IF;
-            counter := counter + 1;
-            IF counter < count(*) FROM json_object_keys(parameters::json) THEN
-                where_string := where_string || ' AND ';
+                conditions := conditions || (_key || ' = ' || _value);
             END IF;
         END LOOP;
+        IF array_length(conditions, 1) IS NULL THEN
+            RETURN 'TRUE';
+        END IF;
+        RETURN array_to_string(conditions, ' AND ');
+    END;
+    $$
+    LANGUAGE plpgsql;
+GRANT EXECUTE ON FUNCTION enermaps_where_conditions(text) to api_user;
+
+-- Precomputed features
+-- The "features" table contains the variables of the data aggregated by feature, as
+-- returned by the queries, and the "geojson" column of the "spatial" table the geometry
+-- transformed into a GeoJSON object in EPSG:4326. They are filled by the data
+-- integration scripts once a dataset is loaded.
+DROP FUNCTION IF EXISTS enermaps_refresh_features(dataset_id int);
+CREATE OR REPLACE FUNCTION enermaps_refresh_features(dataset_id int)
+    RETURNS void
+    AS $$
+    BEGIN
+        -- The geometries of the features of the dataset are converted again, in case
+        -- they were modified since the last refresh
+        UPDATE spatial
+            SET geojson = ST_AsGeoJSON(ST_Reverse(ST_ForceRHR(ST_TRANSFORM(geometry, 4326))))::jsonb
+            WHERE fid IN (SELECT DISTINCT fid FROM data WHERE ds_id = dataset_id);
+
+        DELETE FROM features WHERE ds_id = dataset_id;
+        INSERT INTO features (fid, ds_id, start_at, fields, dt, z, vis_id, variables, units)
+            SELECT fid, ds_id, start_at, fields, dt, z, vis_id,
+                COALESCE(jsonb_object_agg(variable, value) FILTER (WHERE variable IS NOT NULL),
+                         '{}'::jsonb),
+                COALESCE(jsonb_object_agg(variable, unit) FILTER (WHERE variable IS NOT NULL),
+                         '{}'::jsonb)
+                FROM data
+                WHERE ds_id = dataset_id
+                GROUP BY fid, ds_id, start_at, fields, dt, z, vis_id;
+    END;
+    $$
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = public, pg_temp;
+-- Only the data integration scripts and the legend editor may refresh the features
+REVOKE EXECUTE ON FUNCTION enermaps_refresh_features(int) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION enermaps_refresh_features(int) TO data_loader;
+GRANT EXECUTE ON FUNCTION enermaps_refresh_features(int) TO legend_editor;
+
+-- Utility function returning the table to read the features matching the parameters
+-- from: the precomputed features if the dataset has some and the parameters only select
+-- whole features, the data table otherwise
+CREATE OR REPLACE FUNCTION enermaps_features_table(parameters text)
+    RETURNS text
+    AS $$
+    DECLARE
+        dataset_id text := parameters::json ->> 'data.ds_id';
+    BEGIN
+        IF dataset_id IS NULL OR dataset_id !~ '^[0-9]+$' THEN
+            RETURN 'data';
+        END IF;
+        IF EXISTS (
+            SELECT 1 FROM json_object_keys(parameters::json) AS _key
+                WHERE _key NOT IN ('data.ds_id', 'data.fid', 'start_at', 'dt', 'z',
+                                   'fields', 'level', 'intersecting')
+        ) THEN
+            RETURN 'data';
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM features WHERE ds_id = dataset_id::int) THEN
+            RETURN 'data';
+        END IF;
+        RETURN 'features';
+    END;
+    $$
+    LANGUAGE plpgsql
+    STABLE;
+GRANT EXECUTE ON FUNCTION enermaps_features_table(text) to api_user;
+
+-- Utility function returning the query of the features (one row per feature) matching
+-- the conditions, with the given expression as geometry
+CREATE OR REPLACE FUNCTION enermaps_features_query(parameters text,
+                                                     conditions text,
+                                                     geometry text)
+    RETURNS text
+    AS $$
+    BEGIN
+        IF enermaps_features_table(parameters) = 'features' THEN
+            RETURN format('
+                SELECT data.fid,
+                    data.variables,
+                    data.units,
+                    data.fields,
+                    visualization.legend,
+                    data.start_at, data.dt, data.z, data.ds_id, %s AS geometry
+                    FROM features AS data
+                    INNER JOIN spatial ON data.fid = spatial.fid
+                    LEFT JOIN visualization ON data.vis_id = visualization.vis_id
+                    WHERE %s', geometry, conditions);
+        END IF;
+        RETURN format('
+            SELECT data.fid,
+                COALESCE(jsonb_object_agg(variable, value) FILTER (WHERE variable IS NOT NULL),
+                         ''{}''::jsonb) as variables,
+                COALESCE(jsonb_object_agg(variable, unit) FILTER (WHERE variable IS NOT NULL),
+                         ''{}''::jsonb) as units,
+                fields,
+                legend,
+                start_at, dt, z, data.ds_id, %s AS geometry
+                FROM data
+                INNER JOIN spatial ON data.fid = spatial.fid
+                LEFT JOIN visualization ON data.vis_id = visualization.vis_id
+                WHERE %s
+                GROUP BY data.fid, spatial.fid, start_at, dt, z, data.ds_id, fields, legend',
+            geometry, conditions);
+    END;
+    $$
+    LANGUAGE plpgsql
+    STABLE;
+GRANT EXECUTE ON FUNCTION enermaps_features_query(text, text, text) to api_user;
+
+-- Main function
+CREATE OR REPLACE FUNCTION enermaps_query_geojson(parameters text,
+                                                    row_limit int default 100,
+                                                    row_offset int default 0)
+    RETURNS JSONB
+    AS $$
+    DECLARE
+        -- output
+        out_jsonb jsonb;
+    BEGIN
         EXECUTE format('
         SELECT jsonb_build_object(
         ''type'',     ''FeatureCollection'',
@@ -114,23 +242,17 @@ CREATE OR REPLACE FUNCTION enermaps_query_geojson(parameters text,
               SELECT jsonb_build_object(
                 ''type'',       ''Feature'',
                 ''id'',         fid,
-                ''geometry'',   ST_AsGeoJSON(ST_Reverse(ST_ForceRHR(ST_TRANSFORM(geometry, 4326))))::jsonb,
+                ''geometry'',   geometry,
                 ''properties'', to_jsonb(inputs) - ''fid'' - ''geometry''
               ) AS feature
-                FROM (SELECT data.fid,
-                    jsonb_object_agg(variable, value) as variables,
-                    jsonb_object_agg(variable, unit) as units,
-                    fields,
-                    legend,
-                    start_at, dt, z, data.ds_id, geometry
-                    FROM data
-                    INNER JOIN spatial ON data.fid = spatial.fid
-                    LEFT JOIN visualization ON data.vis_id = visualization.vis_id
-                    %s
-                    GROUP BY data.fid, start_at, dt, z, data.ds_id, fields, legend, geometry
+                FROM (%s
                     ORDER BY data.fid LIMIT %s OFFSET %s)
                 inputs)
-            features;', where_string, row_limit, row_offset)
+            features;',
+            enermaps_features_query(parameters,
+                                    enermaps_where_conditions(parameters),
+                                    'COALESCE(spatial.geojson, ST_AsGeoJSON(ST_Reverse(ST_ForceRHR(ST_TRANSFORM(spatial.geometry, 4326))))::jsonb)'),
+            row_limit, row_offset)
         INTO out_jsonb;
         RETURN out_jsonb;
     END;
@@ -156,50 +278,187 @@ CREATE OR REPLACE FUNCTION enermaps_query_table(parameters text,
         geometry geometry(Geometry,3035)
     )
     AS $$
+    BEGIN
+        RETURN QUERY EXECUTE format('%s
+                    ORDER BY data.fid LIMIT %s OFFSET %s;',
+            enermaps_features_query(parameters,
+                                    enermaps_where_conditions(parameters),
+                                    'spatial.geometry'),
+            row_limit, row_offset);
+    END;
+    $$
+    LANGUAGE plpgsql;
+GRANT EXECUTE ON FUNCTION enermaps_query_table(parameters text, row_limit int, row_offset int) to api_user;
+
+-- Index used to iterate over the features of a dataset in the order of their fid
+CREATE INDEX IF NOT EXISTS data_ds_id_fid_idx ON data(ds_id, fid);
+
+-- Variant of enermaps_query_geojson using keyset pagination: instead of skipping the
+-- features of the previous pages (which are all aggregated again for each page, making
+-- the last pages of a big dataset very slow), the page starts right after the fid
+-- given by after_fid (the last fid of the previous page, NULL for the first page).
+-- A page contains all the features of row_limit distinct fids.
+CREATE OR REPLACE FUNCTION enermaps_query_geojson_keyset(parameters text,
+                                                           row_limit int default 100,
+                                                           after_fid text default null)
+    RETURNS JSONB
+    AS $$
     DECLARE
-        -- where string
-        where_string text := 'WHERE ';
-        -- variables to loop on the json input
-        _key text;
-        _value text;
-        counter int := 0;
+        where_string text;
+        out_jsonb jsonb;
     BEGIN
-        FOR _key, _value IN
-           SELECT * FROM json_each_text(parameters::json)
-            LOOP
-            IF _key = 'level' THEN
-                where_string := where_string || 'spatial.levl_code = ANY(''' || _value || '''::levl[])';
-            ELSIF _key = 'intersecting' THEN
-                where_string := where_string || 'ST_intersects(spatial.geometry,ST_TRANSFORM(ST_GeometryFromText(''' || _value || ''',4326),3035))';
-            ELSIF is_json_object(_value) THEN
-                where_string := where_string || create_json_where(_key, _value::json);
-            ELSIF _value is null THEN
-                where_string := where_string || _key || ' IS NULL ';
-            ELSE
-                where_string := where_string || _key || ' = ' || _value;
-            END IF;
-            counter := counter + 1;
-            IF counter < count(*) FROM json_object_keys(parameters::json) THEN
-                where_string := where_string || ' AND ';
-            END IF;
-        END LOOP;
-        RETURN QUERY EXECUTE format('
-        SELECT data.fid,
-                    jsonb_object_agg(variable, value) as variables,
-                    jsonb_object_agg(variable, unit) as units,
-                    fields,
-                    legend,
-                    start_at, dt, z, data.ds_id, geometry
+        where_string := enermaps_where_conditions(parameters);
+        IF after_fid IS NOT NULL THEN
+            where_string := where_string || ' AND data.fid > ' || quote_literal(after_fid);
+        END IF;
+        EXECUTE format('
+        WITH page AS (
+            SELECT DISTINCT data.fid
+                FROM %s AS data
+                INNER JOIN spatial ON data.fid = spatial.fid
+                LEFT JOIN visualization ON data.vis_id = visualization.vis_id
+                WHERE %s
+                ORDER BY data.fid LIMIT %s
+        )
+        SELECT jsonb_build_object(
+        ''type'',     ''FeatureCollection'',
+        ''features'', jsonb_agg(features.feature ORDER BY features.fid)
+        )
+            FROM (
+              SELECT fid, jsonb_build_object(
+                ''type'',       ''Feature'',
+                ''id'',         fid,
+                ''geometry'',   geometry,
+                ''properties'', to_jsonb(inputs) - ''fid'' - ''geometry''
+              ) AS feature
+                FROM (%s) inputs)
+            features;',
+            enermaps_features_table(parameters), where_string, row_limit,
+            enermaps_features_query(parameters,
+                                    where_string || ' AND data.fid IN (SELECT fid FROM page)',
+                                    'COALESCE(spatial.geojson, ST_AsGeoJSON(ST_Reverse(ST_ForceRHR(ST_TRANSFORM(spatial.geometry, 4326))))::jsonb)'))
+        INTO out_jsonb;
+        RETURN out_jsonb;
+    END;
+    $$
+    LANGUAGE plpgsql;
+GRANT EXECUTE ON FUNCTION enermaps_query_geojson_keyset(text, integer, text) to api_user;
+
+-- Count the distinct fids matching the parameters, and return the after_fid values of
+-- the successive pages of enermaps_query_geojson_keyset, so that all the pages can be
+-- requested at once:
+-- {"count": 2500, "after_fids": [null, "<1000th fid>", "<2000th fid>"]}
+CREATE OR REPLACE FUNCTION enermaps_count_features(parameters text,
+                                                     row_limit int default 100)
+    RETURNS JSONB
+    AS $$
+    DECLARE
+        out_jsonb jsonb;
+    BEGIN
+        EXECUTE format('
+        SELECT jsonb_build_object(
+            ''count'',      count(*),
+            ''after_fids'', jsonb_build_array(NULL) || COALESCE(
+                jsonb_agg(fid ORDER BY position)
+                    FILTER (WHERE position %% %s = 0 AND position < total),
+                ''[]''::jsonb)
+        )
+            FROM (
+                SELECT fid,
+                    row_number() OVER (ORDER BY fid) AS position,
+                    count(*) OVER () AS total
+                    FROM (SELECT DISTINCT data.fid
+                        FROM %s AS data
+                        INNER JOIN spatial ON data.fid = spatial.fid
+                        LEFT JOIN visualization ON data.vis_id = visualization.vis_id
+                        WHERE %s) fids
+            ) numbered_fids;',
+            row_limit, enermaps_features_table(parameters),
+            enermaps_where_conditions(parameters))
+        INTO out_jsonb;
+        RETURN out_jsonb;
+    END;
+    $$
+    LANGUAGE plpgsql;
+GRANT EXECUTE ON FUNCTION enermaps_count_features(text, integer) to api_user;
+
+-- Number of features matching the parameters, latest date of their values and checksum
+-- of their content (including their geometries), used by the cache builder of the API
+-- to only download the layers modified since they were cached. It is always computed
+-- from the data table, as the precomputed features might not be refreshed yet.
+CREATE OR REPLACE FUNCTION enermaps_layer_summary(parameters text)
+    RETURNS JSONB
+    AS $$
+    DECLARE
+        out_jsonb jsonb;
+    BEGIN
+        EXECUTE format('
+        SELECT jsonb_build_object(
+            ''count'',        count(DISTINCT data.fid),
+            ''max_start_at'', max(data.start_at),
+            ''checksum'',     md5(COALESCE(string_agg(row_hash, '''' ORDER BY row_hash), ''''))
+        )
+            FROM (
+                SELECT data.fid, data.start_at,
+                    md5(data::text || spatial.geometry::text) AS row_hash
                     FROM data
                     INNER JOIN spatial ON data.fid = spatial.fid
                     LEFT JOIN visualization ON data.vis_id = visualization.vis_id
-                    %s
-                    GROUP BY data.fid, start_at, dt, z, data.ds_id, fields, legend, geometry
-                    ORDER BY data.fid LIMIT %s OFFSET %s;', where_string, row_limit, row_offset);
+                    WHERE %s
+            ) data;',
+            enermaps_where_conditions(parameters))
+        INTO out_jsonb;
+        RETURN out_jsonb;
     END;
     $$
     LANGUAGE plpgsql;
-GRANT EXECUTE ON FUNCTION enermaps_query_table(parameters text, row_limit int, row_offset int) to api_user;
+GRANT EXECUTE ON FUNCTION enermaps_layer_summary(text) to api_user;
+
+-- Mapbox Vector Tile of the XYZ grid (in Web Mercator) containing the features matching
+-- the parameters, in a layer named "features". The geometries are simplified to half a
+-- pixel of a 256x256 tile, and the variables and units of each feature are encoded as
+-- JSON strings.
+-- Requires PostGIS 2.4 or later.
+CREATE OR REPLACE FUNCTION enermaps_query_mvt(parameters text, z int, x int, y int)
+    RETURNS bytea
+    AS $$
+    DECLARE
+        -- half of the width of the world in Web Mercator coordinates
+        world_extent double precision := 20037508.342789244;
+        tile_extent double precision := 2 * world_extent / 2 ^ z;
+        bounds geometry;
+        out_mvt bytea;
+    BEGIN
+        bounds := ST_MakeEnvelope(-world_extent + x * tile_extent,
+                                  world_extent - (y + 1) * tile_extent,
+                                  -world_extent + (x + 1) * tile_extent,
+                                  world_extent - y * tile_extent,
+                                  3857);
+        EXECUTE format('
+        SELECT ST_AsMVT(tile, ''features'', 4096, ''geom'')
+            FROM (
+                SELECT fid,
+                    variables::text AS variables,
+                    units::text AS units,
+                    fields::text AS fields,
+                    start_at::text AS start_at,
+                    dt, z, ds_id,
+                    ST_AsMVTGeom(ST_SimplifyPreserveTopology(ST_Transform(geometry, 3857), $2),
+                                 $1, 4096, 64, true) AS geom
+                    FROM (%s) inputs
+            ) tile
+            WHERE geom IS NOT NULL;',
+            enermaps_features_query(parameters,
+                                    enermaps_where_conditions(parameters)
+                                        || ' AND spatial.geometry && ST_Transform(ST_Segmentize($1, $2 * 32), 3035)',
+                                    'spatial.geometry'))
+        INTO out_mvt
+        USING bounds, tile_extent / 512;
+        RETURN COALESCE(out_mvt, ''::bytea);
+    END;
+    $$
+    LANGUAGE plpgsql;
+GRANT EXECUTE ON FUNCTION enermaps_query_mvt(text, integer, integer, integer) to api_user;
 
 -- View to provide list of parameters to construct the queries
 DROP VIEW IF EXISTS parameters;
@@ -380,6 +639,10 @@ CREATE OR REPLACE FUNCTION enermaps_set_legend(parameters text, legend text)
         EXECUTE format('
         UPDATE data SET vis_id = ''%s''
                     %s', my_uuid, where_string);
+        -- Keep the precomputed features of the datasets up to date
+        PERFORM enermaps_refresh_features(updated.ds_id)
+            FROM (SELECT DISTINCT ds_id FROM data WHERE vis_id = my_uuid) updated
+            WHERE EXISTS (SELECT 1 FROM features WHERE features.ds_id = updated.ds_id);
     END;
     $$
     LANGUAGE plpgsql;
@@ -388,6 +651,7 @@ GRANT USAGE ON SCHEMA public TO legend_editor;
 GRANT EXECUTE ON FUNCTION enermaps_set_legend(parameters text, legend text) to legend_editor;
 GRANT SELECT, UPDATE ON public.data TO legend_editor;
 GRANT SELECT, INSERT ON public.visualization TO legend_editor;
+GRANT SELECT ON public.features TO legend_editor;
 
 
 -- Returns the legend of the data corresponding to the parameters
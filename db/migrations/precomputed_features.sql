@@ -0,0 +1,38 @@
+-- Migration of a database created before the precomputed features (see "Precomputed
+-- features" in db/README.md): adds the features table and the geojson column of the
+-- spatial table, reloads the functions, and refreshes the features of every dataset.
+-- It can be run several times.
+--
+-- Usage (once the image of the database is rebuilt, so it contains the current
+-- postgrest.sql):
+--   docker exec -i enermaps_db_1 psql -h 127.0.0.1 -U test dataset < db/migrations/precomputed_features.sql
+
+\set ON_ERROR_STOP on
+
+ALTER TABLE spatial ADD COLUMN IF NOT EXISTS geojson jsonb;
+
+CREATE TABLE IF NOT EXISTS features
+(
+    fid varchar(200),
+    ds_id int,
+    start_at timestamp without time zone,
+    fields jsonb,
+    dt double precision,
+    z double precision,
+    vis_id uuid,
+    variables jsonb,
+    units jsonb,
+    CONSTRAINT fk_ds_id
+        FOREIGN KEY(ds_id)
+        REFERENCES datasets(ds_id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS features_ds_id_fid_idx ON features(ds_id, fid);
+
+-- Roles, privileges and functions
+\i /docker-entrypoint-initdb.d/postgrest.sql
+
+SELECT ds_id, enermaps_refresh_features(ds_id) FROM datasets ORDER BY ds_id;
+ANALYZE spatial;
+ANALYZE features;
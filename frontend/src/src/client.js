@@ -105,9 +105,11 @@ export async function postCMTask(cm, parameters) {
 }
 
 
-export async function getTaskResult(task) {
+// The server only responds once the status of the task changes, or after 'wait'
+// seconds
+export async function getTaskResult(task, wait=0) {
   const taskResponse = await fetch(
-      BASE_URL + 'api/cm/' + task.cm.name + '/task/' + task.id + '/',
+      BASE_URL + 'api/cm/' + task.cm.name + '/task/' + task.id + '/?wait=' + wait,
   );
   return await taskResponse.json();
 }
@@ -144,18 +144,22 @@ function _deleteTask(task) {
 
 async function _retrieveTaskResult(task) {
   const TIMEOUT_MS = 500;
+  const WAIT_S = 30;
 
-  const taskResponse = await getTaskResult(task);
+  const taskResponse = await getTaskResult(task, WAIT_S).catch(() => undefined);
 
   // The above reponse can be undefined if it encountered an error,
-  // just try again if it has
-  if (!taskResponse || taskResponse.status === PENDING_STATUS) {
+  // just try again (a bit later) if it has. The server already waited for
+  // the status of a pending task to change, so ask again immediately.
+  if (!taskResponse) {
     setTimeout(
         () => {
           _retrieveTaskResult(task);
         },
         TIMEOUT_MS,
     );
+  } else if (taskResponse.status === PENDING_STATUS) {
+    _retrieveTaskResult(task);
   }
 
   if (!!taskResponse) {